@@ -0,0 +1,227 @@
+# benchmarks/bench_ingest.py
+"""
+Benchmark đường đi lấy dữ liệu -> phân tích -> ghi CSDL và các hàm đọc, với nguồn giả lập cục bộ.
+
+Chạy với một database PostgreSQL RIÊNG cho benchmark (bảng được tạo nếu chưa có, dữ liệu giả được ghi vào):
+
+    PG_DATABASE=exchange_db_bench python benchmarks/bench_ingest.py --iterations 50 --latency-ms 20
+    python benchmarks/bench_ingest.py --compare latest   # so với lần chạy trước
+
+Với mỗi giai đoạn của run_update_exchange_rates() (lấy + phân tích từng nguồn, ghi từng nguồn,
+cập nhật nến, cả vòng cập nhật song song) và các hàm đọc, in ra thông lượng và độ trễ p50/p99.
+Kết quả được lưu thành JSON trong reports/benchmarks/ để so sánh giữa các lần chạy.
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+PROJ_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJ_ROOT, 'src'))
+
+import config # noqa: E402
+import database # noqa: E402
+import log_config # noqa: E402
+import main # noqa: E402
+import services.scraper_vcb as scraper # noqa: E402
+import services.sjc_gold_scraper as scraper_sjc # noqa: E402
+from services import http_session # noqa: E402
+
+from fake_sources import FakeSources, FakeSourceState # noqa: E402
+
+RESULTS_DIR = os.path.join(PROJ_ROOT, 'reports', 'benchmarks')
+
+
+class StageTimer:
+    """Gom thời gian (giây) và số dòng xử lý của từng giai đoạn."""
+
+    def __init__(self):
+        self.samples = {}
+        self.rows = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(stage, []).append(time.perf_counter() - started)
+
+    def call(self, stage, func, *args, rows=None, **kwargs):
+        with self.measure(stage):
+            result = func(*args, **kwargs)
+        counted = rows(result) if rows is not None else None
+        if counted is not None:
+            self.rows[stage] = self.rows.get(stage, 0) + counted
+        return result
+
+    def summary(self):
+        stats = {}
+        for stage, samples in self.samples.items():
+            values = np.asarray(samples)
+            total = float(values.sum())
+            stats[stage] = {
+                'count': len(values),
+                'p50_ms': float(np.percentile(values, 50) * 1000),
+                'p99_ms': float(np.percentile(values, 99) * 1000),
+                'mean_ms': float(values.mean() * 1000),
+                'max_ms': float(values.max() * 1000),
+                'ops_per_s': len(values) / total if total > 0 else None,
+                'rows_per_s': self.rows[stage] / total if stage in self.rows and total > 0 else None,
+            }
+        return stats
+
+
+def _row_count(result):
+    return len(result) if result else 0
+
+
+def _stored_count(result):
+    return result if isinstance(result, int) else 0
+
+
+def run_benchmark(args):
+    state = FakeSourceState(args.latency_ms, args.jitter_ms, args.vcb_currencies, args.sjc_items,
+                            args.change_every, args.seed)
+    log_config.setup_logging()
+    if not args.verbose:
+        # Mỗi vòng ghi log INFO/WARNING cho từng nguồn; tắt đi để không đo cả thời gian ghi log, chỉ giữ lỗi
+        logging.disable(logging.WARNING)
+    timer = StageTimer()
+    with FakeSources(state) as sources:
+        scraper.VCB_EXCHANGE_RATE_API_URL = sources.vcb_url
+        scraper_sjc.SJC_PRICE_SERVICE_URL = sources.sjc_url
+        scraper_sjc.SJC_BRANCHES = args.sjc_branches
+        # Spool riêng, để dữ liệu giả không bao giờ bị ghi bù vào CSDL thật
+        config.SPOOL_DIR = tempfile.mkdtemp(prefix='bench-spool-')
+        database.create_tables_postgres()
+        database.preload_dimension_cache()
+
+        for _ in range(args.warmup):
+            main.fetch_and_store_all_sources()
+
+        for _ in range(args.iterations):
+            # Từng giai đoạn tuần tự, để tách thời gian mạng+phân tích khỏi thời gian ghi
+            rates, vcb_time = timer.call('vcb.fetch_parse', scraper.fetch_exchange_rates_from_api, rows=lambda r: _row_count(r[0]))
+            gold, sjc_time = timer.call('sjc.fetch_parse', scraper_sjc.get_sjc_gold_data, rows=lambda r: _row_count(r[0]))
+            if rates:
+                timer.call('vcb.store', database.insert_exchange_rates_batch, rates, vcb_time, rows=_stored_count)
+            if gold:
+                timer.call('sjc.store', database.insert_gold_prices_batch, gold, sjc_time, provider='SJC', rows=_stored_count)
+            timer.call('candles.update', database.update_candles, rows=_stored_count)
+            # Cả vòng cập nhật như run_update_exchange_rates(): hai nguồn song song, ghi ngay khi về
+            timer.call('update.fetch_and_store_all', main.fetch_and_store_all_sources)
+
+        for _ in range(args.read_iterations):
+            timer.call('read.get_latest_rates', database.get_latest_rates, rows=_row_count)
+            timer.call('read.get_latest_gold_prices', database.get_latest_gold_prices, rows=_row_count)
+            timer.call('read.get_exchange_rate_history', database.get_exchange_rate_history, 'USD', rows=_row_count)
+            timer.call('read.get_exchange_rate_candles', database.get_exchange_rate_candles, 'USD', '1m', rows=_row_count)
+        for _ in range(max(1, args.read_iterations // 10)):
+            timer.call('read.iter_exchange_rate_history', lambda: sum(len(chunk) for chunk in database.iter_exchange_rate_history()),
+                       rows=lambda n: n)
+
+    return {
+        'timestamp': datetime.now().astimezone().isoformat(timespec='seconds'),
+        'git_commit': _git_commit(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('compare', 'output')},
+        'source_traffic': {'requests': state.requests, 'bytes': state.bytes_sent},
+        'stages': timer.summary(),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJ_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results, output=None):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = output or os.path.join(RESULTS_DIR, f"ingest-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    return path
+
+
+def _latest_results(exclude=None):
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    files = sorted(name for name in os.listdir(RESULTS_DIR) if name.startswith('ingest-') and name.endswith('.json'))
+    files = [os.path.join(RESULTS_DIR, name) for name in files if os.path.join(RESULTS_DIR, name) != exclude]
+    return files[-1] if files else None
+
+
+def print_report(results, baseline=None):
+    base_stages = baseline['stages'] if baseline else {}
+    header = f"{'Giai đoạn':<34}{'n':>6}{'p50 ms':>10}{'p99 ms':>10}{'ops/s':>10}{'rows/s':>12}"
+    if baseline:
+        header += f"{'Δp50':>9}{'Δp99':>9}"
+    print(header)
+    print('-' * len(header))
+    for stage, s in results['stages'].items():
+        line = (f"{stage:<34}{s['count']:>6}{s['p50_ms']:>10.2f}{s['p99_ms']:>10.2f}"
+                f"{s['ops_per_s'] or 0:>10.1f}{s['rows_per_s'] or 0:>12.0f}")
+        if stage in base_stages:
+            old = base_stages[stage]
+            line += f"{_delta(s['p50_ms'], old['p50_ms']):>9}{_delta(s['p99_ms'], old['p99_ms']):>9}"
+        print(line)
+    for stage in ('vcb.store', 'sjc.store'):
+        if stage in results['stages'] and not results['stages'][stage]['rows_per_s'] and results['config']['change_every'] == 1:
+            print(f"CẢNH BÁO: {stage} không ghi được dòng nào; thời gian đo có thể chỉ là đường lỗi (chạy lại với --verbose).")
+    traffic = results['source_traffic']
+    print(f"\nRequest tới nguồn giả: {traffic['requests']}, byte đã gửi: {traffic['bytes']}")
+    if baseline:
+        print(f"So với: {baseline['timestamp']} (commit {baseline.get('git_commit')})")
+
+
+def _delta(new, old):
+    if not old:
+        return '-'
+    return f"{(new - old) / old * 100:+.0f}%"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark thu thập/ghi/đọc tỷ giá với nguồn giả lập cục bộ.")
+    parser.add_argument('--iterations', type=int, default=30, help="Số vòng đo cho các giai đoạn ghi")
+    parser.add_argument('--warmup', type=int, default=3, help="Số vòng chạy trước khi đo")
+    parser.add_argument('--read-iterations', type=int, default=100, help="Số vòng đo cho các hàm đọc")
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="Độ trễ giả lập của nguồn (ms)")
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help="Dao động ngẫu nhiên ±ms quanh độ trễ")
+    parser.add_argument('--vcb-currencies', type=int, default=20, help="Số ngoại tệ trong payload Vietcombank")
+    parser.add_argument('--sjc-items', type=int, default=30, help="Số mục giá vàng trong payload SJC (chia đều cho 6 chi nhánh)")
+    parser.add_argument('--sjc-branches', default='all', help="BranchId SJC cần lấy ('1,2,...' hoặc 'all')")
+    parser.add_argument('--change-every', type=int, default=1, help="Dữ liệu nguồn đổi sau mỗi N request (1 = luôn đổi)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help="Hiện log mức INFO/WARNING của ứng dụng khi đo (mặc định chỉ hiện lỗi)")
+    parser.add_argument('--output', help="File JSON kết quả (mặc định reports/benchmarks/ingest-<thời gian>.json)")
+    parser.add_argument('--compare', help="File kết quả để so sánh, hoặc 'latest' cho lần chạy gần nhất")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    baseline_path = _latest_results() if args.compare == 'latest' else args.compare
+    try:
+        results = run_benchmark(args)
+    finally:
+        main.close_replayer()
+        database.close_pool()
+        http_session.close_session()
+    path = save_results(results, args.output)
+    baseline = None
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    print(f"\nĐã lưu kết quả: {path}")
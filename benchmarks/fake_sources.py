@@ -0,0 +1,167 @@
+# benchmarks/fake_sources.py
+"""
+Server HTTP giả lập nguồn dữ liệu để benchmark, chạy cục bộ, không cần mạng:
+  - Vietcombank: GET  /api/exchangerates?date=YYYY-MM-DD  (JSON giống API thật)
+  - SJC:         POST /GoldPrice/Services/PriceService.ashx (JSON giống PriceService thật, lọc theo BranchId;
+                 BranchId 1..len(BRANCHES) có dữ liệu, BranchId khác trả về danh sách rỗng)
+Có thể chỉnh độ trễ, số mục (kích thước payload) và tần suất dữ liệu thay đổi.
+"""
+import json
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+REAL_CURRENCIES = [
+    ('USD', 'US DOLLAR', 25000), ('EUR', 'EURO', 27000), ('JPY', 'YEN', 165), ('GBP', 'UK POUND STERLING', 32000),
+    ('AUD', 'AUSTRALIAN DOLLAR', 16000), ('CAD', 'CANADIAN DOLLAR', 18000), ('CHF', 'SWISS FRANC', 28000),
+    ('CNY', 'YUAN RENMINBI', 3400), ('DKK', 'DANISH KRONE', 3600), ('HKD', 'HONGKONG DOLLAR', 3200),
+    ('INR', 'INDIAN RUPEE', 300), ('KRW', 'KOREAN WON', 17), ('KWD', 'KUWAITI DINAR', 81000),
+    ('MYR', 'MALAYSIAN RINGGIT', 5300), ('NOK', 'NORWEGIAN KRONER', 2300), ('RUB', 'RUSSIAN RUBLE', 270),
+    ('SAR', 'SAUDI RIAL', 6600), ('SEK', 'SWEDISH KRONA', 2300), ('SGD', 'SINGAPORE DOLLAR', 18500),
+    ('THB', 'THAI BAHT', 700),
+]
+GOLD_TYPES = ['Vàng SJC 1L, 10L, 1KG', 'Vàng SJC 5 chỉ', 'Vàng nhẫn SJC 99,99 1 chỉ, 2 chỉ, 5 chỉ', 'Nữ trang 99,99%', 'Nữ trang 75%']
+BRANCHES = ['Hồ Chí Minh', 'Hà Nội', 'Đà Nẵng', 'Nha Trang', 'Cà Mau', 'Huế']
+
+
+class FakeSourceState:
+    """Cấu hình và bộ đếm dùng chung của các server giả (đọc bởi nhiều thread xử lý request)."""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, vcb_currencies=20, sjc_items=30, change_every=1, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.vcb_currencies = vcb_currencies
+        self.sjc_items = sjc_items
+        self.change_every = max(1, change_every) # Dữ liệu đổi sau mỗi change_every request (1 = luôn đổi)
+        self.seed = seed
+        self.requests = {'vcb': 0, 'sjc': 0}
+        self.bytes_sent = {'vcb': 0, 'sjc': 0}
+        self._lock = threading.Lock()
+        self._base_time = datetime.now().replace(microsecond=0) - timedelta(days=1)
+
+    def next_version(self, source):
+        with self._lock:
+            self.requests[source] += 1
+            return (self.requests[source] - 1) // self.change_every
+
+    def record_bytes(self, source, size):
+        with self._lock:
+            self.bytes_sent[source] += size
+
+    def delay(self):
+        latency = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def vcb_payload(self, version):
+        rng = random.Random(self.seed * 1_000_003 + version)
+        updated = self._base_time + timedelta(minutes=version)
+        data = []
+        for i in range(self.vcb_currencies):
+            if i < len(REAL_CURRENCIES):
+                code, name, base = REAL_CURRENCIES[i]
+            else:
+                code, name, base = f"X{i:03d}", f"SYNTHETIC CURRENCY {i}", 1000 + i
+            sell = base * (1 + rng.uniform(-0.01, 0.01))
+            data.append({
+                'currencyName': name, 'currencyCode': code,
+                'cash': f"{sell * 0.985:.2f}", 'transfer': f"{sell * 0.99:.2f}", 'sell': f"{sell:.2f}",
+                'icon': f"/-/media/Default-Website/Default-Images/Icons/Flags/im_flag_{code.lower()}.svg",
+            })
+        return {'Count': len(data), 'Date': updated.strftime('%Y-%m-%dT00:00:00'),
+                'UpdatedDate': updated.strftime('%Y-%m-%dT%H:%M:%S+07:00'), 'Data': data}
+
+    def sjc_payload(self, version, branch_id=None):
+        """Giá vàng của mọi chi nhánh (branch_id=None) hoặc chỉ của chi nhánh branch_id (đánh số từ 1)."""
+        rng = random.Random(self.seed * 2_000_003 + version)
+        updated = self._base_time + timedelta(minutes=version)
+        data = []
+        for i in range(self.sjc_items):
+            type_name = GOLD_TYPES[i % len(GOLD_TYPES)]
+            if i >= len(GOLD_TYPES) * len(BRANCHES):
+                type_name = f"{type_name} #{i}"
+            buy = round(118_000_000 * (1 + rng.uniform(-0.01, 0.01)), -5)
+            branch_index = (i // len(GOLD_TYPES)) % len(BRANCHES)
+            if branch_id is not None and branch_index + 1 != branch_id:
+                continue
+            data.append({
+                'Id': i + 1, 'TypeName': type_name, 'BranchName': BRANCHES[branch_index],
+                'Buy': f"{buy:,.0f}", 'BuyValue': buy, 'Sell': f"{buy + 2_000_000:,.0f}", 'SellValue': buy + 2_000_000,
+                'BuyDiffer': None, 'BuyDifferValue': 0, 'SellDiffer': None, 'SellDifferValue': 0,
+                'GroupDate': f"/Date({int(updated.timestamp() * 1000)})/",
+            })
+        return {'success': True, 'latestDate': updated.strftime('%H:%M %d/%m/%Y'), 'data': data}
+
+
+def _make_handler(state):
+    class FakeSourceHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # Keep-alive như server thật
+
+        def setup(self):
+            super().setup()
+            # Header và body được gửi bằng hai lần write: tắt Nagle để không cộng thêm ~40ms delayed-ACK
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def _send_json(self, source, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            state.delay()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            state.record_bytes(source, len(body))
+
+        def do_GET(self):
+            if not self.path.startswith('/api/exchangerates'):
+                self.send_error(404)
+                return
+            self._send_json('vcb', state.vcb_payload(state.next_version('vcb')))
+
+        def do_POST(self):
+            form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8'))
+            if not self.path.startswith('/GoldPrice/Services/PriceService.ashx'):
+                self.send_error(404)
+                return
+            branch_id = form.get('BranchId', [None])[0]
+            self._send_json('sjc', state.sjc_payload(state.next_version('sjc'), int(branch_id) if branch_id else None))
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeSourceHandler
+
+
+class FakeSources:
+    """Chạy server giả trên 127.0.0.1 (cổng ngẫu nhiên) trong thread nền; dùng như context manager."""
+
+    def __init__(self, state):
+        self.state = state
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(state))
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def vcb_url(self):
+        return f"{self.base_url}/api/exchangerates"
+
+    @property
+    def sjc_url(self):
+        return f"{self.base_url}/GoldPrice/Services/PriceService.ashx"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-sources', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,7 +1,21 @@
+-- Cách khuyến nghị để tạo/nâng cấp schema: python src/main.py migrate
+-- (các migration trong database.SCHEMA_MIGRATIONS, phiên bản được ghi trong bảng SchemaVersion).
+-- File này là schema tham khảo, tương đương kết quả của mọi migration hiện có (SchemaVersion 5);
+-- khi thêm migration mới, cập nhật file này cho khớp.
+-- Nếu tạo bảng thủ công bằng file này, vẫn cần chạy "migrate" một lần để ghi nhận phiên bản schema:
+-- các migration dùng IF NOT EXISTS / kiểm tra cột nên không thay đổi các bảng đã tạo đúng.
+
 -- Xóa bảng nếu tồn tại để tạo lại (cẩn thận nếu có dữ liệu quan trọng)
 -- DROP TABLE IF EXISTS ExchangeRates CASCADE;
 -- DROP TABLE IF EXISTS Currencies CASCADE;
 
+-- Các migration đã áp dụng (được "migrate" ghi vào)
+CREATE TABLE IF NOT EXISTS SchemaVersion (
+    version INTEGER PRIMARY KEY,
+    description VARCHAR(255) NOT NULL,
+    applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Bảng lưu thông tin các loại tiền tệ
 CREATE TABLE IF NOT EXISTS Currencies (
     id SERIAL PRIMARY KEY,  -- Tự động tăng, tương đương AUTOINCREMENT của SQLite
@@ -9,7 +23,7 @@ CREATE TABLE IF NOT EXISTS Currencies (
     name VARCHAR(255) NOT NULL       -- Tên đầy đủ của ngoại tệ
 );
 
--- Bảng lưu lịch sử tỷ giá
+-- Bảng lưu lịch sử tỷ giá (bản phân vùng theo tháng: exchange_rate_partitioned.sql)
 CREATE TABLE IF NOT EXISTS ExchangeRates (
     id SERIAL PRIMARY KEY,
     currency_id INTEGER NOT NULL,
@@ -28,35 +42,131 @@ CREATE TABLE IF NOT EXISTS ExchangeRates (
 
 -- Tạo index để tăng tốc độ truy vấn (tùy chọn nhưng khuyến khích)
 CREATE INDEX IF NOT EXISTS idx_currencies_code ON Currencies (code);
-CREATE INDEX IF NOT EXISTS idx_exchangerates_currency_id ON ExchangeRates (currency_id);
+-- Tra cứu tỷ giá tại thời điểm (get_exchange_rates_as_of); cũng phục vụ các truy vấn lọc theo currency_id
+CREATE INDEX IF NOT EXISTS idx_exchangerates_currency_source_time
+    ON ExchangeRates (currency_id, source_update_time DESC, date_recorded DESC);
 CREATE INDEX IF NOT EXISTS idx_exchangerates_date_recorded ON ExchangeRates (date_recorded DESC);
 CREATE INDEX IF NOT EXISTS idx_exchangerates_source_update_time ON ExchangeRates (source_update_time DESC);
 
--- Thông báo tạo bảng thành công (tùy chọn)
--- SELECT 'Bảng Currencies và ExchangeRates đã được tạo/kiểm tra thành công trong PostgreSQL.' AS status;
+-- Tỷ giá mới nhất của mỗi ngoại tệ (một dòng/ngoại tệ), được ứng dụng upsert
+-- trong cùng transaction với mỗi lần ghi ExchangeRates. get_latest_rates() đọc bảng này.
+CREATE TABLE IF NOT EXISTS LatestExchangeRates (
+    currency_id INTEGER PRIMARY KEY REFERENCES Currencies (id) ON DELETE CASCADE,
+    buy_cash NUMERIC(18, 4),
+    buy_transfer NUMERIC(18, 4),
+    sell NUMERIC(18, 4) NOT NULL,
+    date_recorded TIMESTAMP WITH TIME ZONE NOT NULL,
+    source_update_time TIMESTAMP WITH TIME ZONE
+);
+
+-- Nến OHLC của tỷ giá bán (sell) theo khung '1m', '1h', '1d' (ranh giới theo giờ Việt Nam).
+-- Được cập nhật tăng dần bởi database.update_candles() từ các dòng ExchangeRates có id > watermark.
+CREATE TABLE IF NOT EXISTS ExchangeRateCandles (
+    currency_id INTEGER NOT NULL REFERENCES Currencies (id) ON DELETE CASCADE,
+    resolution VARCHAR(4) NOT NULL,
+    bucket_start TIMESTAMP WITH TIME ZONE NOT NULL,
+    open NUMERIC(18, 4) NOT NULL,
+    high NUMERIC(18, 4) NOT NULL,
+    low NUMERIC(18, 4) NOT NULL,
+    close NUMERIC(18, 4) NOT NULL,
+    tick_count INTEGER NOT NULL,
+    open_time TIMESTAMP WITH TIME ZONE NOT NULL,  -- Thời điểm tick mở nến (để trộn nến đúng thứ tự)
+    close_time TIMESTAMP WITH TIME ZONE NOT NULL, -- Thời điểm tick đóng nến
+    PRIMARY KEY (currency_id, resolution, bucket_start)
+);
+
+-- Mốc id (watermark) đã được rollup vào từng bảng nến
+CREATE TABLE IF NOT EXISTS RollupWatermarks (
+    name VARCHAR(50) PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Snapshot gần nhất đã lưu của mỗi nguồn ('VCB', 'SJC', ...).
+-- Snapshot mới trùng thời gian cập nhật và hash nội dung chỉ cập nhật last_seen/seen_count (heartbeat).
+CREATE TABLE IF NOT EXISTS SourceSnapshots (
+    source VARCHAR(50) PRIMARY KEY,
+    source_update_time TIMESTAMP WITH TIME ZONE,
+    content_hash CHAR(64) NOT NULL,  -- SHA-256 của các dòng trong snapshot
+    row_count INTEGER NOT NULL,
+    first_seen TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_seen TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    seen_count INTEGER NOT NULL DEFAULT 1
+);
 
+-- Loại vàng của từng nhà cung cấp (cùng tên có thể có ở nhiều nhà cung cấp)
 CREATE TABLE IF NOT EXISTS GoldTypes (
-        id SERIAL PRIMARY KEY,
-        name VARCHAR(255) UNIQUE NOT NULL, -- Ví dụ: "Vàng SJC 1L - 10L - TP. Hồ Chí Minh"
-        original_type_name VARCHAR(255),   -- Ví dụ: "Vàng SJC 1L - 10L" (tên gốc)
-        city_name VARCHAR(100),            -- Ví dụ: "TP. Hồ Chí Minh"
-        provider VARCHAR(50) DEFAULT 'SJC' NOT NULL -- Nhà cung cấp, mặc định SJC
-    );
-
-    CREATE TABLE IF NOT EXISTS GoldPrices (
-        id SERIAL PRIMARY KEY,
-        gold_type_id INTEGER NOT NULL,
-        date_recorded TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
-        buy_price BIGINT, -- Lưu giá trị nguyên, ví dụ 87500000
-        sell_price BIGINT,
-        unit VARCHAR(50) DEFAULT 'đồng/lượng',
-        source_update_time TIMESTAMP WITH TIME ZONE, -- Thời gian SJC cập nhật
-        CONSTRAINT fk_gold_type
-            FOREIGN KEY (gold_type_id)
-            REFERENCES GoldTypes (id)
-            ON DELETE CASCADE
-    );
-
-    CREATE INDEX IF NOT EXISTS idx_goldtypes_name ON GoldTypes (name);
-    CREATE INDEX IF NOT EXISTS idx_goldprices_gold_type_id ON GoldPrices (gold_type_id);
-    CREATE INDEX IF NOT EXISTS idx_goldprices_date_recorded ON GoldPrices (date_recorded DESC);
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,        -- Ví dụ: "Vàng SJC 1L - 10L - TP. Hồ Chí Minh"
+    original_type_name VARCHAR(255),   -- Ví dụ: "Vàng SJC 1L - 10L" (tên gốc)
+    city_name VARCHAR(100),            -- Ví dụ: "TP. Hồ Chí Minh"
+    provider VARCHAR(50) NOT NULL,     -- Nhà cung cấp: 'SJC', 'PNJ', ...
+    UNIQUE(name, provider)
+);
+
+-- Bảng lưu lịch sử giá vàng
+CREATE TABLE IF NOT EXISTS GoldPrices (
+    id SERIAL PRIMARY KEY,
+    gold_type_id INTEGER NOT NULL,
+    date_recorded TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    buy_price NUMERIC(18, 4),
+    sell_price NUMERIC(18, 4),
+    unit VARCHAR(20) NOT NULL,         -- Đơn vị giá theo nguồn, ví dụ: 'đồng/lượng'
+    source_update_time TIMESTAMP WITH TIME ZONE, -- Thời gian nguồn cập nhật
+    CONSTRAINT fk_gold_type
+        FOREIGN KEY (gold_type_id)
+        REFERENCES GoldTypes (id)
+        ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_goldtypes_provider ON GoldTypes (provider);
+CREATE INDEX IF NOT EXISTS idx_goldprices_gold_type_id ON GoldPrices (gold_type_id);
+CREATE INDEX IF NOT EXISTS idx_goldprices_date_recorded ON GoldPrices (date_recorded DESC);
+CREATE INDEX IF NOT EXISTS idx_goldprices_source_update_time ON GoldPrices (source_update_time DESC);
+
+-- Giá vàng mới nhất của mỗi loại vàng (một dòng/loại), được upsert cùng transaction với GoldPrices.
+CREATE TABLE IF NOT EXISTS LatestGoldPrices (
+    gold_type_id INTEGER PRIMARY KEY REFERENCES GoldTypes (id) ON DELETE CASCADE,
+    gold_price_id INTEGER NOT NULL,
+    buy_price NUMERIC(18, 4),
+    sell_price NUMERIC(18, 4),
+    unit VARCHAR(20) NOT NULL,
+    date_recorded TIMESTAMP WITH TIME ZONE NOT NULL,
+    source_update_time TIMESTAMP WITH TIME ZONE
+);
+
+-- Nến OHLC của giá bán vàng (sell_price) theo khung '1m', '1h', '1d'.
+CREATE TABLE IF NOT EXISTS GoldPriceCandles (
+    gold_type_id INTEGER NOT NULL REFERENCES GoldTypes (id) ON DELETE CASCADE,
+    resolution VARCHAR(4) NOT NULL,
+    bucket_start TIMESTAMP WITH TIME ZONE NOT NULL,
+    open NUMERIC(18, 4) NOT NULL,
+    high NUMERIC(18, 4) NOT NULL,
+    low NUMERIC(18, 4) NOT NULL,
+    close NUMERIC(18, 4) NOT NULL,
+    tick_count INTEGER NOT NULL,
+    open_time TIMESTAMP WITH TIME ZONE NOT NULL,
+    close_time TIMESTAMP WITH TIME ZONE NOT NULL,
+    PRIMARY KEY (gold_type_id, resolution, bucket_start)
+);
+
+-- Mốc seq đã ghi vào CSDL của từng spool cục bộ (xem src/spool.py), cập nhật cùng transaction với dữ liệu
+CREATE TABLE IF NOT EXISTS SpoolCheckpoints (
+    spool_id VARCHAR(64) PRIMARY KEY,
+    last_seq BIGINT NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Các dòng giá bị đánh dấu bất thường (xem src/anomaly.py), để xem lại và nạp lại thủ công nếu cần
+CREATE TABLE IF NOT EXISTS QuarantinedQuotes (
+    id BIGSERIAL PRIMARY KEY,
+    source VARCHAR(50) NOT NULL,
+    kind VARCHAR(20) NOT NULL,
+    instrument VARCHAR(255) NOT NULL,
+    action VARCHAR(12) NOT NULL, -- 'quarantined' (không ghi vào lịch sử) hoặc 'flagged' (vẫn ghi)
+    reasons TEXT NOT NULL,
+    row_data JSONB NOT NULL,
+    source_update_time TIMESTAMP WITH TIME ZONE,
+    detected_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_quarantinedquotes_detected_at ON QuarantinedQuotes (detected_at DESC);
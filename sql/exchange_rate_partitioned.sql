@@ -0,0 +1,57 @@
+-- Phiên bản phân vùng (partition) theo tháng của các bảng lịch sử ExchangeRates và GoldPrices.
+-- Dùng thay cho phần tương ứng trong exchange_rate.sql khi tạo database MỚI
+-- (tương đương kết quả "python src/main.py migrate" với PG_PARTITIONING=monthly; cách khuyến nghị là chạy migrate).
+-- Partition cho từng tháng được ứng dụng tạo tự động (database.ensure_partitions(), lệnh
+-- "python main.py maintenance" hoặc job bảo trì của daemon); ví dụ tạo thủ công ở cuối file.
+-- Truy vấn có điều kiện trên date_recorded chỉ quét các partition liên quan (partition pruning),
+-- và dữ liệu cũ được loại bỏ bằng DETACH/DROP partition thay vì DELETE từng dòng.
+
+CREATE TABLE IF NOT EXISTS ExchangeRates (
+    id SERIAL,
+    currency_id INTEGER NOT NULL,
+    date_recorded TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    buy_cash NUMERIC(18, 4),
+    buy_transfer NUMERIC(18, 4),
+    sell NUMERIC(18, 4) NOT NULL,
+    source_update_time TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (id, date_recorded), -- Khóa chính của bảng phân vùng phải chứa cột phân vùng
+    CONSTRAINT fk_currency
+        FOREIGN KEY (currency_id)
+        REFERENCES Currencies (id)
+        ON DELETE CASCADE
+) PARTITION BY RANGE (date_recorded);
+
+-- Index tạo trên bảng cha được tự động tạo cho mọi partition
+CREATE INDEX IF NOT EXISTS idx_exchangerates_currency_source_time
+    ON ExchangeRates (currency_id, source_update_time DESC, date_recorded DESC);
+CREATE INDEX IF NOT EXISTS idx_exchangerates_date_recorded ON ExchangeRates (date_recorded DESC);
+CREATE INDEX IF NOT EXISTS idx_exchangerates_source_update_time ON ExchangeRates (source_update_time DESC);
+
+CREATE TABLE IF NOT EXISTS GoldPrices (
+    id SERIAL,
+    gold_type_id INTEGER NOT NULL,
+    date_recorded TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    buy_price NUMERIC(18, 4),
+    sell_price NUMERIC(18, 4),
+    unit VARCHAR(20) NOT NULL,
+    source_update_time TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (id, date_recorded),
+    CONSTRAINT fk_gold_type
+        FOREIGN KEY (gold_type_id)
+        REFERENCES GoldTypes (id)
+        ON DELETE CASCADE
+) PARTITION BY RANGE (date_recorded);
+
+CREATE INDEX IF NOT EXISTS idx_goldprices_gold_type_id ON GoldPrices (gold_type_id);
+CREATE INDEX IF NOT EXISTS idx_goldprices_date_recorded ON GoldPrices (date_recorded DESC);
+CREATE INDEX IF NOT EXISTS idx_goldprices_source_update_time ON GoldPrices (source_update_time DESC);
+
+-- Ví dụ partition cho một tháng (ranh giới tháng theo giờ Việt Nam, +07:00):
+-- CREATE TABLE IF NOT EXISTS exchangerates_p2025_06 PARTITION OF ExchangeRates
+--     FOR VALUES FROM ('2025-06-01 00:00:00+07') TO ('2025-07-01 00:00:00+07');
+-- CREATE TABLE IF NOT EXISTS goldprices_p2025_06 PARTITION OF GoldPrices
+--     FOR VALUES FROM ('2025-06-01 00:00:00+07') TO ('2025-07-01 00:00:00+07');
+--
+-- Loại bỏ dữ liệu cũ:
+-- ALTER TABLE ExchangeRates DETACH PARTITION exchangerates_p2024_01; -- giữ lại bảng để lưu trữ
+-- DROP TABLE exchangerates_p2024_01;                                  -- xóa hẳn
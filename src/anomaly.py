@@ -0,0 +1,295 @@
+# src/anomaly.py
+"""
+Phát hiện giá bất thường (giá 0/âm, lỗi phân tích, nhảy gấp nhiều lần) trước khi snapshot được ghi.
+
+Mỗi chuỗi giá (một trường buy/sell của một ngoại tệ hoặc loại vàng, theo từng nguồn) có một RunningStats với chi phí
+O(1) mỗi tick, không quét lại lịch sử:
+  - trung bình/phương sai có trọng số mũ của log-return giữa hai lần đổi giá liên tiếp (cập nhật kiểu Welford);
+  - min/max trượt của ANOMALY_WINDOW lần đổi giá gần nhất (deque đơn điệu).
+Một dòng là bất thường nếu: có giá <= 0, giá mua lớn hơn giá bán, giá ra ngoài [min, max] gần đây quá
+ANOMALY_RANGE_TOLERANCE, hoặc mức thay đổi lớn hơn ANOMALY_MIN_MOVE và có z-score vượt ANOMALY_Z_THRESHOLD.
+Dòng bất thường không cập nhật trạng thái; nếu cùng một mức giá "bất thường" xuất hiện ở
+ANOMALY_CONFIRM_TICKS lần cập nhật khác nhau của nguồn, nó được chấp nhận là mức giá mới.
+Poll lại cùng một lần cập nhật của nguồn (cùng source_update_time) vẫn loại/đánh dấu dòng bất thường,
+nhưng chỉ báo (log, metric, QuarantinedQuotes) ở lần đầu.
+
+Trạng thái được khởi tạo một lần từ lịch sử trong CSDL (database.get_recent_quotes) lúc khởi động
+(ensure_seeded); nếu khi đó CSDL chưa truy cập được, validate() thử lại tối đa mỗi SEED_RETRY_INTERVAL giây.
+"""
+import dataclasses
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+import psycopg2
+
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+ANOMALY_MODES = ('quarantine', 'flag', 'off')
+KIND_EXCHANGE_RATES = database.SNAPSHOT_KIND_EXCHANGE_RATES
+KIND_GOLD_PRICES = database.SNAPSHOT_KIND_GOLD_PRICES
+# Trường giá của từng loại snapshot, và các cặp (giá mua, giá bán) phải thỏa mua <= bán
+PRICE_FIELDS = {
+    KIND_EXCHANGE_RATES: ('buy_cash', 'buy_transfer', 'sell'),
+    KIND_GOLD_PRICES: ('buy', 'sell'),
+}
+BID_ASK_PAIRS = {
+    KIND_EXCHANGE_RATES: (('buy_cash', 'sell'), ('buy_transfer', 'sell')),
+    KIND_GOLD_PRICES: (('buy', 'sell'),),
+}
+SEED_RETRY_INTERVAL = 60 # Giây giữa hai lần thử khởi tạo từ lịch sử khi CSDL chưa truy cập được
+# ExchangeRates không lưu nguồn; lịch sử tỷ giá hiện có đều từ Vietcombank, nên được nạp làm chuỗi của nguồn này
+HISTORY_RATE_SOURCE = 'VCB'
+
+
+class RunningStats:
+    """Trạng thái của một chuỗi giá; mọi thao tác O(1) (khấu hao)."""
+    __slots__ = ('window', 'alpha', 'count', 'mean', 'var', 'last', '_seq', '_mins', '_maxs',
+                 'candidate', 'candidate_count', 'candidate_time')
+
+    def __init__(self, window, alpha):
+        self.window = window
+        self.alpha = alpha
+        self.count = 0    # Số log-return đã quan sát
+        self.mean = 0.0   # Trung bình/phương sai có trọng số mũ của log-return
+        self.var = 0.0
+        self.last = None  # Giá được chấp nhận gần nhất
+        self._seq = 0
+        self._mins = deque() # (seq, giá) tăng dần: phần tử đầu là min của cửa sổ
+        self._maxs = deque() # (seq, giá) giảm dần: phần tử đầu là max của cửa sổ
+        self.candidate = None # Mức giá "bất thường" đang chờ xác nhận là mức mới
+        self.candidate_count = 0
+        self.candidate_time = None
+
+    def observe(self, value):
+        """Chấp nhận `value` (đã qua kiểm tra) và cập nhật trạng thái."""
+        self.candidate, self.candidate_count, self.candidate_time = None, 0, None
+        if value == self.last:
+            return
+        if self.last is not None:
+            change = math.log(value / self.last)
+            self.count += 1
+            # Trọng số đều (Welford) cho đến khi đủ 1/alpha mẫu, sau đó trọng số mũ
+            alpha = max(self.alpha, 1.0 / self.count)
+            diff = change - self.mean
+            increment = alpha * diff
+            self.mean += increment
+            self.var = (1 - alpha) * (self.var + diff * increment)
+        self.last = value
+        self._seq += 1
+        while self._mins and self._mins[-1][1] >= value:
+            self._mins.pop()
+        self._mins.append((self._seq, value))
+        while self._maxs and self._maxs[-1][1] <= value:
+            self._maxs.pop()
+        self._maxs.append((self._seq, value))
+        expired = self._seq - self.window
+        if self._mins[0][0] <= expired:
+            self._mins.popleft()
+        if self._maxs[0][0] <= expired:
+            self._maxs.popleft()
+
+    def check(self, value):
+        """Lý do `value` bất thường so với trạng thái hiện tại ('out_of_range', 'z_score'), hoặc None."""
+        if self.last is None or value == self.last:
+            return None
+        low, high = self._mins[0][1], self._maxs[0][1]
+        tolerance = config.ANOMALY_RANGE_TOLERANCE
+        if value > high * (1 + tolerance) or value < low * (1 - tolerance):
+            return 'out_of_range'
+        change = math.log(value / self.last)
+        if self.count >= config.ANOMALY_MIN_SAMPLES and abs(change) >= config.ANOMALY_MIN_MOVE:
+            deviation = math.sqrt(self.var)
+            if deviation == 0 or abs(change - self.mean) / deviation > config.ANOMALY_Z_THRESHOLD:
+                return 'z_score'
+        return None
+
+    def confirm_candidate(self, value, update_time):
+        """
+        Ghi nhận `value` bất thường; True nếu mức giá này đã lặp lại ở đủ ANOMALY_CONFIRM_TICKS lần
+        cập nhật khác nhau của nguồn (poll lại cùng một lần cập nhật không được tính thêm).
+        """
+        if self.candidate is not None and abs(value / self.candidate - 1) <= config.ANOMALY_MIN_MOVE:
+            if update_time is None or update_time != self.candidate_time:
+                self.candidate_count += 1
+        else:
+            self.candidate, self.candidate_count = value, 1
+        self.candidate_time = update_time
+        return self.candidate_count >= config.ANOMALY_CONFIRM_TICKS
+
+    def is_reported(self, value, update_time):
+        """True nếu `value` chính là mức giá chờ xác nhận đã được báo ở cùng lần cập nhật `update_time` của nguồn."""
+        return (update_time is not None and self.candidate is not None and update_time == self.candidate_time
+                and abs(value / self.candidate - 1) <= config.ANOMALY_MIN_MOVE)
+
+    def reset_level(self, value):
+        """Chấp nhận `value` là mức giá mới: bỏ min/max cũ, giữ phân phối của mức thay đổi."""
+        self._mins.clear()
+        self._maxs.clear()
+        self.last = None
+        self.observe(value)
+
+
+def _instrument(source, kind, row):
+    # Mỗi nguồn một chuỗi giá riêng: cùng mã ngoại tệ ở hai ngân hàng có mức giá khác nhau
+    return f"{source}:{row['code'] if kind == KIND_EXCHANGE_RATES else row['type_name']}"
+
+
+def _positive_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) and value > 0 else None
+
+
+class QuoteValidator:
+    """Kiểm tra các dòng của snapshot trước khi ghi; an toàn khi gọi từ nhiều thread."""
+
+    def __init__(self, mode=None):
+        self.mode = mode or config.ANOMALY_MODE
+        if self.mode not in ANOMALY_MODES:
+            raise ValueError(f"ANOMALY_MODE='{self.mode}' không hợp lệ (cho phép: {', '.join(ANOMALY_MODES)}).")
+        self._alpha = 1 - 0.5 ** (1 / max(1.0, config.ANOMALY_HALF_LIFE))
+        self._stats = {} # (kind, instrument, field) -> RunningStats
+        self._lock = threading.Lock()
+        self._seed_lock = threading.Lock() # Chỉ một thread khởi tạo từ lịch sử; các thread khác chờ kết quả
+        self._seeded = False
+        self._seed_attempted_at = None
+        # (kind, instrument) -> (source_update_time, lý do) của lỗi không theo RunningStats (giá <= 0, mua > bán) đã báo
+        self._reported = {}
+
+    def _new_stats(self):
+        return RunningStats(config.ANOMALY_WINDOW, self._alpha)
+
+    def seed_from_history(self):
+        """Khởi tạo trạng thái từ ANOMALY_WINDOW dòng gần nhất của mỗi chuỗi giá (chỉ các chuỗi chưa có trạng thái)."""
+        rates, gold = database.get_recent_quotes(config.ANOMALY_WINDOW)
+        seeded = {}
+        for rows, kind, columns in (
+            (rates, KIND_EXCHANGE_RATES, {'buy_cash': 'buy_cash', 'buy_transfer': 'buy_transfer', 'sell': 'sell'}),
+            (gold, KIND_GOLD_PRICES, {'buy': 'buy_price', 'sell': 'sell_price'}),
+        ):
+            for row in rows:
+                if kind == KIND_EXCHANGE_RATES:
+                    instrument = f"{HISTORY_RATE_SOURCE}:{row['currency_code']}"
+                else:
+                    instrument = f"{row['provider']}:{row['gold_type_name']}"
+                for field, column in columns.items():
+                    value = _positive_float(row[column])
+                    if value is not None:
+                        key = (kind, instrument, field)
+                        if key not in seeded:
+                            seeded[key] = self._new_stats()
+                        seeded[key].observe(value)
+        with self._lock:
+            for key, stats in seeded.items():
+                self._stats.setdefault(key, stats)
+            self._seeded = True
+        logger.info(f"Đã khởi tạo trạng thái phát hiện bất thường cho {len(seeded)} chuỗi giá từ lịch sử.",
+                    extra={'series': len(seeded)})
+
+    def ensure_seeded(self):
+        """
+        Khởi tạo từ lịch sử nếu chưa làm (gọi một lần lúc khởi động). Lỗi CSDL chỉ được ghi log;
+        lần thử lại tiếp theo (từ validate()) cách lần trước ít nhất SEED_RETRY_INTERVAL giây.
+        """
+        if self._seeded:
+            return
+        with self._seed_lock:
+            # Kiểm tra lại sau khi có khóa: thread khác có thể vừa khởi tạo xong (hoặc vừa thử và lỗi)
+            now = time.monotonic()
+            if self._seeded or (self._seed_attempted_at is not None and now - self._seed_attempted_at < SEED_RETRY_INTERVAL):
+                return
+            self._seed_attempted_at = now
+            try:
+                self.seed_from_history()
+            except psycopg2.Error as e:
+                logger.warning(f"Chưa khởi tạo được trạng thái phát hiện bất thường từ lịch sử ({e}); chỉ dùng dữ liệu mới.")
+
+    def _check_row(self, kind, instrument, row, update_time):
+        """
+        (lý do bất thường, các trường giá hợp lệ, True nếu mọi lý do đã được báo ở cùng lần cập nhật này của nguồn).
+        Không thay đổi trạng thái ngoài việc theo dõi mức giá chờ xác nhận và các lỗi đã báo.
+        """
+        reasons, values = [], {}
+        for field in PRICE_FIELDS[kind]:
+            if row.get(field) is None:
+                continue
+            value = _positive_float(row[field])
+            if value is None:
+                reasons.append(f"{field}:non_positive")
+                continue
+            values[field] = value
+        for bid, ask in BID_ASK_PAIRS[kind]:
+            if bid in values and ask in values and values[bid] > values[ask]:
+                reasons.append(f"{bid}>{ask}")
+        static_reasons = tuple(reasons)
+        if static_reasons:
+            reported = update_time is not None and self._reported.get((kind, instrument)) == (update_time, static_reasons)
+            self._reported[(kind, instrument)] = (update_time, static_reasons)
+        else:
+            reported = True
+            self._reported.pop((kind, instrument), None)
+        for field, value in values.items():
+            stats = self._stats.get((kind, instrument, field))
+            reason = stats.check(value) if stats is not None else None
+            if reason is None:
+                continue
+            reported = reported and stats.is_reported(value, update_time)
+            if stats.confirm_candidate(value, update_time):
+                logger.warning(f"Chấp nhận mức giá mới của {instrument} {field}: {value:g} (trước đó {stats.last:g})",
+                               extra={'instrument': instrument, 'field': field})
+                stats.reset_level(value)
+                continue
+            reasons.append(f"{field}:{reason}")
+        return reasons, values, reported
+
+    def validate(self, snapshot):
+        """
+        Kiểm tra một services.sources.Snapshot. Trả về (snapshot cần ghi, danh sách dòng bất thường):
+        ở mode 'quarantine' snapshot trả về không còn các dòng bất thường (None nếu không còn dòng nào);
+        mỗi dòng bất thường là dict theo dạng database.insert_quarantined_quotes nhận.
+        """
+        if self.mode == 'off':
+            return snapshot, []
+        self.ensure_seeded() # Chỉ truy vấn CSDL khi việc khởi tạo lúc khởi động đã thất bại
+        action = 'quarantined' if self.mode == 'quarantine' else 'flagged'
+        kept, anomalies = [], []
+        with self._lock:
+            for quote in snapshot.quotes:
+                row = quote.as_row()
+                instrument = _instrument(snapshot.source, snapshot.kind, row)
+                reasons, values, reported = self._check_row(snapshot.kind, instrument, row, snapshot.source_update_time)
+                if reasons:
+                    if not reported:
+                        anomalies.append({
+                            'source': snapshot.source, 'kind': snapshot.kind, 'instrument': instrument, 'action': action,
+                            'reasons': reasons, 'row': row, 'source_update_time': snapshot.source_update_time,
+                        })
+                    if self.mode == 'flag':
+                        kept.append(quote)
+                    continue
+                for field, value in values.items():
+                    key = (snapshot.kind, instrument, field)
+                    if key not in self._stats:
+                        self._stats[key] = self._new_stats()
+                    self._stats[key].observe(value)
+                kept.append(quote)
+        for anomaly in anomalies:
+            logger.warning(f"Giá bất thường từ {snapshot.source}: {anomaly['instrument']} ({', '.join(anomaly['reasons'])}), {action}",
+                           extra={'source': snapshot.source, 'instrument': anomaly['instrument'], 'action': action})
+        if len(kept) == len(snapshot.quotes):
+            return snapshot, anomalies
+        return (dataclasses.replace(snapshot, quotes=tuple(kept)) if kept else None), anomalies
+
+
+def from_config():
+    """QuoteValidator theo ANOMALY_MODE, hoặc None khi tắt ('off')."""
+    validator = QuoteValidator()
+    return None if validator.mode == 'off' else validator
@@ -0,0 +1,295 @@
+# src/api.py
+import gzip
+import hashlib
+import json
+import logging
+import threading
+from datetime import date, datetime
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import psycopg2
+
+import config
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _json_default(value):
+    """Chuyển các kiểu psycopg2 trả về (Decimal, datetime) sang kiểu JSON."""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Không chuyển được {type(value).__name__} sang JSON")
+
+
+class Payload:
+    """
+    Một response JSON đã được chuẩn bị sẵn: body, ETag và bản nén gzip (nếu body đủ lớn).
+    Việc serialize/nén/băm chỉ làm một lần, rồi dùng lại cho mọi client.
+    """
+    __slots__ = ('body', 'gzipped', 'etag')
+
+    def __init__(self, data):
+        self.body = json.dumps(data, ensure_ascii=False, default=_json_default).encode('utf-8')
+        # ETag yếu: cùng một giá trị cho bản gốc và bản gzip của cùng nội dung
+        self.etag = f'W/"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+        self.gzipped = None
+        if len(self.body) >= config.API_GZIP_MIN_BYTES:
+            self.gzipped = gzip.compress(self.body, compresslevel=6, mtime=0)
+
+
+class QuoteCache:
+    """
+    Bộ nhớ đệm trong tiến trình cho tỷ giá và giá vàng mới nhất.
+    Được làm mới sau mỗi lần ghi dữ liệu (daemon --api) hoặc theo chu kỳ (serve),
+    nên số truy vấn CSDL không phụ thuộc vào số client đang poll API.
+    """
+
+    def __init__(self):
+        self._refresh_lock = threading.RLock() # Chỉ một lần làm mới chạy tại một thời điểm
+        self._payloads = {} # 'rates' | 'gold' | 'rates/<CODE>' -> Payload
+        self._loaded = False
+
+    def refresh(self):
+        """Đọc lại hai bảng Latest* (hai truy vấn nhỏ) và dựng lại các payload."""
+        with self._refresh_lock:
+            rates = database.get_latest_rates()
+            gold_prices = database.get_latest_gold_prices()
+            refreshed_at = datetime.now().astimezone()
+            previous = self._payloads
+            payloads = {}
+            # get_latest_* trả về [] khi lỗi CSDL: giữ dữ liệu cũ thay vì trả danh sách rỗng cho client
+            if rates or 'rates' not in previous:
+                payloads['rates'] = Payload({'refreshed_at': refreshed_at, 'rates': rates})
+                for rate in rates:
+                    payloads[f"rates/{rate['currency_code']}"] = Payload({'refreshed_at': refreshed_at, 'rate': rate})
+            else:
+                payloads.update({key: payload for key, payload in previous.items() if key.startswith('rates')})
+            if gold_prices or 'gold' not in previous:
+                payloads['gold'] = Payload({'refreshed_at': refreshed_at, 'gold_prices': gold_prices})
+            else:
+                payloads['gold'] = previous['gold']
+            self._payloads = payloads # Thay cả dict một lần: các thread đọc không cần khóa
+            self._loaded = True
+
+    def get(self, key):
+        """Trả về Payload đã dựng sẵn, hoặc None nếu không có (ví dụ mã ngoại tệ không tồn tại)."""
+        if not self._loaded:
+            with self._refresh_lock:
+                if not self._loaded:
+                    self.refresh()
+        return self._payloads.get(key)
+
+
+def _parse_time(query, name):
+    value = query.get(name, [None])[0]
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Tham số '{name}' phải theo định dạng ISO 8601, ví dụ 2025-01-31 hoặc 2025-01-31T08:00:00+07:00.")
+
+
+def _parse_limit(query):
+    value = query.get('limit', [None])[0]
+    if not value:
+        return config.API_HISTORY_LIMIT
+    if not value.isdigit() or int(value) == 0:
+        raise ValueError("Tham số 'limit' phải là số nguyên dương.")
+    return min(int(value), config.API_HISTORY_MAX_LIMIT)
+
+
+def _accepts_gzip(accept_encoding):
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        if coding.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # So sánh yếu (RFC 9110): bỏ tiền tố W/ ở cả hai phía
+    opaque = etag.removeprefix('W/')
+    return any(tag.strip().removeprefix('W/') == opaque for tag in if_none_match.split(','))
+
+
+def _parse_content_length(value):
+    """Số byte body theo header Content-Length (0 nếu không có); ValueError nếu không phải số nguyên không âm."""
+    if value is None or not value.strip():
+        return 0
+    value = value.strip()
+    if not value.isdigit():
+        raise ValueError("Header 'Content-Length' phải là số nguyên không âm.")
+    return int(value)
+
+
+def _parse_as_of_queries(body):
+    """[(code, datetime)] từ body JSON {"queries": [{"code": "USD", "at": "2025-05-08T10:00:00+07:00"}, ...]}."""
+    usage = 'Body phải là JSON {"queries": [{"code": "USD", "at": "<thời điểm ISO 8601>"}, ...]}.'
+    try:
+        data = json.loads(body)
+    except ValueError: # Gồm cả UnicodeDecodeError khi body không phải UTF-8
+        raise ValueError(usage)
+    queries = data.get('queries') if isinstance(data, dict) else None
+    if not isinstance(queries, list):
+        raise ValueError(usage)
+    if len(queries) > config.API_AS_OF_MAX_QUERIES:
+        raise ValueError(f"Tối đa {config.API_AS_OF_MAX_QUERIES} cặp (code, at) mỗi request.")
+    pairs = []
+    for index, item in enumerate(queries):
+        if not isinstance(item, dict) or not isinstance(item.get('code'), str) or not isinstance(item.get('at'), str):
+            raise ValueError(f"queries[{index}] phải là object có 'code' và 'at' kiểu chuỗi. {usage}")
+        try:
+            at = datetime.fromisoformat(item['at'])
+        except ValueError:
+            raise ValueError(f"queries[{index}].at phải theo định dạng ISO 8601, ví dụ 2025-05-08T10:00:00+07:00.")
+        pairs.append((item['code'], at))
+    return pairs
+
+
+class QuoteRequestHandler(BaseHTTPRequestHandler):
+    """
+    API chỉ đọc:
+      GET /rates                  tỷ giá mới nhất của mọi ngoại tệ (từ cache)
+      GET /rates/<CODE>           tỷ giá mới nhất của một ngoại tệ (từ cache)
+      GET /gold                   giá vàng mới nhất (từ cache)
+      GET /history/rates/<CODE>   lịch sử tỷ giá, tham số ?start=&end=&limit=
+      GET /history/gold/<tên>     lịch sử giá vàng, tham số ?start=&end=&limit=&provider=
+      POST /rates/as-of           tỷ giá có hiệu lực tại từng thời điểm, body {"queries": [{"code":, "at":}, ...]}
+      GET /health
+      GET /metrics                metric định dạng Prometheus (không có ETag)
+    Mọi response có ETag; client gửi lại If-None-Match sẽ nhận 304 không có body.
+    """
+    server_version = "ExchangeRateAPI/1.0"
+    protocol_version = "HTTP/1.1" # Giữ kết nối keep-alive cho client poll liên tục
+    cache = None # QuoteCache, được gán bởi make_server()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [unquote(part) for part in url.path.split('/') if part]
+        query = parse_qs(url.query)
+        if parts == ['metrics']:
+            self._send_metrics()
+            return
+        try:
+            payload = self._route(parts, query)
+        except ValueError as e:
+            self._send_payload(Payload({'error': str(e)}), status=400)
+            return
+        if payload is None:
+            self._send_payload(Payload({'error': f"Không tìm thấy: {url.path}"}), status=404)
+            return
+        self._send_payload(payload)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != '/rates/as-of':
+            self._send_payload(Payload({'error': f"Không tìm thấy: {url.path}"}), status=404)
+            return
+        try:
+            length = _parse_content_length(self.headers.get('Content-Length'))
+        except ValueError as e:
+            self.close_connection = True # Không biết body dài bao nhiêu, nên không dùng lại kết nối được
+            self._send_payload(Payload({'error': str(e)}), status=400)
+            return
+        if length > config.API_AS_OF_MAX_BODY_BYTES:
+            self.close_connection = True # Không đọc body quá lớn, nên không dùng lại kết nối được
+            self._send_payload(Payload({'error': "Body quá lớn."}), status=413)
+            return
+        try:
+            pairs = _parse_as_of_queries(self.rfile.read(length))
+            rates = database.get_exchange_rates_as_of(pairs)
+        except ValueError as e:
+            self._send_payload(Payload({'error': str(e)}), status=400)
+            return
+        except psycopg2.Error as e:
+            logger.error(f"Lỗi khi tra cứu tỷ giá tại thời điểm: {e}")
+            self._send_payload(Payload({'error': "CSDL tạm thời không truy cập được."}), status=503)
+            return
+        self._send_payload(Payload({'rates': rates}))
+
+    def _route(self, parts, query):
+        if parts in ([], ['health']):
+            return Payload({'status': 'ok'})
+        if parts == ['rates']:
+            return self.cache.get('rates')
+        if len(parts) == 2 and parts[0] == 'rates':
+            return self.cache.get(f"rates/{parts[1].upper()}")
+        if parts == ['gold']:
+            return self.cache.get('gold')
+        if len(parts) == 3 and parts[:2] == ['history', 'rates']:
+            code = parts[2].upper()
+            history = database.get_exchange_rate_history(
+                code, _parse_time(query, 'start'), _parse_time(query, 'end'), _parse_limit(query)
+            )
+            return Payload({'currency_code': code, 'history': history})
+        if len(parts) == 3 and parts[:2] == ['history', 'gold']:
+            provider = query.get('provider', ['SJC'])[0]
+            history = database.get_gold_price_history(
+                parts[2], _parse_time(query, 'start'), _parse_time(query, 'end'), _parse_limit(query), provider
+            )
+            return Payload({'gold_type_name': parts[2], 'provider': provider, 'history': history})
+        return None
+
+    def _send_payload(self, payload, status=200):
+        if status == 200 and _etag_matches(self.headers.get('If-None-Match'), payload.etag):
+            self.send_response(304)
+            self.send_header('ETag', payload.etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            return
+
+        body = payload.body
+        use_gzip = payload.gzipped is not None and _accepts_gzip(self.headers.get('Accept-Encoding'))
+        if use_gzip:
+            body = payload.gzipped
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', payload.etag)
+        self.send_header('Cache-Control', 'no-cache') # Client luôn hỏi lại bằng If-None-Match
+        self.send_header('Vary', 'Accept-Encoding')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_metrics(self):
+        body, content_type = metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if config.API_ACCESS_LOG:
+            logger.info(format % args, extra={'client': self.address_string()})
+
+
+def make_server(cache, host=None, port=None):
+    """Tạo HTTP server (mỗi request một thread) phục vụ dữ liệu từ `cache`."""
+    handler = type('BoundQuoteRequestHandler', (QuoteRequestHandler,), {'cache': cache})
+    server = ThreadingHTTPServer((host or config.API_HOST, config.API_PORT if port is None else port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_background(server):
+    """Chạy server trong một thread nền; dừng bằng server.shutdown()."""
+    thread = threading.Thread(target=server.serve_forever, name='quote-api', daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    logger.info(f"API tỷ giá đang lắng nghe tại http://{host}:{port}")
+    return thread
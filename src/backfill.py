@@ -0,0 +1,156 @@
+# src/backfill.py
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+from datetime import datetime, time, timedelta, timezone
+
+import config
+import database
+import services.scraper_vcb as scraper
+from services.rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+VN_TIMEZONE = timezone(timedelta(hours=7))
+
+
+def _load_checkpoint(path):
+    """Đọc tập các ngày (chuỗi YYYY-MM-DD) đã nạp xong từ file checkpoint."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return set(json.load(f).get('completed_dates', []))
+    except FileNotFoundError:
+        return set()
+    except (ValueError, OSError) as e:
+        logger.warning(f"Không đọc được checkpoint '{path}', bắt đầu lại từ đầu: {e}")
+        return set()
+
+
+def _save_checkpoint(path, completed_dates):
+    """Ghi checkpoint theo kiểu atomic (file tạm rồi đổi tên) để không hỏng file khi bị ngắt giữa chừng."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'completed_dates': sorted(completed_dates)}, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _recorded_at(day, source_update_time_str):
+    """Thời điểm ghi nhận của dữ liệu lịch sử: thời gian cập nhật của VCB, hoặc 12:00 ngày đó nếu không có."""
+    source_update_time_aware = database._parse_datetime_for_postgres(source_update_time_str)
+    if source_update_time_aware is not None:
+        return source_update_time_aware
+    return datetime.combine(day, time(12, 0), tzinfo=VN_TIMEZONE)
+
+
+class _SnapshotClaims:
+    """
+    Các thời gian cập nhật VCB đã có một worker nhận ghi trong lần chạy này. Ngày nghỉ VCB trả về cùng
+    một UpdatedDate cho nhiều ngày liền nhau; nếu không giữ chỗ trước, hai worker có thể cùng qua bước
+    kiểm tra đã tồn tại rồi cùng ghi một snapshot hai lần.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._claimed = set()
+
+    def claim(self, source_update_time_str):
+        """True nếu worker gọi là worker đầu tiên nhận ghi snapshot này."""
+        with self._lock:
+            if source_update_time_str in self._claimed:
+                return False
+            self._claimed.add(source_update_time_str)
+            return True
+
+    def release(self, source_update_time_str):
+        """Trả lại chỗ khi ghi thất bại, để ngày khác (hoặc lần chạy sau) ghi snapshot này."""
+        with self._lock:
+            self._claimed.discard(source_update_time_str)
+
+
+def _backfill_day(day, limiter, claims):
+    """
+    Lấy và ghi tỷ giá của một ngày. Trả về số bản ghi đã ghi,
+    hoặc None nếu lấy dữ liệu/ghi thất bại (ngày đó sẽ được thử lại ở lần chạy sau).
+    """
+    limiter.acquire()
+    rates, source_update_time_str = scraper.fetch_exchange_rates_from_api(date=day, conditional=False)
+    if rates is None:
+        # (None, None): lỗi mạng/định dạng -> thử lại sau; (None, thời gian): ngày không có tỷ giá
+        return None if source_update_time_str is None else 0
+    claimed = source_update_time_str is not None
+    if claimed and not claims.claim(source_update_time_str):
+        return 0 # Một worker khác đang (hoặc đã) ghi snapshot này
+    if database.has_exchange_rates_at(source_update_time_str):
+        return 0 # Snapshot này đã có (lần chạy trước đã ghi)
+    inserted = database.insert_exchange_rates_batch(
+        rates,
+        source_update_time_str,
+        detect_changes=False, # Không so với snapshot "hiện tại" của nguồn
+        date_recorded=_recorded_at(day, source_update_time_str)
+    )
+    if not inserted:
+        if claimed:
+            claims.release(source_update_time_str)
+        return None
+    return inserted
+
+
+def run_backfill(start_date, end_date, workers=None, rate_limit=None, checkpoint_path=None):
+    """
+    Nạp bù tỷ giá Vietcombank cho các ngày trong [start_date, end_date]:
+    lấy song song tối đa `workers` ngày, không vượt quá `rate_limit` request/giây,
+    mỗi ngày được ghi trong một transaction với thời gian lịch sử của nó.
+    Các ngày đã xong được lưu vào checkpoint, nên chạy lại sau khi bị ngắt sẽ tiếp tục từ chỗ dừng.
+    """
+    workers = config.BACKFILL_WORKERS if workers is None else workers
+    rate_limit = config.BACKFILL_RATE_LIMIT if rate_limit is None else rate_limit
+    checkpoint_path = str(checkpoint_path or config.BACKFILL_CHECKPOINT_PATH)
+
+    completed = _load_checkpoint(checkpoint_path)
+    days = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+    pending_days = [day for day in days if day.isoformat() not in completed]
+    logger.info(f"Nạp bù tỷ giá {start_date} -> {end_date}: {len(days)} ngày, "
+                f"{len(days) - len(pending_days)} ngày đã có trong checkpoint, còn {len(pending_days)} ngày.")
+    if not pending_days:
+        return
+
+    # Dữ liệu lịch sử cần partition của các tháng tương ứng (không làm gì nếu bảng không phân vùng)
+    database.ensure_partitions(start=datetime.combine(start_date, time(), tzinfo=VN_TIMEZONE),
+                               end=datetime.combine(end_date, time(), tzinfo=VN_TIMEZONE),
+                               months_ahead=0)
+
+    limiter = RateLimiter(rate_limit, burst=workers)
+    total_rows = 0
+    failed_days = []
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backfill')
+    try:
+        claims = _SnapshotClaims()
+        futures = {executor.submit(_backfill_day, day, limiter, claims): day for day in pending_days}
+        for done_count, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            day = futures[future]
+            try:
+                inserted = future.result()
+            except Exception as e:
+                logger.exception(f"Lỗi không xác định khi nạp bù ngày {day}: {e}")
+                inserted = None
+            if inserted is None:
+                failed_days.append(day)
+                continue
+            total_rows += inserted
+            completed.add(day.isoformat())
+            _save_checkpoint(checkpoint_path, completed)
+            logger.info(f"[{done_count}/{len(pending_days)}] {day}: ghi {inserted} bản ghi.",
+                        extra={'day': day.isoformat(), 'rows': inserted})
+    except KeyboardInterrupt:
+        logger.info("Đã dừng nạp bù theo yêu cầu; chạy lại cùng lệnh để tiếp tục từ checkpoint.")
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+
+    logger.info(f"Hoàn tất nạp bù: {total_rows} bản ghi mới.")
+    if failed_days:
+        logger.warning(f"{len(failed_days)} ngày thất bại (sẽ được thử lại ở lần chạy sau): "
+                       f"{', '.join(d.isoformat() for d in sorted(failed_days))}")
@@ -1,6 +1,9 @@
 # src/config.py
 
+import logging
 import os
+import socket
+from pathlib import Path
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,6 +15,98 @@ DB_USER = os.getenv("PG_USER", "postgres") # Giá trị mặc định an toàn h
 DB_PASSWORD = os.getenv("PG_PASSWORD") # Không nên có giá trị mặc định cho password
 DB_PORT = os.getenv("PG_PORT", "5432")
 
+# --- Đường dẫn thư mục dữ liệu (theo cấu trúc Cookiecutter Data Science) ---
+PROJ_ROOT = Path(__file__).resolve().parents[1]
+DATA_DIR = PROJ_ROOT / "data"
+RAW_DATA_DIR = DATA_DIR / "raw"
+INTERIM_DATA_DIR = DATA_DIR / "interim"
+PROCESSED_DATA_DIR = DATA_DIR / "processed"
+EXTERNAL_DATA_DIR = DATA_DIR / "external"
+
+# --- Cấu hình thu thập dữ liệu ---
+# Deadline (giây) cho mỗi nguồn trong một lần cập nhật; các nguồn được lấy song song
+VCB_FETCH_DEADLINE = float(os.getenv("VCB_FETCH_DEADLINE", "30"))
+SJC_FETCH_DEADLINE = float(os.getenv("SJC_FETCH_DEADLINE", "25"))
+# Số lần lấy dữ liệu tối đa mỗi giây của từng nguồn (0 = không giới hạn), chặn việc gọi dồn dập khi chạy lặp lại
+VCB_RATE_LIMIT = float(os.getenv("VCB_RATE_LIMIT", "0"))
+SJC_RATE_LIMIT = float(os.getenv("SJC_RATE_LIMIT", "0"))
+# Chi nhánh SJC cần lấy giá: danh sách BranchId cách nhau dấu phẩy (vd "1,2,5"), hoặc "all" để dò
+# mọi BranchId từ 1 đến SJC_MAX_BRANCH_ID; danh sách dò được dùng lại trong SJC_BRANCH_REFRESH_INTERVAL giây.
+SJC_BRANCHES = os.getenv("SJC_BRANCHES", "1")
+SJC_MAX_BRANCH_ID = int(os.getenv("SJC_MAX_BRANCH_ID", "20"))
+SJC_BRANCH_REFRESH_INTERVAL = float(os.getenv("SJC_BRANCH_REFRESH_INTERVAL", str(24 * 3600)))
+
+# --- Cấu hình chế độ thường trú (python main.py daemon) ---
+# Chu kỳ poll (giây) của từng nguồn và độ lệch ngẫu nhiên ±POLL_JITTER giây để tránh poll đồng loạt
+VCB_POLL_INTERVAL = float(os.getenv("VCB_POLL_INTERVAL", "60"))
+SJC_POLL_INTERVAL = float(os.getenv("SJC_POLL_INTERVAL", "60"))
+POLL_JITTER = float(os.getenv("POLL_JITTER", "2"))
+# Chu kỳ (giây) cập nhật bảng nến OHLC từ các tick mới
+ROLLUP_INTERVAL = float(os.getenv("ROLLUP_INTERVAL", "60"))
+
+# --- Cấu hình nạp bù lịch sử tỷ giá (python main.py backfill) ---
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "4"))           # Số ngày được lấy song song
+BACKFILL_RATE_LIMIT = float(os.getenv("BACKFILL_RATE_LIMIT", "2"))   # Số request tối đa mỗi giây tới Vietcombank
+BACKFILL_CHECKPOINT_PATH = INTERIM_DATA_DIR / "backfill_vcb_checkpoint.json"
+
+# --- Cấu hình API đọc tỷ giá (python main.py serve, hoặc daemon --api) ---
+API_HOST = os.getenv("API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("API_PORT", "8080"))
+API_REFRESH_INTERVAL = float(os.getenv("API_REFRESH_INTERVAL", "30"))   # Chu kỳ làm mới cache khi chạy serve (không tự ghi dữ liệu)
+API_GZIP_MIN_BYTES = int(os.getenv("API_GZIP_MIN_BYTES", "1024"))       # Chỉ nén gzip response lớn hơn ngưỡng này
+API_HISTORY_LIMIT = int(os.getenv("API_HISTORY_LIMIT", "1000"))         # Số dòng lịch sử mặc định mỗi request
+API_HISTORY_MAX_LIMIT = int(os.getenv("API_HISTORY_MAX_LIMIT", "10000"))
+API_ACCESS_LOG = os.getenv("API_ACCESS_LOG", "False").lower() in ('true', '1', 't')
+API_AS_OF_MAX_QUERIES = int(os.getenv("API_AS_OF_MAX_QUERIES", "10000"))  # Số cặp (code, at) tối đa mỗi request POST /rates/as-of
+API_AS_OF_MAX_BODY_BYTES = int(os.getenv("API_AS_OF_MAX_BODY_BYTES", str(2 * 1024 * 1024)))
+
+# --- Cấu hình quy đổi chéo ngoại tệ (conversion.py) ---
+CONVERSION_CHECK_INTERVAL = float(os.getenv("CONVERSION_CHECK_INTERVAL", "5")) # Tối đa bao lâu (giây) mới hỏi CSDL có snapshot tỷ giá mới chưa
+
+# --- Cấu hình xuất lịch sử ra file dạng cột (python main.py export) ---
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "parquet")                   # 'parquet' hoặc 'arrow' (Arrow IPC)
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "50000"))        # Số dòng đọc từ CSDL mỗi lô
+
+# --- Cấu hình phát hiện giá bất thường trước khi ghi (anomaly.py) ---
+# ANOMALY_MODE: 'quarantine' (dòng bất thường không được ghi vào lịch sử, lưu riêng vào QuarantinedQuotes),
+# 'flag' (vẫn ghi, chỉ đánh dấu vào QuarantinedQuotes và log) hoặc 'off'
+ANOMALY_MODE = os.getenv("ANOMALY_MODE", "quarantine").lower()
+ANOMALY_WINDOW = int(os.getenv("ANOMALY_WINDOW", "200"))               # Số lần đổi giá gần nhất dùng cho min/max trượt (và để khởi tạo từ lịch sử)
+ANOMALY_RANGE_TOLERANCE = float(os.getenv("ANOMALY_RANGE_TOLERANCE", "0.25")) # Giá vượt ra ngoài [min, max] gần đây quá tỷ lệ này là bất thường
+ANOMALY_Z_THRESHOLD = float(os.getenv("ANOMALY_Z_THRESHOLD", "8"))     # Ngưỡng z-score của mức thay đổi (log-return) so với lịch sử
+ANOMALY_MIN_MOVE = float(os.getenv("ANOMALY_MIN_MOVE", "0.02"))        # Thay đổi nhỏ hơn tỷ lệ này không bao giờ bị coi là bất thường theo z-score
+ANOMALY_HALF_LIFE = float(os.getenv("ANOMALY_HALF_LIFE", "500"))       # Chu kỳ bán rã (số lần đổi giá) của trung bình/phương sai
+ANOMALY_MIN_SAMPLES = int(os.getenv("ANOMALY_MIN_SAMPLES", "20"))      # Số lần đổi giá tối thiểu trước khi dùng z-score
+ANOMALY_CONFIRM_TICKS = int(os.getenv("ANOMALY_CONFIRM_TICKS", "3"))   # Cùng một mức giá "bất thường" lặp lại chừng này lần thì được chấp nhận là mức mới
+
+# --- Cấu hình spool ghi trước (write-ahead) cục bộ ---
+# Snapshot lấy được được ghi nối vào file trong SPOOL_DIR trước, rồi mới được ghi hàng loạt vào CSDL;
+# khi PostgreSQL không truy cập được, dữ liệu nằm lại trong spool và được ghi bù khi CSDL hoạt động lại.
+SPOOL_ENABLED = os.getenv("SPOOL_ENABLED", "True").lower() in ('true', '1', 't')
+SPOOL_DIR = Path(os.getenv("SPOOL_DIR", str(INTERIM_DATA_DIR / "spool")))
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))  # Kích thước tối đa một file spool
+SPOOL_FSYNC = os.getenv("SPOOL_FSYNC", "True").lower() in ('true', '1', 't')        # fsync sau mỗi snapshot
+SPOOL_REPLAY_BATCH_ROWS = int(os.getenv("SPOOL_REPLAY_BATCH_ROWS", "50000"))         # Số dòng tối đa mỗi transaction ghi bù
+SPOOL_RETRY_MAX = float(os.getenv("SPOOL_RETRY_MAX", "60"))                          # Trần thời gian chờ (giây) giữa hai lần thử khi CSDL lỗi
+
+# --- Cấu hình chạy nhiều node thu thập (collector) cùng lúc ---
+# COLLECTOR_COORDINATION=advisory: mỗi nguồn (và mỗi job nền) chỉ được một node đang sống chạy, chọn bằng
+# khóa advisory của PostgreSQL giữ trên một kết nối riêng; node chết thì khóa được nhả và node khác tiếp quản
+# ở lần poll kế tiếp. 'none' (mặc định): mọi node đều chạy mọi nguồn.
+COLLECTOR_COORDINATION = os.getenv("COLLECTOR_COORDINATION", "none").lower()
+COLLECTOR_NODE_ID = os.getenv("COLLECTOR_NODE_ID", f"{socket.gethostname()}:{os.getpid()}")
+# Node mất kết nối tới CSDL khi đang giữ khóa: True = vẫn poll (dữ liệu vào spool, snapshot trùng bị bỏ qua khi ghi bù),
+# False = ngừng poll cho đến khi giành lại được khóa
+COLLECTOR_FAIL_OPEN = os.getenv("COLLECTOR_FAIL_OPEN", "True").lower() in ('true', '1', 't')
+# TCP keepalive (giây) của kết nối giữ khóa: node bị mất mạng/treo máy được server phát hiện sau khoảng
+# COLLECTOR_KEEPALIVE + 3 * COLLECTOR_KEEPALIVE / 2 giây, khi đó khóa được nhả cho node khác
+COLLECTOR_KEEPALIVE = int(os.getenv("COLLECTOR_KEEPALIVE", "10"))
+
+# --- Cấu hình log và metric ---
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")                  # DEBUG, INFO, WARNING, ERROR
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")                # 'text' (dễ đọc) hoặc 'json' (mỗi dòng một object)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))          # Cổng /metrics riêng cho daemon không chạy API (0 = tắt)
+
 # --- Các cấu hình khác (ví dụ) ---
 # API_KEY = os.getenv("API_KEY")
 # DEBUG_MODE = os.getenv("DEBUG_MODE", "False").lower() in ('true', '1', 't')
@@ -19,7 +114,7 @@ DB_PORT = os.getenv("PG_PORT", "5432")
 
 # Kiểm tra xem password có được cung cấp không (quan trọng cho kết nối DB)
 if DB_PASSWORD is None:
-    print("CẢNH BÁO: Biến môi trường PG_PASSWORD chưa được thiết lập.")
+    logging.getLogger(__name__).warning("Biến môi trường PG_PASSWORD chưa được thiết lập.")
     # Bạn có thể quyết định dừng chương trình ở đây nếu password là bắt buộc
     # raise ValueError("PG_PASSWORD is not set in the environment variables or .env file")
 
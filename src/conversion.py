@@ -0,0 +1,157 @@
+# src/conversion.py
+"""
+Quy đổi chéo giữa các ngoại tệ (vd EUR -> JPY) từ tỷ giá Vietcombank niêm yết theo VND, theo lô bằng NumPy.
+
+Với mỗi loại tỷ giá (buy_cash, buy_transfer, sell), CrossRateMatrix giữ ma trận N×N
+    M[i, j] = rate[i] / rate[j] = số đơn vị ngoại tệ j đổi được từ 1 đơn vị ngoại tệ i
+(VND nằm trong ma trận với tỷ giá 1). Ma trận được dựng một lần cho mỗi snapshot; quy đổi một mảng
+số tiền chỉ là tra chỉ số và nhân mảng, không truy vấn CSDL.
+
+CrossRateEngine giữ ma trận của tỷ giá mới nhất và chỉ dựng lại khi có snapshot mới được ghi
+(kiểm tra bằng một truy vấn nhỏ, tối đa mỗi CONVERSION_CHECK_INTERVAL giây):
+
+    engine = CrossRateEngine()
+    jpy = engine.convert([100, 250.5], 'EUR', 'JPY', side='sell')
+    usd = engine.convert(amounts, from_codes, 'USD')           # from_codes: mảng mã, mỗi số tiền một mã
+    settled = engine.as_of('2025-05-08T10:00:00+07:00').convert(amounts, 'EUR', 'VND')
+"""
+import logging
+import threading
+import time
+
+import numpy as np
+
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+RATE_FIELDS = ('buy_cash', 'buy_transfer', 'sell')
+BASE_CURRENCY = 'VND'
+
+
+class CrossRateMatrix:
+    """Ma trận tỷ giá chéo của một snapshot (không đổi sau khi dựng; dùng chung giữa các thread)."""
+
+    def __init__(self, rates, snapshot_time=None):
+        """rates: các dict có currency_code và các trường RATE_FIELDS (tính theo VND), vd kết quả get_latest_rates()."""
+        by_code = {rate['currency_code']: rate for rate in rates}
+        by_code.pop(BASE_CURRENCY, None)
+        self.codes = np.array(sorted([*by_code, BASE_CURRENCY])) # Sắp xếp để tra mã bằng searchsorted
+        self.snapshot_time = snapshot_time
+        self.matrices = {}
+        for field in RATE_FIELDS:
+            # Tỷ giá thiếu (vd ngoại tệ không nhận tiền mặt) thành NaN, lan sang mọi ô quy đổi liên quan
+            vnd = np.array([
+                1.0 if code == BASE_CURRENCY else _to_float(by_code[code].get(field)) for code in self.codes
+            ])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self.matrices[field] = vnd[:, None] / vnd[None, :]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def index(self, codes):
+        """
+        Chỉ số trong ma trận của một mã hoặc một mảng mã; mã không có trong ma trận ném KeyError.
+        Mảng số nguyên được coi là chỉ số đã tra sẵn (dùng lại kết quả index() cho nhiều lần quy đổi).
+        """
+        codes = np.asarray(codes)
+        if np.issubdtype(codes.dtype, np.integer):
+            return codes
+        codes = codes.astype(str) # Mảng object (vd cột pandas) -> chuỗi cố định: np.unique nhanh hơn nhiều
+        if codes.ndim == 0:
+            return self._positions(np.char.upper(codes).reshape(1))[0]
+        # Mảng mã lớn chỉ có vài mã khác nhau: tra từng mã khác nhau một lần rồi trải lại theo chỉ số
+        distinct, inverse = np.unique(codes, return_inverse=True)
+        return self._positions(np.char.upper(distinct))[inverse]
+
+    def _positions(self, codes):
+        positions = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        unknown = self.codes[positions] != codes
+        if np.any(unknown):
+            raise KeyError(f"Không có tỷ giá cho: {', '.join(sorted(set(codes[unknown].tolist())))}")
+        return positions
+
+    def matrix(self, side='sell'):
+        if side not in self.matrices:
+            raise ValueError(f"side phải là một trong {RATE_FIELDS}, nhận được '{side}'.")
+        return self.matrices[side]
+
+    def rate(self, from_code, to_code, side='sell'):
+        """Số đơn vị to_code đổi được từ 1 đơn vị from_code (NaN nếu thiếu tỷ giá)."""
+        return float(self.matrix(side)[self.index(from_code), self.index(to_code)])
+
+    def convert(self, amounts, from_codes, to_codes, side='sell'):
+        """
+        Quy đổi mảng số tiền. from_codes/to_codes là một mã (áp dụng cho mọi số tiền), hoặc mảng mã
+        (hay mảng chỉ số từ index()) cùng độ dài với amounts. Trả về mảng float64 (NaN nếu thiếu tỷ giá của loại `side`).
+        """
+        matrix = self.matrix(side)
+        amounts = np.asarray(amounts, dtype=np.float64)
+        return amounts * matrix[self.index(from_codes), self.index(to_codes)]
+
+
+def _to_float(value):
+    return np.nan if value is None else float(value)
+
+
+def _snapshot_time(rates):
+    """Thời điểm cập nhật mới nhất trong các tỷ giá dựng nên ma trận (None nếu không có)."""
+    times = [rate['source_update_time'] or rate['date_recorded'] for rate in rates]
+    return max(times) if times else None
+
+
+class CrossRateEngine:
+    """
+    Ma trận tỷ giá chéo của tỷ giá mới nhất, dựng lại chỉ khi LatestExchangeRates có snapshot mới.
+    Khi CSDL lỗi, tiếp tục dùng ma trận đã có.
+    """
+
+    def __init__(self, check_interval=None):
+        self.check_interval = config.CONVERSION_CHECK_INTERVAL if check_interval is None else check_interval
+        self._matrix = None
+        self._version = None
+        self._checked_at = None # monotonic, lần cuối hỏi phiên bản tỷ giá
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Buộc kiểm tra lại phiên bản ở lần dùng tới (vd gọi ngay sau khi ghi snapshot trong cùng tiến trình)."""
+        self._checked_at = None
+
+    def current(self):
+        """CrossRateMatrix của tỷ giá mới nhất. LookupError nếu chưa từng đọc được tỷ giá nào."""
+        with self._lock:
+            now = time.monotonic()
+            if self._matrix is None or self._checked_at is None or now - self._checked_at >= self.check_interval:
+                self._checked_at = now
+                self._refresh()
+            if self._matrix is None:
+                raise LookupError("Chưa có tỷ giá nào trong CSDL để quy đổi.")
+            return self._matrix
+
+    def _refresh(self):
+        version = database.get_latest_rates_version()
+        if version is None or (version == self._version and self._matrix is not None):
+            return # Lỗi CSDL (đã được ghi log) hoặc không có snapshot mới
+        rates = database.get_latest_rates()
+        if not rates:
+            return
+        started = time.perf_counter()
+        self._matrix = CrossRateMatrix(rates, _snapshot_time(rates))
+        self._version = version
+        logger.debug(f"Đã dựng ma trận tỷ giá chéo {len(self._matrix)}×{len(self._matrix)} "
+                     f"trong {(time.perf_counter() - started) * 1000:.1f}ms", extra={'snapshot_time': self._matrix.snapshot_time})
+
+    def convert(self, amounts, from_codes, to_codes, side='sell'):
+        """Quy đổi theo tỷ giá mới nhất (xem CrossRateMatrix.convert)."""
+        return self.current().convert(amounts, from_codes, to_codes, side)
+
+    def as_of(self, at):
+        """
+        CrossRateMatrix của tỷ giá có hiệu lực tại thời điểm `at` (một truy vấn, xem get_exchange_rates_as_of),
+        cho các ngoại tệ đang có tỷ giá. Giữ lại kết quả để quy đổi nhiều lô cùng thời điểm.
+        """
+        codes = [code for code in self.current().codes if code != BASE_CURRENCY]
+        rates = [rate for rate in database.get_exchange_rates_as_of([(code, at) for code in codes]) if rate['sell'] is not None]
+        return CrossRateMatrix(rates, _snapshot_time(rates))
@@ -1,9 +1,22 @@
 import psycopg2
 import psycopg2.extras # Để sử dụng RealDictCursor
-from datetime import datetime, timezone # Thêm timezone
+import psycopg2.pool # Pool kết nối dùng chung cho toàn tiến trình
+import hashlib
+import itertools
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone # Thêm timezone
+from psycopg2 import sql as pg_sql
 import config
+import metrics
 import os
 
+logger = logging.getLogger(__name__)
+
 # --- Cấu hình kết nối PostgreSQL ---
 # Sử dụng biến môi trường để bảo mật thông tin nhạy cảm
 DB_HOST = os.getenv("PG_HOST", "localhost")
@@ -12,35 +25,400 @@ DB_USER = os.getenv("PG_USER", "postgres")      # Thay bằng user của bạn
 DB_PASSWORD = os.getenv("PG_PASSWORD", "your_password") # Thay bằng password của bạn
 DB_PORT = os.getenv("PG_PORT", "5432")
 
+# --- Cấu hình pool kết nối ---
+DB_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))   # Số kết nối mở sẵn
+DB_POOL_MAX = int(os.getenv("PG_POOL_MAX", "5"))   # Số kết nối tối đa được mượn cùng lúc
+DB_POOL_TIMEOUT = float(os.getenv("PG_POOL_TIMEOUT", "30")) # Số giây tối đa chờ khi pool đã hết kết nối
+# Kết nối nằm rảnh trong pool lâu hơn số giây này sẽ được kiểm tra bằng "SELECT 1" trước khi dùng lại
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("PG_POOL_HEALTHCHECK_IDLE", "30"))
+
+# --- Cấu hình phân vùng (partition) bảng lịch sử ---
+# PG_PARTITIONING=monthly: ExchangeRates/GoldPrices được tạo dạng partition theo tháng trên date_recorded
+# (chỉ áp dụng khi tạo bảng mới; bảng thường đã có dữ liệu cần được chuyển đổi thủ công).
+DB_PARTITIONING = os.getenv("PG_PARTITIONING", "none").lower()
+DB_PARTITION_MONTHS_AHEAD = int(os.getenv("PG_PARTITION_MONTHS_AHEAD", "3")) # Số tháng tương lai tạo sẵn partition
+DB_RETENTION_MONTHS = int(os.getenv("PG_RETENTION_MONTHS", "0")) # Giữ lại bao nhiêu tháng lịch sử (0 = giữ mãi)
+DB_RETENTION_MODE = os.getenv("PG_RETENTION_MODE", "detach").lower() # 'detach' (giữ bảng để lưu trữ) hoặc 'drop'
+PARTITIONED_TABLES = ('ExchangeRates', 'GoldPrices')
+PARTITION_TIMEZONE = timezone(timedelta(hours=7)) # Ranh giới tháng tính theo giờ Việt Nam
+
+# --- Cấu hình bảng nến OHLC (rollup) ---
+ROLLUP_TIMEZONE = os.getenv("ROLLUP_TIMEZONE", "Asia/Ho_Chi_Minh") # Múi giờ dùng để cắt nến ngày
+ROLLUP_BATCH_SIZE = int(os.getenv("ROLLUP_BATCH_SIZE", "100000"))  # Số tick tối đa xử lý trong một transaction
+CANDLE_RESOLUTIONS = {'1m': 'minute', '1h': 'hour', '1d': 'day'}
+# Khóa advisory: các transaction ghi lịch sử giữ khóa dạng shared, bước rollup lấy khóa exclusive
+# trong chốc lát để chắc chắn không còn transaction ghi nào đang dở khi chốt mốc id (watermark).
+INGEST_ADVISORY_LOCK = 0x46494E58
+
+# Số dòng mỗi lần lấy từ server-side cursor khi đọc lịch sử dạng luồng (iter_*_history)
+HISTORY_CHUNK_SIZE = int(os.getenv("PG_HISTORY_CHUNK_SIZE", "10000"))
+
+_pool = None
+_pool_slots = None # Semaphore giới hạn số kết nối đang được mượn (ThreadedConnectionPool không tự chờ)
+_pool_lock = threading.Lock()
+_last_released = {} # id(conn) -> thời điểm (monotonic) kết nối được trả về pool
+
+# --- Cache ID của các bảng chiều (Currencies, GoldTypes) ---
+# Danh sách mã ngoại tệ và loại vàng SJC gần như không đổi, nên ID được giữ trong bộ nhớ
+# để việc ghi snapshot không phải SELECT/INSERT bảng chiều ở mỗi lần chạy.
+_currency_id_cache = {}  # code -> id
+_gold_type_id_cache = {} # (name, provider) -> id
+_dimension_cache_loaded = False
+_dimension_cache_lock = threading.Lock()
+
 
-def get_db_connection():
-    """Tạo và trả về một kết nối đến cơ sở dữ liệu PostgreSQL."""
+def _print_connection_error(e):
+    # Không ghi mật khẩu ra log
+    logger.error(
+        f"Lỗi nghiêm trọng: Không thể kết nối đến PostgreSQL server ({e}). "
+        "Vui lòng kiểm tra server có đang chạy không, thông tin kết nối (host, database, user, password, port), "
+        "quyền truy cập của user vào database và cấu hình pg_hba.conf (nếu kết nối từ máy khác).",
+        extra={'pg_host': DB_HOST, 'pg_database': DB_NAME, 'pg_user': DB_USER, 'pg_port': DB_PORT}
+    )
+
+
+def get_db_connection(**connect_kwargs):
+    """
+    Tạo và trả về một kết nối riêng (không qua pool) đến cơ sở dữ liệu PostgreSQL.
+    Người gọi tự chịu trách nhiệm đóng kết nối. Các hàm trong module này dùng db_connection().
+    connect_kwargs: tham số libpq bổ sung (vd application_name, keepalives_idle).
+    """
     try:
         conn = psycopg2.connect(
             host=DB_HOST,
             database=DB_NAME,
             user=DB_USER,
             password=DB_PASSWORD,
-            port=DB_PORT
+            port=DB_PORT,
+            **connect_kwargs
         )
         return conn
     except psycopg2.OperationalError as e:
-        print(f"Lỗi nghiêm trọng: Không thể kết nối đến PostgreSQL server.")
-        print(f"Thông tin kết nối: Host={DB_HOST}, DB={DB_NAME}, User={DB_USER}, Port={DB_PORT}, Password={DB_PASSWORD}")
-        print(f"Chi tiết lỗi: {e}")
-        print("Vui lòng kiểm tra:")
-        print("1. PostgreSQL server có đang chạy không.")
-        print("2. Thông tin kết nối (host, database, user, password, port) có chính xác không.")
-        print("3. Quyền truy cập của user vào database.")
-        print("4. Cấu hình pg_hba.conf của PostgreSQL (nếu kết nối từ máy khác).")
+        _print_connection_error(e)
         raise  # Ném lại lỗi để chương trình chính có thể dừng lại
 
-def create_tables_postgres():
+
+def init_pool(minconn=None, maxconn=None):
+    """
+    Khởi tạo pool kết nối dùng chung cho toàn tiến trình (chỉ tạo một lần).
+    Có thể gọi lúc khởi động để mở sẵn kết nối; nếu không, pool sẽ được tạo ở lần dùng đầu tiên.
+    """
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            return _pool
+        minconn = DB_POOL_MIN if minconn is None else minconn
+        maxconn = DB_POOL_MAX if maxconn is None else maxconn
+        try:
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                minconn,
+                maxconn,
+                host=DB_HOST,
+                database=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                port=DB_PORT
+            )
+        except psycopg2.OperationalError as e:
+            _print_connection_error(e)
+            raise
+        _pool_slots = threading.BoundedSemaphore(maxconn)
+        _last_released.clear()
+        return _pool
+
+
+def close_pool():
+    """Đóng tất cả kết nối trong pool (gọi khi tiến trình kết thúc)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
+        _last_released.clear()
+
+
+def _is_connection_healthy(conn):
+    """Kiểm tra nhanh một kết nối vừa lấy ra khỏi pool còn dùng được hay không."""
+    if conn.closed:
+        return False
+    released_at = _last_released.get(id(conn))
+    if released_at is None or time.monotonic() - released_at < DB_POOL_HEALTHCHECK_IDLE:
+        return True # Kết nối mới tạo hoặc vừa được dùng gần đây
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _release_connection(pool, conn, discard):
+    """Trả kết nối về pool; kết nối hỏng sẽ bị đóng để pool tạo kết nối mới thay thế."""
+    discard = discard or conn.closed
+    if discard:
+        _last_released.pop(id(conn), None)
+    else:
+        _last_released[id(conn)] = time.monotonic()
+    if pool.closed:
+        if not conn.closed:
+            conn.close()
+        return
+    pool.putconn(conn, close=discard)
+
+
+@contextmanager
+def db_connection():
+    """
+    Mượn một kết nối từ pool (context manager):
+
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                ...
+
+    Commit khi khối lệnh kết thúc bình thường, rollback khi có lỗi, rồi trả kết nối về pool.
+    Kết nối hỏng (server khởi động lại, mạng bị ngắt) bị loại khỏi pool thay vì được dùng lại.
+    """
+    pool = init_pool()
+    slots = _pool_slots
+    wait_started = time.perf_counter()
+    if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+        metrics.DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - wait_started)
+        raise psycopg2.pool.PoolError(f"Không mượn được kết nối từ pool sau {DB_POOL_TIMEOUT} giây chờ.")
+    conn = None
+    discard = False
+    try:
+        for _ in range(pool.maxconn + 1):
+            conn = pool.getconn()
+            if _is_connection_healthy(conn):
+                break
+            _release_connection(pool, conn, discard=True)
+            conn = None
+        metrics.DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - wait_started)
+        if conn is None:
+            raise psycopg2.OperationalError("Không lấy được kết nối còn hoạt động từ pool.")
+        yield conn
+        conn.commit()
+    except BaseException as e:
+        if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            discard = True
+        if conn is not None and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        raise
+    finally:
+        if conn is not None:
+            _release_connection(pool, conn, discard)
+        slots.release()
+
+def _load_dimension_ids(cursor):
+    """Đọc toàn bộ Currencies và GoldTypes bằng MỘT câu truy vấn, trả về (currencies, gold_types)."""
+    cursor.execute("""
+        SELECT 'C', id, code, NULL FROM Currencies
+        UNION ALL
+        SELECT 'G', id, name, provider FROM GoldTypes
+    """)
+    currencies, gold_types = {}, {}
+    for kind, dim_id, key, provider in cursor.fetchall():
+        if kind == 'C':
+            currencies[key] = dim_id
+        else:
+            gold_types[(key, provider)] = dim_id
+    return currencies, gold_types
+
+
+def _replace_dimension_cache(currencies, gold_types):
+    global _dimension_cache_loaded
+    with _dimension_cache_lock:
+        _currency_id_cache.clear()
+        _currency_id_cache.update(currencies)
+        _gold_type_id_cache.clear()
+        _gold_type_id_cache.update(gold_types)
+        _dimension_cache_loaded = True
+
+
+def _remember_dimension_ids(currencies=None, gold_types=None):
+    """Bổ sung ID vào cache. Chỉ gọi với các dòng đã được commit."""
+    with _dimension_cache_lock:
+        _currency_id_cache.update(currencies or {})
+        _gold_type_id_cache.update(gold_types or {})
+
+
+def invalidate_dimension_cache():
+    """Xóa cache ID bảng chiều; lần ghi kế tiếp sẽ nạp lại từ CSDL."""
+    global _dimension_cache_loaded
+    with _dimension_cache_lock:
+        _currency_id_cache.clear()
+        _gold_type_id_cache.clear()
+        _dimension_cache_loaded = False
+
+
+@metrics.timed_db
+def preload_dimension_cache():
+    """Nạp sẵn cache ID của Currencies và GoldTypes bằng một câu truy vấn (gọi lúc khởi động)."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                currencies, gold_types = _load_dimension_ids(cursor)
+        _replace_dimension_cache(currencies, gold_types)
+        logger.info(f"Đã nạp cache bảng chiều: {len(currencies)} ngoại tệ, {len(gold_types)} loại vàng.")
+    except psycopg2.Error as e:
+        logger.error(f"Lỗi khi nạp cache bảng chiều từ PostgreSQL: {e}")
+
+
+def _history_table_options():
+    """Các đoạn DDL khác nhau giữa bảng lịch sử thường và bảng phân vùng theo tháng."""
+    if DB_PARTITIONING == 'monthly':
+        # Khóa chính của bảng phân vùng phải chứa cột phân vùng
+        return {
+            'id_constraint': '',
+            'primary_key': '\n        PRIMARY KEY (id, date_recorded),',
+            'partition_by': ' PARTITION BY RANGE (date_recorded)',
+        }
+    return {'id_constraint': ' PRIMARY KEY', 'primary_key': '', 'partition_by': ''}
+
+
+def _month_start(dt):
+    dt = dt.astimezone(PARTITION_TIMEZONE)
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add_months(month_start, months):
+    month_index = month_start.year * 12 + month_start.month - 1 + months
+    return month_start.replace(year=month_index // 12, month=month_index % 12 + 1)
+
+
+def _partition_name(table, month_start):
+    return f"{table.lower()}_p{month_start.year:04d}_{month_start.month:02d}"
+
+
+def _is_partitioned(cursor, table):
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (table.lower(),))
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+@metrics.timed_db
+def ensure_partitions(start=None, end=None, months_ahead=None):
+    """
+    Tạo (nếu chưa có) partition theo tháng cho ExchangeRates và GoldPrices, từ tháng chứa `start`
+    đến `months_ahead` tháng sau tháng chứa `end` (mặc định: từ tháng hiện tại, PG_PARTITION_MONTHS_AHEAD tháng tới).
+    Không làm gì với bảng không phân vùng. Trả về danh sách partition mới tạo.
     """
-    Tạo các bảng trong cơ sở dữ liệu PostgreSQL nếu chúng chưa tồn tại.
+    now = datetime.now(PARTITION_TIMEZONE)
+    first_month = _month_start(start or now)
+    last_month = _add_months(
+        _month_start(end or now),
+        DB_PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    )
+    created = []
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                for table in PARTITIONED_TABLES:
+                    if not _is_partitioned(cursor, table):
+                        continue
+                    month = first_month
+                    while month <= last_month:
+                        name = _partition_name(table, month)
+                        cursor.execute("SELECT to_regclass(%s) IS NULL", (name,))
+                        if cursor.fetchone()[0]:
+                            cursor.execute(
+                                pg_sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)").format(
+                                    pg_sql.Identifier(name), pg_sql.Identifier(table.lower())
+                                ),
+                                (month, _add_months(month, 1))
+                            )
+                            created.append(name)
+                        month = _add_months(month, 1)
+        if created:
+            logger.info(f"Đã tạo {len(created)} partition mới: {', '.join(created)}")
+    except psycopg2.Error as e:
+        logger.error(f"Lỗi khi tạo partition cho bảng lịch sử: {e}")
+    return created
+
+
+@metrics.timed_db
+def apply_retention(keep_months=None, mode=None):
     """
-    # Tạo bảng cho tỷ giá
-    sql_script = """
+    Áp dụng chính sách lưu giữ cho các bảng lịch sử phân vùng: các partition có toàn bộ dữ liệu
+    cũ hơn `keep_months` tháng được DETACH (giữ lại bảng độc lập để lưu trữ) hoặc DROP,
+    thay vì DELETE từng dòng (không tạo bloat, không cần VACUUM).
+    keep_months=0 nghĩa là giữ mãi. Trả về danh sách partition đã xử lý.
+    """
+    keep_months = DB_RETENTION_MONTHS if keep_months is None else keep_months
+    mode = DB_RETENTION_MODE if mode is None else mode
+    if keep_months <= 0:
+        return []
+    if mode not in ('detach', 'drop'):
+        raise ValueError(f"PG_RETENTION_MODE không hợp lệ: '{mode}' (chỉ nhận 'detach' hoặc 'drop').")
+
+    cutoff = _add_months(_month_start(datetime.now(PARTITION_TIMEZONE)), -keep_months)
+    processed = []
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                for table in PARTITIONED_TABLES:
+                    cursor.execute("""
+                        SELECT child.relname
+                        FROM pg_inherits i
+                        JOIN pg_class child ON child.oid = i.inhrelid
+                        WHERE i.inhparent = to_regclass(%s)
+                    """, (table.lower(),))
+                    for (name,) in cursor.fetchall():
+                        match = re.search(r'_p(\d{4})_(\d{2})$', name)
+                        if not match:
+                            continue
+                        month = datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=PARTITION_TIMEZONE)
+                        if _add_months(month, 1) > cutoff:
+                            continue
+                        if mode == 'drop':
+                            statement = pg_sql.SQL("DROP TABLE {}").format(pg_sql.Identifier(name))
+                        else:
+                            statement = pg_sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+                                pg_sql.Identifier(table.lower()), pg_sql.Identifier(name)
+                            )
+                        cursor.execute(statement)
+                        processed.append(name)
+        if processed:
+            action = "Đã xóa" if mode == 'drop' else "Đã tách (detach)"
+            logger.info(f"{action} {len(processed)} partition cũ hơn {keep_months} tháng: {', '.join(processed)}")
+    except psycopg2.Error as e:
+        logger.error(f"Lỗi khi áp dụng chính sách lưu giữ cho bảng lịch sử: {e}")
+    return processed
+
+
+def run_partition_maintenance():
+    """Việc bảo trì định kỳ: tạo partition cho các tháng sắp tới và áp dụng chính sách lưu giữ."""
+    ensure_partitions()
+    apply_retention()
+
+
+# --- Phiên bản schema (migration) ---
+# Mỗi migration là (phiên bản, mô tả, hàm nhận cursor); phiên bản tăng dần và không bao giờ sửa lại
+# migration đã phát hành, chỉ thêm migration mới vào cuối. Migration được áp dụng tường minh
+# (python main.py migrate); lúc khởi động ứng dụng chỉ so phiên bản bằng một truy vấn (verify_schema).
+SCHEMA_MIGRATION_LOCK = 0x4D494752 # Khóa advisory: chỉ một tiến trình chạy migration tại một thời điểm
+# Thời gian tối đa chờ khóa bảng khi chạy DDL, để migration không xếp hàng chặn các lệnh ghi đang chạy
+DB_MIGRATION_LOCK_TIMEOUT = os.getenv("PG_MIGRATION_LOCK_TIMEOUT", "5s")
+
+_SCHEMA_VERSION_SQL = """
+CREATE TABLE IF NOT EXISTS SchemaVersion (
+    version INTEGER PRIMARY KEY,
+    description VARCHAR(255) NOT NULL,
+    applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+_schema_version_checked = None # Phiên bản đã xác nhận trong tiến trình này (tránh hỏi lại CSDL)
+
+
+def _migration_base_tables(cursor):
+    """Các bảng tỷ giá, giá vàng, nến, watermark và snapshot (IF NOT EXISTS: không đổi gì với CSDL đã có bảng)."""
+    options = _history_table_options()
+    cursor.execute(f"""
     CREATE TABLE IF NOT EXISTS Currencies (
         id SERIAL PRIMARY KEY,
         code VARCHAR(10) UNIQUE NOT NULL,
@@ -48,91 +426,407 @@ def create_tables_postgres():
     );
 
     CREATE TABLE IF NOT EXISTS ExchangeRates (
-        id SERIAL PRIMARY KEY,
+        id SERIAL{options['id_constraint']},
         currency_id INTEGER NOT NULL,
         date_recorded TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
         buy_cash NUMERIC(18, 4),
         buy_transfer NUMERIC(18, 4),
         sell NUMERIC(18, 4) NOT NULL,
-        source_update_time TIMESTAMP WITH TIME ZONE,
+        source_update_time TIMESTAMP WITH TIME ZONE,{options['primary_key']}
         CONSTRAINT fk_currency
             FOREIGN KEY (currency_id)
             REFERENCES Currencies (id)
             ON DELETE CASCADE
-    );
+    ){options['partition_by']};
 
     CREATE INDEX IF NOT EXISTS idx_currencies_code ON Currencies (code);
     CREATE INDEX IF NOT EXISTS idx_exchangerates_currency_id ON ExchangeRates (currency_id);
     CREATE INDEX IF NOT EXISTS idx_exchangerates_date_recorded ON ExchangeRates (date_recorded DESC);
     CREATE INDEX IF NOT EXISTS idx_exchangerates_source_update_time ON ExchangeRates (source_update_time DESC);
+
+    -- Tỷ giá mới nhất của mỗi ngoại tệ, được upsert cùng transaction với mỗi lần ghi ExchangeRates
+    CREATE TABLE IF NOT EXISTS LatestExchangeRates (
+        currency_id INTEGER PRIMARY KEY REFERENCES Currencies (id) ON DELETE CASCADE,
+        buy_cash NUMERIC(18, 4),
+        buy_transfer NUMERIC(18, 4),
+        sell NUMERIC(18, 4) NOT NULL,
+        date_recorded TIMESTAMP WITH TIME ZONE NOT NULL,
+        source_update_time TIMESTAMP WITH TIME ZONE
+    );
+
+    -- Nến OHLC của tỷ giá bán (sell) theo khung 1m/1h/1d, cập nhật tăng dần từ watermark
+    CREATE TABLE IF NOT EXISTS ExchangeRateCandles (
+        currency_id INTEGER NOT NULL REFERENCES Currencies (id) ON DELETE CASCADE,
+        resolution VARCHAR(4) NOT NULL,
+        bucket_start TIMESTAMP WITH TIME ZONE NOT NULL,
+        open NUMERIC(18, 4) NOT NULL,
+        high NUMERIC(18, 4) NOT NULL,
+        low NUMERIC(18, 4) NOT NULL,
+        close NUMERIC(18, 4) NOT NULL,
+        tick_count INTEGER NOT NULL,
+        open_time TIMESTAMP WITH TIME ZONE NOT NULL,
+        close_time TIMESTAMP WITH TIME ZONE NOT NULL,
+        PRIMARY KEY (currency_id, resolution, bucket_start)
+    );
+
+    -- Mốc id đã được rollup của từng bảng lịch sử
+    CREATE TABLE IF NOT EXISTS RollupWatermarks (
+        name VARCHAR(50) PRIMARY KEY,
+        last_id BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Snapshot gần nhất đã lưu của mỗi nguồn (phát hiện snapshot không đổi)
+    CREATE TABLE IF NOT EXISTS SourceSnapshots (
+        source VARCHAR(50) PRIMARY KEY,
+        source_update_time TIMESTAMP WITH TIME ZONE,
+        content_hash CHAR(64) NOT NULL,
+        row_count INTEGER NOT NULL,
+        first_seen TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        last_seen TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        seen_count INTEGER NOT NULL DEFAULT 1
+    );
+""")
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS GoldTypes (
+        id SERIAL PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        original_type_name VARCHAR(255),
+        city_name VARCHAR(100),
+        provider VARCHAR(50) NOT NULL,
+        UNIQUE(name, provider)
+    );
+
+    CREATE TABLE IF NOT EXISTS GoldPrices (
+        id SERIAL{options['id_constraint']},
+        gold_type_id INTEGER NOT NULL,
+        date_recorded TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        buy_price NUMERIC(18, 4),
+        sell_price NUMERIC(18, 4),
+        unit VARCHAR(20) NOT NULL,
+        source_update_time TIMESTAMP WITH TIME ZONE,{options['primary_key']}
+        CONSTRAINT fk_gold_type
+            FOREIGN KEY (gold_type_id)
+            REFERENCES GoldTypes (id)
+            ON DELETE CASCADE
+    ){options['partition_by']};
+
+    -- Giá vàng mới nhất của mỗi loại vàng, được upsert cùng transaction với mỗi lần ghi GoldPrices
+    CREATE TABLE IF NOT EXISTS LatestGoldPrices (
+        gold_type_id INTEGER PRIMARY KEY REFERENCES GoldTypes (id) ON DELETE CASCADE,
+        gold_price_id INTEGER NOT NULL,
+        buy_price NUMERIC(18, 4),
+        sell_price NUMERIC(18, 4),
+        unit VARCHAR(20) NOT NULL,
+        date_recorded TIMESTAMP WITH TIME ZONE NOT NULL,
+        source_update_time TIMESTAMP WITH TIME ZONE
+    );
+
+    -- Nến OHLC của giá bán vàng (sell_price) theo khung 1m/1h/1d
+    CREATE TABLE IF NOT EXISTS GoldPriceCandles (
+        gold_type_id INTEGER NOT NULL REFERENCES GoldTypes (id) ON DELETE CASCADE,
+        resolution VARCHAR(4) NOT NULL,
+        bucket_start TIMESTAMP WITH TIME ZONE NOT NULL,
+        open NUMERIC(18, 4) NOT NULL,
+        high NUMERIC(18, 4) NOT NULL,
+        low NUMERIC(18, 4) NOT NULL,
+        close NUMERIC(18, 4) NOT NULL,
+        tick_count INTEGER NOT NULL,
+        open_time TIMESTAMP WITH TIME ZONE NOT NULL,
+        close_time TIMESTAMP WITH TIME ZONE NOT NULL,
+        PRIMARY KEY (gold_type_id, resolution, bucket_start)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_goldtypes_provider ON GoldTypes (provider);
+    CREATE INDEX IF NOT EXISTS idx_goldprices_gold_type_id ON GoldPrices (gold_type_id);
+    CREATE INDEX IF NOT EXISTS idx_goldprices_date_recorded ON GoldPrices (date_recorded DESC);
+    CREATE INDEX IF NOT EXISTS idx_goldprices_source_update_time ON GoldPrices (source_update_time DESC);
+""")
+
+
+def _migration_goldtypes_column_names(cursor):
     """
-    conn = None
+    CSDL tạo bởi phiên bản cũ của create_gold_tables() có cột GoldTypes.original_type/city,
+    trong khi mã ghi/đọc và sql/exchange_rate.sql dùng original_type_name/city_name: đổi tên cột.
+    """
+    cursor.execute("""
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema()
+                   AND table_name = 'goldtypes' AND column_name = 'original_type') THEN
+            ALTER TABLE GoldTypes RENAME COLUMN original_type TO original_type_name;
+            ALTER TABLE GoldTypes ALTER COLUMN original_type_name DROP NOT NULL;
+        END IF;
+        IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema()
+                   AND table_name = 'goldtypes' AND column_name = 'city') THEN
+            ALTER TABLE GoldTypes RENAME COLUMN city TO city_name;
+        END IF;
+    END $$;
+    """)
+
+
+def _migration_spool_checkpoints(cursor):
+    """Mốc seq đã ghi vào CSDL của từng spool cục bộ (xem spool.py), cập nhật cùng transaction với dữ liệu."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS SpoolCheckpoints (
+        spool_id VARCHAR(64) PRIMARY KEY,
+        last_seq BIGINT NOT NULL,
+        updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+
+def _autocommit_migration(migrate):
+    """Đánh dấu migration chạy ngoài transaction (autocommit), vd để dùng CREATE INDEX CONCURRENTLY."""
+    migrate.autocommit = True
+    return migrate
+
+
+def _create_index_concurrently(cursor, name, table, columns):
+    """
+    CREATE INDEX CONCURRENTLY (không chặn lệnh ghi vào bảng). Index INVALID còn lại từ lần tạo
+    bị lỗi/ngắt trước đó được xóa và tạo lại, vì IF NOT EXISTS sẽ bỏ qua nó.
+    """
+    cursor.execute("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+    row = cursor.fetchone()
+    if row and row[0]:
+        logger.warning(f"Index '{name}' chưa tạo xong từ lần migrate trước (INVALID), tạo lại.")
+        cursor.execute(pg_sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(pg_sql.Identifier(name)))
+    cursor.execute(pg_sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} " + columns).format(
+        pg_sql.Identifier(name), pg_sql.Identifier(table)
+    ))
+
+
+@_autocommit_migration
+def _migration_rate_as_of_index(cursor):
+    """
+    Index cho tra cứu tỷ giá tại thời điểm (get_exchange_rates_as_of); thay thế index chỉ theo currency_id.
+    Index được tạo CONCURRENTLY trước khi xóa index cũ, nên bảng ExchangeRates lớn vẫn nhận ghi trong lúc migrate.
+    """
+    name = 'idx_exchangerates_currency_source_time'
+    columns = '(currency_id, source_update_time DESC, date_recorded DESC)'
+    if not _is_partitioned(cursor, 'ExchangeRates'):
+        _create_index_concurrently(cursor, name, 'exchangerates', columns)
+        cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_exchangerates_currency_id")
+        return
+    # Bảng phân vùng không hỗ trợ CONCURRENTLY: tạo index rỗng trên riêng bảng cha (ON ONLY), tạo index
+    # từng partition CONCURRENTLY rồi gắn vào; index cha tự thành hợp lệ khi mọi partition đã được gắn
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY exchangerates {columns}")
+    cursor.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'exchangerates'::regclass ORDER BY c.relname
+    """)
+    for (partition,) in cursor.fetchall():
+        partition_index = f"{partition}_currency_source_time_idx"
+        _create_index_concurrently(cursor, partition_index, partition, columns)
+        cursor.execute(pg_sql.SQL("ALTER INDEX {} ATTACH PARTITION {}").format(
+            pg_sql.Identifier(name), pg_sql.Identifier(partition_index)
+        ))
+    # DROP INDEX trên bảng phân vùng không có CONCURRENTLY: lock_timeout giới hạn thời gian chờ khóa
+    cursor.execute("SELECT set_config('lock_timeout', %s, false)", (DB_MIGRATION_LOCK_TIMEOUT,))
+    cursor.execute("DROP INDEX IF EXISTS idx_exchangerates_currency_id")
+
+
+def _migration_quarantined_quotes(cursor):
+    """Các dòng giá bị đánh dấu bất thường (xem anomaly.py), để xem lại và nạp lại thủ công nếu cần."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS QuarantinedQuotes (
+        id BIGSERIAL PRIMARY KEY,
+        source VARCHAR(50) NOT NULL,
+        kind VARCHAR(20) NOT NULL,
+        instrument VARCHAR(255) NOT NULL,
+        action VARCHAR(12) NOT NULL, -- 'quarantined' (không ghi vào lịch sử) hoặc 'flagged' (vẫn ghi)
+        reasons TEXT NOT NULL,
+        row_data JSONB NOT NULL,
+        source_update_time TIMESTAMP WITH TIME ZONE,
+        detected_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_quarantinedquotes_detected_at ON QuarantinedQuotes (detected_at DESC);
+    """)
+
+
+SCHEMA_MIGRATIONS = [
+    (1, "Bảng tỷ giá, giá vàng, nến OHLC, watermark rollup và snapshot nguồn", _migration_base_tables),
+    (2, "Đổi tên cột GoldTypes.original_type/city thành original_type_name/city_name", _migration_goldtypes_column_names),
+    (3, "Bảng SpoolCheckpoints cho việc ghi lại dữ liệu từ spool cục bộ", _migration_spool_checkpoints),
+    (4, "Index (currency_id, source_update_time) cho tra cứu tỷ giá tại thời điểm", _migration_rate_as_of_index),
+    (5, "Bảng QuarantinedQuotes cho các dòng giá bất thường", _migration_quarantined_quotes),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0] # Phiên bản schema mà mã nguồn này cần
+
+
+@metrics.timed_db
+def get_schema_version():
+    """Phiên bản schema hiện tại của CSDL (0 nếu chưa có bảng SchemaVersion). Chỉ một truy vấn, không chạy DDL."""
     try:
-        conn = get_db_connection()
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT COALESCE(MAX(version), 0) FROM SchemaVersion")
+                return cursor.fetchone()[0]
+    except psycopg2.errors.UndefinedTable:
+        return 0
+
+
+def verify_schema():
+    """
+    Kiểm tra lúc khởi động: trả về True nếu CSDL đã ở phiên bản SCHEMA_VERSION (hoặc mới hơn).
+    Kết quả đúng được nhớ trong tiến trình, các lần gọi sau không truy vấn lại.
+    """
+    global _schema_version_checked
+    if _schema_version_checked is not None:
+        return True
+    version = get_schema_version()
+    if version < SCHEMA_VERSION:
+        logger.error(f"Schema CSDL '{DB_NAME}' đang ở phiên bản {version}, mã nguồn cần phiên bản {SCHEMA_VERSION}. "
+                     "Chạy 'python main.py migrate' để nâng cấp.",
+                     extra={'schema_version': version, 'required_version': SCHEMA_VERSION})
+        return False
+    if version > SCHEMA_VERSION:
+        logger.warning(f"Schema CSDL '{DB_NAME}' (phiên bản {version}) mới hơn mã nguồn (phiên bản {SCHEMA_VERSION}).")
+    _schema_version_checked = version
+    return True
+
+
+@metrics.timed_db
+def _apply_transactional_migration(version, description, migrate):
+    """Chạy migration cùng dòng SchemaVersion của nó trong MỘT transaction. False nếu đã được áp dụng."""
+    with db_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute(sql_script)
-        conn.commit()
-        print(f"Đã kiểm tra/khởi tạo bảng tỷ giá trong PostgreSQL database '{DB_NAME}'.")
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_MIGRATION_LOCK,))
+            cursor.execute("SELECT 1 FROM SchemaVersion WHERE version = %s", (version,))
+            if cursor.fetchone():
+                return False
+            cursor.execute("SELECT set_config('lock_timeout', %s, true)", (DB_MIGRATION_LOCK_TIMEOUT,))
+            migrate(cursor)
+            cursor.execute(
+                "INSERT INTO SchemaVersion (version, description) VALUES (%s, %s)", (version, description)
+            )
+    return True
+
+
+def _apply_autocommit_migration(version, description, migrate):
+    """
+    Chạy migration ở chế độ autocommit (mỗi lệnh một transaction), dưới khóa advisory mức session.
+    Migration loại này phải chạy lại được nếu bị ngắt giữa chừng. False nếu đã được áp dụng.
+    """
+    with db_connection() as conn:
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_MIGRATION_LOCK,))
+                try:
+                    cursor.execute("SELECT 1 FROM SchemaVersion WHERE version = %s", (version,))
+                    if cursor.fetchone():
+                        return False
+                    migrate(cursor)
+                    cursor.execute(
+                        "INSERT INTO SchemaVersion (version, description) VALUES (%s, %s)", (version, description)
+                    )
+                finally:
+                    if not conn.closed:
+                        cursor.execute("RESET lock_timeout")
+                        cursor.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_MIGRATION_LOCK,))
+        finally:
+            if not conn.closed:
+                conn.autocommit = False
+    return True
+
+
+def apply_migrations(target=None):
+    """
+    Áp dụng các migration còn thiếu, đến phiên bản `target` (mặc định: SCHEMA_VERSION).
+    Mỗi migration chạy cùng dòng SchemaVersion của nó trong MỘT transaction (DDL của PostgreSQL có
+    transaction), nên migration lỗi không để lại schema dở dang; riêng migration đánh dấu
+    _autocommit_migration (vd tạo index CONCURRENTLY) chạy ngoài transaction và phải chạy lại được.
+    Trả về danh sách phiên bản đã áp dụng.
+    """
+    global _schema_version_checked
+    target = SCHEMA_VERSION if target is None else target
+    applied = []
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(_SCHEMA_VERSION_SQL)
+    for version, description, migrate in SCHEMA_MIGRATIONS:
+        if version > target:
+            break
+        if getattr(migrate, 'autocommit', False):
+            done = _apply_autocommit_migration(version, description, migrate)
+        else:
+            done = _apply_transactional_migration(version, description, migrate)
+        if not done:
+            continue # Đã áp dụng (có thể bởi tiến trình khác trong lúc chờ khóa)
+        applied.append(version)
+        logger.info(f"Đã áp dụng migration {version}: {description}", extra={'schema_version': version})
+    _schema_version_checked = None
+    invalidate_dimension_cache()
+    return applied
+
+
+def create_tables_postgres():
+    """
+    Tạo/nâng cấp schema bằng cách áp dụng mọi migration còn thiếu (xem SCHEMA_MIGRATIONS),
+    rồi tạo sẵn partition cho tháng hiện tại và các tháng sắp tới (không làm gì nếu bảng không phân vùng).
+    Trả về False nếu migration lỗi (khi đó không tạo partition: schema có thể chưa ở phiên bản cần).
+    """
+    try:
+        applied = apply_migrations()
     except psycopg2.Error as e:
-        print(f"Lỗi khi tạo bảng tỷ giá trong PostgreSQL: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
-    
-    # Tạo bảng cho giá vàng
-    create_gold_tables()
+        logger.error(f"Lỗi khi áp dụng migration schema trong PostgreSQL: {e}")
+        return False
+    if not applied:
+        logger.info(f"Schema PostgreSQL database '{DB_NAME}' đã ở phiên bản {SCHEMA_VERSION}.")
+    ensure_partitions()
+    return True
 
+@metrics.timed_db
 def get_or_create_currency(code, name):
     """
     Lấy ID của một loại tiền tệ dựa trên mã của nó trong PostgreSQL.
     Nếu không tồn tại, tạo mới và trả về ID.
     Sử dụng 'ON CONFLICT DO NOTHING' hoặc 'RETURNING id' để xử lý hiệu quả.
+    ID đã biết được lấy thẳng từ cache trong bộ nhớ, không truy vấn CSDL.
     """
-    conn = None
-    currency_id = None
+    currency_id = _currency_id_cache.get(code)
+    if currency_id is not None:
+        return currency_id
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            # Thử SELECT trước để tránh ghi log không cần thiết nếu đã tồn tại
-            cursor.execute("SELECT id FROM Currencies WHERE code = %s", (code,))
-            row = cursor.fetchone()
-            if row:
-                currency_id = row[0]
-            else:
-                # Nếu không có, INSERT và lấy ID trả về.
-                # Xử lý trường hợp đồng thời (race condition) bằng cách bắt UniqueViolation.
-                try:
-                    cursor.execute(
-                        "INSERT INTO Currencies (code, name) VALUES (%s, %s) RETURNING id",
-                        (code, name)
-                    )
-                    currency_id = cursor.fetchone()[0]
-                    conn.commit()
-                    print(f"Đã thêm ngoại tệ mới vào PostgreSQL: {name} ({code}) với ID {currency_id}")
-                except psycopg2.errors.UniqueViolation: # Bắt lỗi cụ thể
-                    conn.rollback() # Quan trọng: rollback transaction bị lỗi
-                    # Ngoại tệ đã được thêm bởi một tiến trình khác, thử lấy lại ID
-                    cursor.execute("SELECT id FROM Currencies WHERE code = %s", (code,))
-                    row_after_conflict = cursor.fetchone()
-                    if row_after_conflict:
-                        currency_id = row_after_conflict[0]
-                        print(f"Ngoại tệ {code} đã tồn tại (xử lý race condition), ID: {currency_id}")
-                    else:
-                        # Trường hợp này không nên xảy ra nếu UniqueViolation là do code
-                        print(f"LỖI NGHIÊM TRỌNG: Không tìm thấy currency {code} sau khi xử lý UniqueViolation.")
-                except psycopg2.Error as e_insert: # Bắt các lỗi khác khi insert
-                    conn.rollback()
-                    print(f"Lỗi khi INSERT currency '{code}': {e_insert}")
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                # Thử SELECT trước để tránh ghi log không cần thiết nếu đã tồn tại
+                cursor.execute("SELECT id FROM Currencies WHERE code = %s", (code,))
+                row = cursor.fetchone()
+                if row:
+                    currency_id = row[0]
+                else:
+                    # Nếu không có, INSERT và lấy ID trả về.
+                    # Xử lý trường hợp đồng thời (race condition) bằng cách bắt UniqueViolation.
+                    try:
+                        cursor.execute(
+                            "INSERT INTO Currencies (code, name) VALUES (%s, %s) RETURNING id",
+                            (code, name)
+                        )
+                        currency_id = cursor.fetchone()[0]
+                        conn.commit()
+                        logger.info(f"Đã thêm ngoại tệ mới vào PostgreSQL: {name} ({code}) với ID {currency_id}")
+                    except psycopg2.errors.UniqueViolation: # Bắt lỗi cụ thể
+                        conn.rollback() # Quan trọng: rollback transaction bị lỗi
+                        # Ngoại tệ đã được thêm bởi một tiến trình khác, thử lấy lại ID
+                        cursor.execute("SELECT id FROM Currencies WHERE code = %s", (code,))
+                        row_after_conflict = cursor.fetchone()
+                        if row_after_conflict:
+                            currency_id = row_after_conflict[0]
+                            logger.info(f"Ngoại tệ {code} đã tồn tại (xử lý race condition), ID: {currency_id}")
+                        else:
+                            # Trường hợp này không nên xảy ra nếu UniqueViolation là do code
+                            logger.error(f"LỖI NGHIÊM TRỌNG: Không tìm thấy currency {code} sau khi xử lý UniqueViolation.")
+                    except psycopg2.Error as e_insert: # Bắt các lỗi khác khi insert
+                        conn.rollback()
+                        logger.error(f"Lỗi khi INSERT currency '{code}': {e_insert}")
 
     except psycopg2.Error as e:
-        print(f"Lỗi CSDL khi get/create currency '{code}': {e}")
-        if conn: # Đảm bảo conn tồn tại trước khi rollback
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Lỗi CSDL khi get/create currency '{code}': {e}")
+    if currency_id is not None:
+        _remember_dimension_ids(currencies={code: currency_id})
     return currency_id
 
 def _parse_datetime_for_postgres(time_str_from_api):
@@ -154,266 +848,1163 @@ def _parse_datetime_for_postgres(time_str_from_api):
         # dt_aware = dt_naive.replace(tzinfo=timezone(timedelta(hours=7)))
         return dt_aware
     except ValueError:
-        print(f"Không thể phân tích chuỗi thời gian '{time_str_from_api}' cho source_update_time.")
+        logger.warning(f"Không thể phân tích chuỗi thời gian '{time_str_from_api}' cho source_update_time.")
         return None
 
 
+# Ghi vào bảng lịch sử và upsert bảng "mới nhất" trong cùng MỘT câu lệnh (CTE).
+# Bản ghi mới nhất chỉ bị ghi đè khi bản ghi mới không cũ hơn (so theo thời gian cập nhật của nguồn),
+# nên dữ liệu lịch sử nạp bù (backfill) không đè lên tỷ giá hiện tại.
+# {values} được thay bằng _ROW_TEMPLATE (một dòng) hoặc "%s" (execute_values, nhiều dòng).
+_INSERT_EXCHANGE_RATES_SQL = """
+WITH inserted AS (
+    INSERT INTO ExchangeRates 
+        (currency_id, buy_cash, buy_transfer, sell, source_update_time, date_recorded)
+    VALUES {values}
+    RETURNING currency_id, buy_cash, buy_transfer, sell, date_recorded, source_update_time
+)
+INSERT INTO LatestExchangeRates AS l
+    (currency_id, buy_cash, buy_transfer, sell, date_recorded, source_update_time)
+SELECT DISTINCT ON (currency_id)
+    currency_id, buy_cash, buy_transfer, sell, date_recorded, source_update_time
+FROM inserted
+ORDER BY currency_id, COALESCE(source_update_time, date_recorded) DESC
+ON CONFLICT (currency_id) DO UPDATE SET
+    buy_cash = EXCLUDED.buy_cash,
+    buy_transfer = EXCLUDED.buy_transfer,
+    sell = EXCLUDED.sell,
+    date_recorded = EXCLUDED.date_recorded,
+    source_update_time = EXCLUDED.source_update_time
+WHERE COALESCE(EXCLUDED.source_update_time, EXCLUDED.date_recorded)
+   >= COALESCE(l.source_update_time, l.date_recorded)
+"""
+
+_INSERT_GOLD_PRICES_SQL = """
+WITH inserted AS (
+    INSERT INTO GoldPrices 
+        (gold_type_id, buy_price, sell_price, unit, source_update_time, date_recorded)
+    VALUES {values}
+    RETURNING id, gold_type_id, buy_price, sell_price, unit, date_recorded, source_update_time
+)
+INSERT INTO LatestGoldPrices AS l
+    (gold_type_id, gold_price_id, buy_price, sell_price, unit, date_recorded, source_update_time)
+SELECT DISTINCT ON (gold_type_id)
+    gold_type_id, id, buy_price, sell_price, unit, date_recorded, source_update_time
+FROM inserted
+ORDER BY gold_type_id, COALESCE(source_update_time, date_recorded) DESC, id DESC
+ON CONFLICT (gold_type_id) DO UPDATE SET
+    gold_price_id = EXCLUDED.gold_price_id,
+    buy_price = EXCLUDED.buy_price,
+    sell_price = EXCLUDED.sell_price,
+    unit = EXCLUDED.unit,
+    date_recorded = EXCLUDED.date_recorded,
+    source_update_time = EXCLUDED.source_update_time
+WHERE COALESCE(EXCLUDED.source_update_time, EXCLUDED.date_recorded)
+   >= COALESCE(l.source_update_time, l.date_recorded)
+"""
+
+# date_recorded NULL nghĩa là "thời điểm ghi" (CURRENT_TIMESTAMP); dữ liệu nạp bù truyền thời điểm lịch sử
+_ROW_TEMPLATE = "(%s, %s, %s, %s, %s, COALESCE(%s::timestamptz, CURRENT_TIMESTAMP))"
+
+
+def _lock_for_ingest(cursor):
+    """Giữ khóa advisory dạng shared đến hết transaction ghi lịch sử (xem INGEST_ADVISORY_LOCK)."""
+    cursor.execute("SELECT pg_advisory_xact_lock_shared(%s)", (INGEST_ADVISORY_LOCK,))
+
+
+@metrics.timed_db
 def insert_exchange_rate(currency_id, buy_cash, buy_transfer, sell, source_update_time_str):
     """Chèn một bản ghi tỷ giá mới vào bảng ExchangeRates trong PostgreSQL."""
-    conn = None
     try:
-        conn = get_db_connection()
         # date_recorded sẽ được PostgreSQL tự động gán với DEFAULT CURRENT_TIMESTAMP (bao gồm múi giờ)
-        
         source_update_time_aware = _parse_datetime_for_postgres(source_update_time_str)
 
-        with conn.cursor() as cursor:
-            sql = """
-            INSERT INTO ExchangeRates 
-                (currency_id, buy_cash, buy_transfer, sell, source_update_time)
-            VALUES (%s, %s, %s, %s, %s) 
-            """
-            # psycopg2 sẽ tự động chuyển None thành NULL trong SQL.
-            # Kiểu NUMERIC trong PG sẽ chấp nhận float từ Python.
-            # Kiểu TIMESTAMP WITH TIME ZONE sẽ chấp nhận datetime object "aware".
-            cursor.execute(sql, (
-                currency_id,
-                buy_cash,
-                buy_transfer,
-                sell,
-                source_update_time_aware
-            ))
-        conn.commit()
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                _lock_for_ingest(cursor)
+                # Ghi lịch sử và cập nhật LatestExchangeRates trong cùng câu lệnh
+                sql = _INSERT_EXCHANGE_RATES_SQL.format(values=_ROW_TEMPLATE)
+                # psycopg2 sẽ tự động chuyển None thành NULL trong SQL.
+                # Kiểu NUMERIC trong PG sẽ chấp nhận float từ Python.
+                # Kiểu TIMESTAMP WITH TIME ZONE sẽ chấp nhận datetime object "aware".
+                cursor.execute(sql, (
+                    currency_id,
+                    buy_cash,
+                    buy_transfer,
+                    sell,
+                    source_update_time_aware,
+                    None # date_recorded: thời điểm ghi
+                ))
     except psycopg2.Error as e:
-        print(f"Lỗi khi chèn tỷ giá vào PostgreSQL cho currency_id {currency_id}: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Lỗi khi chèn tỷ giá vào PostgreSQL cho currency_id {currency_id}: {e}")
+
+def _snapshot_hash(rows):
+    """Hash SHA-256 ổn định (không phụ thuộc thứ tự) của các dòng trong một snapshot."""
+    canonical = json.dumps(sorted(rows, key=repr), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
 
+
+def _snapshot_is_unchanged(cursor, source, source_update_time_aware, content_hash, row_count):
+    """
+    So sánh snapshot mới với snapshot gần nhất đã lưu của `source` bằng MỘT câu upsert vào SourceSnapshots.
+    Snapshot được coi là không đổi khi cả thời gian cập nhật của nguồn lẫn hash nội dung đều trùng;
+    khi đó chỉ last_seen/seen_count được cập nhật (heartbeat) và hàm trả về True.
+    """
+    cursor.execute("""
+        INSERT INTO SourceSnapshots AS s (source, source_update_time, content_hash, row_count)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (source) DO UPDATE SET
+            seen_count = CASE WHEN s.content_hash = EXCLUDED.content_hash
+                               AND s.source_update_time IS NOT DISTINCT FROM EXCLUDED.source_update_time
+                              THEN s.seen_count + 1 ELSE 1 END,
+            first_seen = CASE WHEN s.content_hash = EXCLUDED.content_hash
+                               AND s.source_update_time IS NOT DISTINCT FROM EXCLUDED.source_update_time
+                              THEN s.first_seen ELSE CURRENT_TIMESTAMP END,
+            last_seen = CURRENT_TIMESTAMP,
+            source_update_time = EXCLUDED.source_update_time,
+            content_hash = EXCLUDED.content_hash,
+            row_count = EXCLUDED.row_count
+        RETURNING seen_count
+    """, (source, source_update_time_aware, content_hash, row_count))
+    return cursor.fetchone()[0] > 1
+
+
+def _resolve_currency_ids(cursor, rates):
+    """
+    Trả về ({code: id}, {code: id mới tạo}) cho mọi mã ngoại tệ trong snapshot.
+    Mã đã có trong cache không tốn truy vấn nào; mã mới được tạo bằng một câu
+    INSERT ... ON CONFLICT DO NOTHING RETURNING. Các ID mới tạo chỉ được đưa vào cache
+    sau khi transaction commit (người gọi xử lý), tránh cache ID của dòng bị rollback.
+    """
+    if not _dimension_cache_loaded:
+        _replace_dimension_cache(*_load_dimension_ids(cursor))
+
+    names_by_code = {rate['code']: rate['name'] for rate in rates}
+    currency_ids = {code: _currency_id_cache[code] for code in names_by_code if code in _currency_id_cache}
+    missing = [(code, name) for code, name in names_by_code.items() if code not in currency_ids]
+    if not missing:
+        return currency_ids, {}
+
+    created = dict(psycopg2.extras.execute_values(
+        cursor,
+        "INSERT INTO Currencies (code, name) VALUES %s ON CONFLICT DO NOTHING RETURNING code, id",
+        missing,
+        page_size=len(missing),
+        fetch=True
+    ))
+    currency_ids.update(created)
+    conflicted = [code for code, _ in missing if code not in created]
+    if conflicted:
+        # Tiến trình khác đã tạo các mã này -> cache đã lỗi thời, bỏ đi và lấy lại ID
+        invalidate_dimension_cache()
+        cursor.execute("SELECT code, id FROM Currencies WHERE code = ANY(%s)", (conflicted,))
+        existing = dict(cursor.fetchall())
+        currency_ids.update(existing)
+        _remember_dimension_ids(currencies=existing)
+    return currency_ids, created
+
+
+def _insert_exchange_rate_rows(cursor, rates, currency_ids, source_update_time_aware, date_recorded=None):
+    """
+    Ghi các dòng tỷ giá bằng một câu INSERT nhiều dòng (multi-row VALUES), đồng thời cập nhật
+    LatestExchangeRates. Trả về số dòng đã ghi.
+    """
+    rows = []
+    for rate_data in rates:
+        currency_id = currency_ids.get(rate_data['code'])
+        if currency_id is None:
+            logger.warning(f"Không thể lấy hoặc tạo currency_id cho {rate_data['code']} trong PostgreSQL.")
+            continue
+        rows.append((
+            currency_id,
+            rate_data['buy_cash'],
+            rate_data['buy_transfer'],
+            rate_data['sell'],
+            source_update_time_aware,
+            date_recorded
+        ))
+    if rows:
+        _lock_for_ingest(cursor)
+        psycopg2.extras.execute_values(
+            cursor,
+            _INSERT_EXCHANGE_RATES_SQL.format(values="%s"), # Kèm upsert LatestExchangeRates
+            rows,
+            template=_ROW_TEMPLATE,
+            page_size=len(rows) # Gửi cả snapshot trong một câu lệnh
+        )
+    return len(rows)
+
+
+@metrics.timed_db
+def insert_exchange_rates_batch(rates, source_update_time_str, source='VCB', detect_changes=True, date_recorded=None):
+    """
+    Ghi toàn bộ snapshot tỷ giá (danh sách dict do scraper_vcb trả về) trong MỘT transaction.
+    Hoặc tất cả các dòng được ghi, hoặc không dòng nào (all-or-nothing).
+    Với detect_changes=True, snapshot trùng thời gian cập nhật và nội dung với snapshot
+    gần nhất của `source` không được ghi lại, chỉ ghi nhận heartbeat "last seen".
+    date_recorded (datetime có múi giờ) ghi đè thời điểm ghi nhận, dùng khi nạp bù dữ liệu lịch sử;
+    mặc định là thời điểm ghi vào CSDL.
+    Trả về số bản ghi đã ghi (0 nếu snapshot không đổi hoặc có lỗi).
+    """
+    if not rates:
+        return 0
+    source_update_time_aware = _parse_datetime_for_postgres(source_update_time_str)
+    content_hash = _snapshot_hash(
+        [(r['code'], r['buy_cash'], r['buy_transfer'], r['sell']) for r in rates]
+    ) if detect_changes else None
+    for attempt in range(2):
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as cursor:
+                    if detect_changes and _snapshot_is_unchanged(
+                            cursor, source, source_update_time_aware, content_hash, len(rates)):
+                        logger.debug(f"Snapshot tỷ giá {source} không đổi, chỉ ghi nhận heartbeat.",
+                                     extra={'source': source, 'source_update_time': source_update_time_str})
+                        metrics.record_snapshot(source, len(rates), 0)
+                        return 0
+                    currency_ids, created_ids = _resolve_currency_ids(cursor, rates)
+                    inserted = _insert_exchange_rate_rows(
+                        cursor, rates, currency_ids, source_update_time_aware, date_recorded
+                    )
+            _remember_dimension_ids(currencies=created_ids)
+            metrics.record_snapshot(source, len(rates), inserted)
+            return inserted
+        except psycopg2.errors.ForeignKeyViolation as e:
+            # ID trong cache trỏ tới dòng đã bị xóa: bỏ cache rồi thử lại một lần
+            invalidate_dimension_cache()
+            if attempt == 0:
+                continue
+            logger.error(f"Lỗi khi ghi snapshot {len(rates)} tỷ giá vào PostgreSQL (đã rollback toàn bộ): {e}")
+        except psycopg2.Error as e:
+            logger.error(f"Lỗi khi ghi snapshot {len(rates)} tỷ giá vào PostgreSQL (đã rollback toàn bộ): {e}")
+            break
+    metrics.record_snapshot(source, len(rates), None)
+    return 0
+
+@metrics.timed_db
+def has_exchange_rates_at(source_update_time_str):
+    """Kiểm tra đã có bản ghi tỷ giá nào với thời gian cập nhật của nguồn này chưa (dùng index source_update_time)."""
+    source_update_time_aware = _parse_datetime_for_postgres(source_update_time_str)
+    if source_update_time_aware is None:
+        return False
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT EXISTS (SELECT 1 FROM ExchangeRates WHERE source_update_time = %s)",
+                    (source_update_time_aware,)
+                )
+                return cursor.fetchone()[0]
+    except psycopg2.Error as e:
+        logger.error(f"Lỗi khi kiểm tra tỷ giá đã tồn tại trong PostgreSQL: {e}")
+        return False
+
+@metrics.timed_db
 def get_latest_rates():
-    """Lấy các bản ghi tỷ giá mới nhất cho mỗi loại tiền tệ từ PostgreSQL."""
-    conn = None
+    """
+    Lấy các bản ghi tỷ giá mới nhất cho mỗi loại tiền tệ từ PostgreSQL.
+    Đọc từ LatestExchangeRates (một dòng cho mỗi ngoại tệ), nên chi phí không tăng theo độ dài lịch sử.
+    """
     rates = []
     try:
-        conn = get_db_connection()
-        # Sử dụng RealDictCursor để lấy kết quả dưới dạng dictionary (giống đối tượng hơn)
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-            # DISTINCT ON (column) chỉ giữ lại hàng đầu tiên cho mỗi nhóm giá trị duy nhất của column
-            # sau khi đã ORDER BY.
-            query = """
-            SELECT DISTINCT ON (c.code)
-                c.name AS currency_name, 
-                c.code AS currency_code, 
-                er.buy_cash, 
-                er.buy_transfer, 
-                er.sell, 
-                er.date_recorded,  -- Thời gian ứng dụng ghi vào DB (đã có múi giờ)
-                er.source_update_time -- Thời gian VCB cập nhật (đã có múi giờ)
-            FROM ExchangeRates er
-            JOIN Currencies c ON er.currency_id = c.id
-            ORDER BY c.code, er.date_recorded DESC, er.id DESC; 
-            -- Sắp xếp theo code, sau đó theo date_recorded mới nhất, rồi id mới nhất (để đảm bảo tính duy nhất nếu date_recorded trùng)
-            """
-            cursor.execute(query)
-            rates = cursor.fetchall() # Trả về list của các RealDictRow
+        with db_connection() as conn:
+            # Sử dụng RealDictCursor để lấy kết quả dưới dạng dictionary (giống đối tượng hơn)
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                query = """
+                SELECT
+                    c.name AS currency_name, 
+                    c.code AS currency_code, 
+                    ler.buy_cash, 
+                    ler.buy_transfer, 
+                    ler.sell, 
+                    ler.date_recorded,  -- Thời gian ứng dụng ghi vào DB (đã có múi giờ)
+                    ler.source_update_time -- Thời gian VCB cập nhật (đã có múi giờ)
+                FROM LatestExchangeRates ler
+                JOIN Currencies c ON ler.currency_id = c.id
+                ORDER BY c.code;
+                """
+                cursor.execute(query)
+                rates = cursor.fetchall() # Trả về list của các RealDictRow
     except psycopg2.Error as e:
-        print(f"Lỗi khi lấy tỷ giá mới nhất từ PostgreSQL: {e}")
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Lỗi khi lấy tỷ giá mới nhất từ PostgreSQL: {e}")
     return rates
 
-def create_gold_tables():
+@metrics.timed_db
+def get_latest_rates_version():
     """
-    Tạo các bảng liên quan đến giá vàng trong PostgreSQL nếu chúng chưa tồn tại.
+    (thời điểm ghi mới nhất, số ngoại tệ) của LatestExchangeRates: đổi mỗi khi có snapshot tỷ giá mới được ghi.
+    Rẻ hơn nhiều so với đọc lại toàn bộ tỷ giá; None nếu lỗi CSDL.
     """
-    sql_script = """
-    CREATE TABLE IF NOT EXISTS GoldTypes (
-        id SERIAL PRIMARY KEY,
-        name VARCHAR(255) NOT NULL,  -- Đổi full_name thành name
-        original_type VARCHAR(255) NOT NULL,  -- Đổi original_type_name thành original_type
-        city VARCHAR(100),  -- Đổi city_name thành city
-        provider VARCHAR(50) NOT NULL,
-        UNIQUE(name, provider)
-    );
-
-    CREATE TABLE IF NOT EXISTS GoldPrices (
-        id SERIAL PRIMARY KEY,
-        gold_type_id INTEGER NOT NULL,
-        date_recorded TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
-        buy_price NUMERIC(18, 4),
-        sell_price NUMERIC(18, 4),
-        unit VARCHAR(20) NOT NULL,
-        source_update_time TIMESTAMP WITH TIME ZONE,
-        CONSTRAINT fk_gold_type
-            FOREIGN KEY (gold_type_id)
-            REFERENCES GoldTypes (id)
-            ON DELETE CASCADE
-    );
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT MAX(date_recorded), COUNT(*) FROM LatestExchangeRates")
+                return cursor.fetchone()
+    except psycopg2.Error as e:
+        logger.error(f"Lỗi khi kiểm tra phiên bản tỷ giá mới nhất: {e}")
+        return None
 
-    CREATE INDEX IF NOT EXISTS idx_goldtypes_provider ON GoldTypes (provider);
-    CREATE INDEX IF NOT EXISTS idx_goldprices_gold_type_id ON GoldPrices (gold_type_id);
-    CREATE INDEX IF NOT EXISTS idx_goldprices_date_recorded ON GoldPrices (date_recorded DESC);
-    CREATE INDEX IF NOT EXISTS idx_goldprices_source_update_time ON GoldPrices (source_update_time DESC);
-    """
-    conn = None
+def _fetch_history(query, params, what):
+    rows = []
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(sql_script)
-        conn.commit()
-        print(f"Đã kiểm tra/khởi tạo bảng giá vàng trong PostgreSQL database '{DB_NAME}'.")
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
     except psycopg2.Error as e:
-        print(f"Lỗi khi tạo bảng giá vàng trong PostgreSQL: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Lỗi khi đọc lịch sử {what} từ PostgreSQL: {e}")
+    return rows
 
+@metrics.timed_db
+def get_exchange_rate_history(code, start=None, end=None, limit=None):
+    """
+    Lấy lịch sử tỷ giá của một ngoại tệ với date_recorded trong [start, end) (bỏ trống để không giới hạn),
+    sắp xếp theo thời gian tăng dần; `limit` giới hạn số dòng mới nhất được trả về.
+    Điều kiện trên date_recorded cho phép chỉ quét các partition liên quan.
+    """
+    return _fetch_history("""
+        SELECT * FROM (
+            SELECT c.code AS currency_code, er.buy_cash, er.buy_transfer, er.sell,
+                   er.date_recorded, er.source_update_time
+            FROM ExchangeRates er
+            JOIN Currencies c ON c.id = er.currency_id
+            WHERE c.code = %(code)s
+              AND (%(start)s::timestamptz IS NULL OR er.date_recorded >= %(start)s)
+              AND (%(end)s::timestamptz IS NULL OR er.date_recorded < %(end)s)
+            ORDER BY er.date_recorded DESC
+            LIMIT %(limit)s
+        ) h
+        ORDER BY h.date_recorded
+    """, {'code': code, 'start': start, 'end': end, 'limit': limit}, 'tỷ giá')
+
+def _as_of_time(value):
+    """datetime (hoặc chuỗi ISO 8601) có múi giờ; thời điểm không có múi giờ được hiểu là giờ Việt Nam."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=PARTITION_TIMEZONE)
+    return value
+
+@metrics.timed_db
+def get_exchange_rates_as_of(queries):
+    """
+    Tỷ giá có hiệu lực tại nhiều thời điểm, trong MỘT truy vấn: queries là các cặp (mã ngoại tệ, thời điểm).
+    Tỷ giá có hiệu lực tại thời điểm t là bản ghi có source_update_time mới nhất nhưng không sau t.
+    Trả về list dict cùng thứ tự, cùng độ dài với queries (currency_code, at, buy_cash, buy_transfer, sell,
+    source_update_time, date_recorded); các trường tỷ giá là None nếu không có tỷ giá nào trước t
+    hoặc mã ngoại tệ không tồn tại. Mỗi cặp là một lần dò index (currency_id, source_update_time).
+    Lỗi CSDL được ném ra (kết quả thiếu sẽ làm lệch thứ tự với queries).
+    """
+    codes, times = [], []
+    for code, at in queries:
+        codes.append(code.upper())
+        times.append(_as_of_time(at))
+    if not codes:
+        return []
+    with db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute("""
+                SELECT q.code AS currency_code, q.at, r.buy_cash, r.buy_transfer, r.sell,
+                       r.source_update_time, r.date_recorded
+                FROM unnest(%s::text[], %s::timestamptz[]) WITH ORDINALITY AS q (code, at, ord)
+                LEFT JOIN Currencies c ON c.code = q.code
+                LEFT JOIN LATERAL (
+                    SELECT er.buy_cash, er.buy_transfer, er.sell, er.source_update_time, er.date_recorded
+                    FROM ExchangeRates er
+                    WHERE er.currency_id = c.id AND er.source_update_time <= q.at
+                    ORDER BY er.source_update_time DESC, er.date_recorded DESC
+                    LIMIT 1
+                ) r ON TRUE
+                ORDER BY q.ord
+            """, (codes, times))
+            return cursor.fetchall()
+
+@metrics.timed_db
 def get_or_create_gold_type(full_name, original_type_name, city_name, provider='SJC'):
     """
     Lấy ID của một loại vàng dựa trên tên đầy đủ (tham số full_name của Python, ứng với cột 'name' trong DB).
     Nếu không tồn tại, tạo mới và trả về ID.
+    ID đã biết được lấy thẳng từ cache trong bộ nhớ, không truy vấn CSDL.
     """
-    conn = None
-    gold_type_id = None
+    gold_type_id = _gold_type_id_cache.get((full_name, provider))
+    if gold_type_id is not None:
+        return gold_type_id
     try:
-        conn = get_db_connection()
-        if conn is None: # Thêm kiểm tra nếu get_db_connection có thể trả về None
-            raise ConnectionError("Không thể kết nối đến cơ sở dữ liệu.")
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                # Sử dụng cột 'name' trong câu lệnh SQL, giá trị lấy từ biến Python 'full_name'
+                sql_select = "SELECT id FROM GoldTypes WHERE name = %s AND provider = %s"
+                cursor.execute(sql_select, (full_name, provider))
+                row = cursor.fetchone()
+                
+                if row:
+                    gold_type_id = row[0]
+                else:
+                    try:
+                        # Sử dụng cột 'name' trong câu lệnh SQL INSERT
+                        sql_insert = """INSERT INTO GoldTypes (name, original_type_name, city_name, provider) 
+                                        VALUES (%s, %s, %s, %s) RETURNING id"""
+                        cursor.execute(sql_insert, (full_name, original_type_name, city_name, provider))
+                        result = cursor.fetchone()
+                        if result:
+                            gold_type_id = result[0]
+                            conn.commit()
+                            # print(f"Đã thêm loại vàng mới: {full_name} (Provider: {provider}) với ID {gold_type_id}")
+                        else:
+                            # Trường hợp hiếm khi RETURNING id không trả về gì dù không có lỗi
+                            conn.rollback() # Rollback nếu không lấy được ID
+                            logger.error(f"Lỗi: Không nhận được ID sau khi INSERT GoldType '{full_name}'.")
 
-        with conn.cursor() as cursor:
-            # Sử dụng cột 'name' trong câu lệnh SQL, giá trị lấy từ biến Python 'full_name'
-            sql_select = "SELECT id FROM GoldTypes WHERE name = %s AND provider = %s"
-            cursor.execute(sql_select, (full_name, provider))
-            row = cursor.fetchone()
-            
-            if row:
-                gold_type_id = row[0]
-            else:
-                try:
-                    # Sử dụng cột 'name' trong câu lệnh SQL INSERT
-                    sql_insert = """INSERT INTO GoldTypes (name, original_type_name, city_name, provider) 
-                                    VALUES (%s, %s, %s, %s) RETURNING id"""
-                    cursor.execute(sql_insert, (full_name, original_type_name, city_name, provider))
-                    result = cursor.fetchone()
-                    if result:
-                        gold_type_id = result[0]
-                        conn.commit()
-                        # print(f"Đã thêm loại vàng mới: {full_name} (Provider: {provider}) với ID {gold_type_id}")
-                    else:
-                        # Trường hợp hiếm khi RETURNING id không trả về gì dù không có lỗi
-                        conn.rollback() # Rollback nếu không lấy được ID
-                        print(f"Lỗi: Không nhận được ID sau khi INSERT GoldType '{full_name}'.")
-
-                except psycopg2.errors.UniqueViolation:
-                    conn.rollback() # Quan trọng: rollback transaction bị lỗi
-                    # print(f"Thông tin: Loại vàng '{full_name}' (Provider: {provider}) đã tồn tại do race condition hoặc đã được thêm trước đó.")
-                    # Thử lấy lại ID một lần nữa sau khi rollback
-                    cursor.execute(sql_select, (full_name, provider)) # Dùng lại sql_select
-                    row_after_conflict = cursor.fetchone()
-                    if row_after_conflict:
-                        gold_type_id = row_after_conflict[0]
-                    else:
-                        # Điều này không nên xảy ra nếu UniqueViolation là do 'name' và 'provider'
-                        print(f"LỖI NGHIÊM TRỌNG: Không tìm thấy GoldType '{full_name}' sau khi xử lý UniqueViolation.")
-                except psycopg2.Error as e_insert:
-                    conn.rollback()
-                    print(f"Lỗi khi INSERT GoldType '{full_name}': {e_insert}")
+                    except psycopg2.errors.UniqueViolation:
+                        conn.rollback() # Quan trọng: rollback transaction bị lỗi
+                        # print(f"Thông tin: Loại vàng '{full_name}' (Provider: {provider}) đã tồn tại do race condition hoặc đã được thêm trước đó.")
+                        # Thử lấy lại ID một lần nữa sau khi rollback
+                        cursor.execute(sql_select, (full_name, provider)) # Dùng lại sql_select
+                        row_after_conflict = cursor.fetchone()
+                        if row_after_conflict:
+                            gold_type_id = row_after_conflict[0]
+                        else:
+                            # Điều này không nên xảy ra nếu UniqueViolation là do 'name' và 'provider'
+                            logger.error(f"LỖI NGHIÊM TRỌNG: Không tìm thấy GoldType '{full_name}' sau khi xử lý UniqueViolation.")
+                    except psycopg2.Error as e_insert:
+                        conn.rollback()
+                        logger.error(f"Lỗi khi INSERT GoldType '{full_name}': {e_insert}")
                     
     except psycopg2.Error as e:
         # Bổ sung thêm thông tin vào lỗi để dễ debug hơn
-        print(f"Lỗi CSDL khi get/create GoldType '{full_name}' (Provider: {provider}). SQL SELECT: '{sql_select if 'sql_select' in locals() else 'N/A'}'. Lỗi: {e}")
-        if conn: 
-            conn.rollback()
-    except ConnectionError as e_conn: # Bắt lỗi ConnectionError đã thêm
-        print(e_conn)
-    finally:
-        if conn: 
-            conn.close()
+        logger.error(f"Lỗi CSDL khi get/create GoldType '{full_name}' (Provider: {provider}). SQL SELECT: '{sql_select if 'sql_select' in locals() else 'N/A'}'. Lỗi: {e}")
+    if gold_type_id is not None:
+        _remember_dimension_ids(gold_types={(full_name, provider): gold_type_id})
     return gold_type_id
 
+@metrics.timed_db
 def insert_gold_price(gold_type_id, buy_price, sell_price, unit, source_update_time_str):
     """Chèn một bản ghi giá vàng mới vào bảng GoldPrices trong PostgreSQL."""
-    conn = None
     try:
-        conn = get_db_connection()
         source_update_time_aware = _parse_datetime_for_postgres(source_update_time_str)
         
-        with conn.cursor() as cursor:
-            sql = """
-            INSERT INTO GoldPrices 
-                (gold_type_id, buy_price, sell_price, unit, source_update_time)
-            VALUES (%s, %s, %s, %s, %s)
-            """
-            cursor.execute(sql, (
-                gold_type_id,
-                buy_price,
-                sell_price,
-                unit,
-                source_update_time_aware
-            ))
-        conn.commit()
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                _lock_for_ingest(cursor)
+                # Ghi lịch sử và cập nhật LatestGoldPrices trong cùng câu lệnh
+                sql = _INSERT_GOLD_PRICES_SQL.format(values=_ROW_TEMPLATE)
+                cursor.execute(sql, (
+                    gold_type_id,
+                    buy_price,
+                    sell_price,
+                    unit,
+                    source_update_time_aware,
+                    None # date_recorded: thời điểm ghi
+                ))
     except psycopg2.Error as e:
-        print(f"Lỗi khi chèn giá vàng vào PostgreSQL cho gold_type_id {gold_type_id}: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Lỗi khi chèn giá vàng vào PostgreSQL cho gold_type_id {gold_type_id}: {e}")
+
+def _resolve_gold_type_ids(cursor, gold_items, provider):
+    """
+    Trả về ({name: id}, {(name, provider): id mới tạo}) cho mọi loại vàng trong snapshot
+    của nhà cung cấp `provider`. Cách dùng cache giống _resolve_currency_ids.
+    """
+    if not _dimension_cache_loaded:
+        _replace_dimension_cache(*_load_dimension_ids(cursor))
 
+    types_by_name = {
+        item['type_name']: (item['type_name'], item['original_type'], item['city'], provider)
+        for item in gold_items
+    }
+    gold_type_ids = {
+        name: _gold_type_id_cache[(name, provider)]
+        for name in types_by_name if (name, provider) in _gold_type_id_cache
+    }
+    missing = [values for name, values in types_by_name.items() if name not in gold_type_ids]
+    if not missing:
+        return gold_type_ids, {}
+
+    created = dict(psycopg2.extras.execute_values(
+        cursor,
+        """INSERT INTO GoldTypes (name, original_type_name, city_name, provider) VALUES %s
+           ON CONFLICT DO NOTHING RETURNING name, id""",
+        missing,
+        page_size=len(missing),
+        fetch=True
+    ))
+    gold_type_ids.update(created)
+    conflicted = [values[0] for values in missing if values[0] not in created]
+    if conflicted:
+        invalidate_dimension_cache()
+        cursor.execute(
+            "SELECT name, id FROM GoldTypes WHERE provider = %s AND name = ANY(%s)",
+            (provider, conflicted)
+        )
+        existing = dict(cursor.fetchall())
+        gold_type_ids.update(existing)
+        _remember_dimension_ids(gold_types={(name, provider): gold_type_id for name, gold_type_id in existing.items()})
+    return gold_type_ids, {(name, provider): gold_type_id for name, gold_type_id in created.items()}
+
+
+def _insert_gold_price_rows(cursor, gold_items, gold_type_ids, source_update_time_aware, date_recorded=None):
+    """
+    Ghi các dòng giá vàng bằng một câu INSERT nhiều dòng (multi-row VALUES), đồng thời cập nhật
+    LatestGoldPrices. Trả về số dòng đã ghi.
+    """
+    rows = []
+    for gold_item in gold_items:
+        gold_type_id = gold_type_ids.get(gold_item['type_name'])
+        if gold_type_id is None:
+            logger.warning(f"Không thể lấy hoặc tạo gold_type_id cho '{gold_item['type_name']}' trong PostgreSQL.")
+            continue
+        rows.append((
+            gold_type_id,
+            gold_item['buy'],
+            gold_item['sell'],
+            gold_item['unit'],
+            source_update_time_aware,
+            date_recorded
+        ))
+    if rows:
+        _lock_for_ingest(cursor)
+        psycopg2.extras.execute_values(
+            cursor,
+            _INSERT_GOLD_PRICES_SQL.format(values="%s"), # Kèm upsert LatestGoldPrices
+            rows,
+            template=_ROW_TEMPLATE,
+            page_size=len(rows)
+        )
+    return len(rows)
+
+
+@metrics.timed_db
+def insert_gold_prices_batch(gold_items, source_update_time_str, provider='SJC', detect_changes=True, date_recorded=None):
+    """
+    Ghi toàn bộ snapshot giá vàng (danh sách dict do sjc_gold_scraper trả về) trong MỘT transaction.
+    Hoặc tất cả các dòng được ghi, hoặc không dòng nào (all-or-nothing).
+    Với detect_changes=True, snapshot không đổi so với lần trước của `provider` chỉ được
+    ghi nhận heartbeat (xem insert_exchange_rates_batch). date_recorded: xem insert_exchange_rates_batch.
+    Trả về số bản ghi đã ghi (0 nếu snapshot không đổi hoặc có lỗi).
+    """
+    if not gold_items:
+        return 0
+    source_update_time_aware = _parse_datetime_for_postgres(source_update_time_str)
+    content_hash = _snapshot_hash(
+        [(g['type_name'], g['buy'], g['sell'], g['unit']) for g in gold_items]
+    ) if detect_changes else None
+    for attempt in range(2):
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as cursor:
+                    if detect_changes and _snapshot_is_unchanged(
+                            cursor, provider, source_update_time_aware, content_hash, len(gold_items)):
+                        logger.debug(f"Snapshot giá vàng {provider} không đổi, chỉ ghi nhận heartbeat.",
+                                     extra={'source': provider, 'source_update_time': source_update_time_str})
+                        metrics.record_snapshot(provider, len(gold_items), 0)
+                        return 0
+                    gold_type_ids, created_ids = _resolve_gold_type_ids(cursor, gold_items, provider)
+                    inserted = _insert_gold_price_rows(
+                        cursor, gold_items, gold_type_ids, source_update_time_aware, date_recorded
+                    )
+            _remember_dimension_ids(gold_types=created_ids)
+            metrics.record_snapshot(provider, len(gold_items), inserted)
+            return inserted
+        except psycopg2.errors.ForeignKeyViolation as e:
+            invalidate_dimension_cache()
+            if attempt == 0:
+                continue
+            logger.error(f"Lỗi khi ghi snapshot {len(gold_items)} giá vàng vào PostgreSQL (đã rollback toàn bộ): {e}")
+        except psycopg2.Error as e:
+            logger.error(f"Lỗi khi ghi snapshot {len(gold_items)} giá vàng vào PostgreSQL (đã rollback toàn bộ): {e}")
+            break
+    metrics.record_snapshot(provider, len(gold_items), None)
+    return 0
+
+@metrics.timed_db
 def get_latest_gold_prices():
-    """Lấy các bản ghi giá vàng mới nhất cho mỗi loại vàng từ PostgreSQL."""
-    conn = None
+    """
+    Lấy các bản ghi giá vàng mới nhất cho mỗi loại vàng từ PostgreSQL.
+    Đọc từ LatestGoldPrices (một dòng cho mỗi loại vàng), nên chi phí không tăng theo độ dài lịch sử.
+    """
     prices = []
     sql_query = "" # Khởi tạo để có thể in ra nếu lỗi
     try:
-        conn = get_db_connection()
-        if conn is None: # Thêm kiểm tra nếu get_db_connection có thể trả về None
-            raise ConnectionError("Không thể kết nối đến cơ sở dữ liệu để lấy giá vàng.")
-            
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-            # Sử dụng lại CTE của bạn, đây là một cách tốt.
-            # Sửa gt.city thành gt.city_name
-            # Và gt.name đã đúng (trước đó có thể là gt.full_name)
-            sql_query = """
-            WITH latest_prices AS (
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                sql_query = """
                 SELECT 
-                    gp.gold_type_id,
-                    MAX(gp.date_recorded) as latest_date
-                FROM GoldPrices gp
-                GROUP BY gp.gold_type_id
-            )
-            SELECT 
-                gp.id AS gold_price_id, -- Thêm bí danh để tránh trùng tên cột 'id' với GoldTypes.id
-                gp.gold_type_id,
-                gp.date_recorded,
-                gp.buy_price,
-                gp.sell_price,
-                gp.unit,
-                gp.source_update_time,
-                gt.id AS gold_type_table_id, -- Thêm bí danh để phân biệt
-                gt.name as gold_type_name,
-                gt.original_type_name, -- Thêm cột này nếu bạn muốn hiển thị tên gốc
-                gt.provider,
-                gt.city_name  -- << SỬA Ở ĐÂY: gt.city THÀNH gt.city_name
+                    lgp.gold_price_id,
+                    lgp.gold_type_id,
+                    lgp.date_recorded,
+                    lgp.buy_price,
+                    lgp.sell_price,
+                    lgp.unit,
+                    lgp.source_update_time,
+                    gt.id AS gold_type_table_id, -- Thêm bí danh để phân biệt
+                    gt.name as gold_type_name,
+                    gt.original_type_name, -- Thêm cột này nếu bạn muốn hiển thị tên gốc
+                    gt.provider,
+                    gt.city_name
+                FROM LatestGoldPrices lgp
+                JOIN GoldTypes gt ON lgp.gold_type_id = gt.id
+                ORDER BY gt.provider, gt.name; 
+                """
+                cursor.execute(sql_query)
+                prices = cursor.fetchall()
+    except psycopg2.Error as e:
+        logger.error(f"Lỗi khi lấy giá vàng mới nhất từ PostgreSQL: {e}")
+        logger.debug(f"SQL Query đã chạy (hoặc cố gắng chạy): \n{sql_query}")
+    return prices
+
+
+@metrics.timed_db
+def get_gold_price_history(gold_type_name, start=None, end=None, limit=None, provider='SJC'):
+    """Lấy lịch sử giá của một loại vàng (xem get_exchange_rate_history)."""
+    return _fetch_history("""
+        SELECT * FROM (
+            SELECT gt.name AS gold_type_name, gt.provider, gp.buy_price, gp.sell_price, gp.unit,
+                   gp.date_recorded, gp.source_update_time
             FROM GoldPrices gp
-            JOIN GoldTypes gt ON gp.gold_type_id = gt.id
-            JOIN latest_prices lp ON gp.gold_type_id = lp.gold_type_id 
-                AND gp.date_recorded = lp.latest_date
-            ORDER BY gt.provider, gt.name; 
-            """
-            cursor.execute(sql_query)
-            prices = cursor.fetchall()
+            JOIN GoldTypes gt ON gt.id = gp.gold_type_id
+            WHERE gt.name = %(name)s AND gt.provider = %(provider)s
+              AND (%(start)s::timestamptz IS NULL OR gp.date_recorded >= %(start)s)
+              AND (%(end)s::timestamptz IS NULL OR gp.date_recorded < %(end)s)
+            ORDER BY gp.date_recorded DESC
+            LIMIT %(limit)s
+        ) h
+        ORDER BY h.date_recorded
+    """, {'name': gold_type_name, 'provider': provider, 'start': start, 'end': end, 'limit': limit}, 'giá vàng')
+
+# --- Ghi hàng loạt nhiều snapshot (phát lại từ spool cục bộ) ---
+SNAPSHOT_KIND_EXCHANGE_RATES = 'exchange_rates'
+SNAPSHOT_KIND_GOLD_PRICES = 'gold_prices'
+BULK_PAGE_SIZE = 5000 # Số dòng mỗi câu INSERT nhiều dòng khi ghi hàng loạt
+
+
+def _snapshot_content_hash(kind, rows):
+    if kind == SNAPSHOT_KIND_EXCHANGE_RATES:
+        return _snapshot_hash([(r['code'], r['buy_cash'], r['buy_transfer'], r['sell']) for r in rows])
+    return _snapshot_hash([(g['type_name'], g['buy'], g['sell'], g['unit']) for g in rows])
+
+
+def _update_source_snapshot_state(cursor, source, state):
+    """Ghi trạng thái cuối của SourceSnapshots sau nhiều snapshot cùng nguồn trong một lô (xem insert_snapshots_bulk)."""
+    if state['reset'] is not None:
+        source_update_time, content_hash, row_count = state['reset']
+        cursor.execute("""
+            UPDATE SourceSnapshots SET source_update_time = %s, content_hash = %s, row_count = %s,
+                   seen_count = %s, first_seen = CURRENT_TIMESTAMP, last_seen = CURRENT_TIMESTAMP
+            WHERE source = %s
+        """, (source_update_time, content_hash, row_count, 1 + state['heartbeats'], source))
+    elif state['heartbeats']:
+        cursor.execute("""
+            UPDATE SourceSnapshots SET seen_count = seen_count + %s, last_seen = CURRENT_TIMESTAMP
+            WHERE source = %s
+        """, (state['heartbeats'], source))
+
+
+def _bulk_insert(cursor, insert_sql, rows):
+    if rows:
+        _lock_for_ingest(cursor)
+        psycopg2.extras.execute_values(
+            cursor, insert_sql.format(values="%s"), rows, template=_ROW_TEMPLATE, page_size=BULK_PAGE_SIZE
+        )
+
+
+@metrics.timed_db
+def get_spool_checkpoint(spool_id):
+    """seq lớn nhất của spool `spool_id` đã được ghi vào CSDL (0 nếu chưa có)."""
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT last_seq FROM SpoolCheckpoints WHERE spool_id = %s", (spool_id,))
+            row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+@metrics.timed_db
+def advance_spool_checkpoint(spool_id, last_seq):
+    """Dời mốc seq đã xử lý của spool mà không ghi dữ liệu (bản ghi hỏng đã được chuyển sang dead-letter)."""
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO SpoolCheckpoints (spool_id, last_seq) VALUES (%s, %s)
+                ON CONFLICT (spool_id) DO UPDATE
+                SET last_seq = GREATEST(SpoolCheckpoints.last_seq, EXCLUDED.last_seq), updated_at = CURRENT_TIMESTAMP
+            """, (spool_id, last_seq))
+
+
+@metrics.timed_db
+def insert_snapshots_bulk(snapshots, spool_id=None, last_seq=None):
+    """
+    Ghi nhiều snapshot (theo đúng thứ tự) trong MỘT transaction, dùng khi phát lại spool.
+    Mỗi snapshot là dict: source, kind ('exchange_rates' hoặc 'gold_prices'), source_update_time (chuỗi
+    như scraper trả về), fetched_at (datetime có múi giờ, dùng làm date_recorded) và rows (các dict như
+    insert_exchange_rates_batch / insert_gold_prices_batch nhận).
+
+    Phát hiện snapshot không đổi giống insert_*_batch: snapshot đầu của mỗi nguồn so với SourceSnapshots,
+    các snapshot sau so với snapshot liền trước trong lô (trong bộ nhớ). Các dòng của cả lô được ghi bằng
+    vài câu INSERT nhiều dòng cho mỗi bảng. Nếu có spool_id, SpoolCheckpoints được cập nhật thành last_seq
+    trong cùng transaction, nên phát lại lô đã commit là không thể (idempotent).
+    Trả về {source: số dòng đã ghi}; lỗi CSDL được ném ra để người gọi thử lại cả lô.
+    """
+    written = {}
+    created_currencies = {}
+    created_gold_types = {}
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                if spool_id is not None:
+                    # Khóa dòng checkpoint: hai tiến trình phát lại cùng một spool không ghi trùng
+                    cursor.execute("""
+                        INSERT INTO SpoolCheckpoints (spool_id, last_seq) VALUES (%s, 0)
+                        ON CONFLICT (spool_id) DO UPDATE SET spool_id = EXCLUDED.spool_id
+                        RETURNING last_seq
+                    """, (spool_id,))
+                    committed_seq = cursor.fetchone()[0]
+                    snapshots = [snap for snap in snapshots if snap['seq'] > committed_seq]
+
+                states = {}   # source -> {'last': (time, hash), 'reset': ..., 'heartbeats': n}
+                changed = []  # (snapshot, source_update_time) cần ghi
+                for snap in snapshots:
+                    source, rows = snap['source'], snap['rows']
+                    written.setdefault(source, 0)
+                    if not rows:
+                        continue
+                    source_update_time = _parse_datetime_for_postgres(snap['source_update_time'])
+                    content_hash = _snapshot_content_hash(snap['kind'], rows)
+                    state = states.get(source)
+                    if state is None:
+                        unchanged = _snapshot_is_unchanged(cursor, source, source_update_time, content_hash, len(rows))
+                        states[source] = {'last': (source_update_time, content_hash), 'reset': None, 'heartbeats': 0}
+                    else:
+                        unchanged = state['last'] == (source_update_time, content_hash)
+                        if unchanged:
+                            state['heartbeats'] += 1
+                        else:
+                            state.update(last=(source_update_time, content_hash), heartbeats=0,
+                                         reset=(source_update_time, content_hash, len(rows)))
+                    if not unchanged:
+                        changed.append((snap, source_update_time))
+                for source, state in states.items():
+                    _update_source_snapshot_state(cursor, source, state)
+
+                rate_snaps = [(snap, t) for snap, t in changed if snap['kind'] == SNAPSHOT_KIND_EXCHANGE_RATES]
+                gold_snaps = [(snap, t) for snap, t in changed if snap['kind'] != SNAPSHOT_KIND_EXCHANGE_RATES]
+                rate_rows = []
+                if rate_snaps:
+                    currency_ids, created_currencies = _resolve_currency_ids(
+                        cursor, [rate for snap, _ in rate_snaps for rate in snap['rows']]
+                    )
+                    for snap, source_update_time in rate_snaps:
+                        before = len(rate_rows)
+                        rate_rows.extend(
+                            (currency_ids[r['code']], r['buy_cash'], r['buy_transfer'], r['sell'],
+                             source_update_time, snap['fetched_at'])
+                            for r in snap['rows'] if r['code'] in currency_ids
+                        )
+                        written[snap['source']] += len(rate_rows) - before
+                gold_rows = []
+                for provider in dict.fromkeys(snap['source'] for snap, _ in gold_snaps):
+                    provider_snaps = [(snap, t) for snap, t in gold_snaps if snap['source'] == provider]
+                    gold_type_ids, created = _resolve_gold_type_ids(
+                        cursor, [item for snap, _ in provider_snaps for item in snap['rows']], provider
+                    )
+                    created_gold_types.update(created)
+                    for snap, source_update_time in provider_snaps:
+                        before = len(gold_rows)
+                        gold_rows.extend(
+                            (gold_type_ids[g['type_name']], g['buy'], g['sell'], g['unit'],
+                             source_update_time, snap['fetched_at'])
+                            for g in snap['rows'] if g['type_name'] in gold_type_ids
+                        )
+                        written[provider] += len(gold_rows) - before
+                _bulk_insert(cursor, _INSERT_EXCHANGE_RATES_SQL, rate_rows)
+                _bulk_insert(cursor, _INSERT_GOLD_PRICES_SQL, gold_rows)
+
+                if spool_id is not None and last_seq is not None:
+                    cursor.execute("""
+                        UPDATE SpoolCheckpoints SET last_seq = GREATEST(last_seq, %s), updated_at = CURRENT_TIMESTAMP
+                        WHERE spool_id = %s
+                    """, (last_seq, spool_id))
+    except psycopg2.errors.ForeignKeyViolation:
+        invalidate_dimension_cache() # ID trong cache trỏ tới dòng đã bị xóa; lần thử sau đọc lại
+        raise
+    _remember_dimension_ids(currencies=created_currencies, gold_types=created_gold_types)
+    return written
+
+
+@metrics.timed_db
+def get_recent_quotes(per_instrument):
+    """
+    Tối đa per_instrument dòng gần nhất của mỗi ngoại tệ và mỗi loại vàng, cũ trước mới sau
+    (dùng để khởi tạo trạng thái của anomaly.QuoteValidator một lần lúc khởi động).
+    Trả về (rates, gold): rates gồm currency_code, buy_cash, buy_transfer, sell;
+    gold gồm provider, gold_type_name, buy_price, sell_price. Lỗi CSDL được ném ra.
+    """
+    with db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            # Mỗi ngoại tệ: dò index (currency_id, source_update_time) từ cuối
+            cursor.execute("""
+                SELECT c.code AS currency_code, h.buy_cash, h.buy_transfer, h.sell
+                FROM Currencies c
+                CROSS JOIN LATERAL (
+                    SELECT er.buy_cash, er.buy_transfer, er.sell, er.source_update_time, er.date_recorded
+                    FROM ExchangeRates er
+                    WHERE er.currency_id = c.id AND er.source_update_time IS NOT NULL
+                    ORDER BY er.source_update_time DESC, er.date_recorded DESC
+                    LIMIT %(limit)s
+                ) h
+                ORDER BY c.code, h.source_update_time, h.date_recorded
+            """, {'limit': per_instrument})
+            rates = cursor.fetchall()
+            # GoldPrices không có index theo (gold_type_id, thời gian): đọc lùi theo id (thứ tự ghi)
+            cursor.execute("""
+                SELECT gt.provider, gt.name AS gold_type_name, h.buy_price, h.sell_price
+                FROM GoldTypes gt
+                CROSS JOIN LATERAL (
+                    SELECT gp.id, gp.buy_price, gp.sell_price
+                    FROM GoldPrices gp
+                    WHERE gp.gold_type_id = gt.id
+                    ORDER BY gp.id DESC
+                    LIMIT %(limit)s
+                ) h
+                ORDER BY gt.provider, gt.name, h.id
+            """, {'limit': per_instrument})
+            return rates, cursor.fetchall()
+
+@metrics.timed_db
+def insert_quarantined_quotes(records):
+    """
+    Ghi các dòng giá bất thường vào QuarantinedQuotes. records: các dict có source, kind, instrument,
+    action, reasons (list), row (dict dòng của snapshot), source_update_time (chuỗi như scraper trả về).
+    """
+    if not records:
+        return 0
+    values = [(
+        record['source'], record['kind'], record['instrument'], record['action'], ', '.join(record['reasons']),
+        json.dumps(record['row'], ensure_ascii=False, default=str),
+        _parse_datetime_for_postgres(record['source_update_time'])
+    ) for record in records]
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            psycopg2.extras.execute_values(cursor, """
+                INSERT INTO QuarantinedQuotes (source, kind, instrument, action, reasons, row_data, source_update_time)
+                VALUES %s
+            """, values)
+    return len(values)
+
+@metrics.timed_db
+def rebuild_latest_tables():
+    """
+    Dựng lại LatestExchangeRates và LatestGoldPrices từ toàn bộ lịch sử (quét cả bảng một lần).
+    Dùng khi mới nâng cấp database đã có dữ liệu, hoặc khi nghi ngờ bảng "mới nhất" lệch với lịch sử.
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO LatestExchangeRates
+                        (currency_id, buy_cash, buy_transfer, sell, date_recorded, source_update_time)
+                    SELECT DISTINCT ON (currency_id)
+                        currency_id, buy_cash, buy_transfer, sell, date_recorded, source_update_time
+                    FROM ExchangeRates
+                    ORDER BY currency_id, COALESCE(source_update_time, date_recorded) DESC, id DESC
+                    ON CONFLICT (currency_id) DO UPDATE SET
+                        buy_cash = EXCLUDED.buy_cash,
+                        buy_transfer = EXCLUDED.buy_transfer,
+                        sell = EXCLUDED.sell,
+                        date_recorded = EXCLUDED.date_recorded,
+                        source_update_time = EXCLUDED.source_update_time
+                """)
+                rates_count = cursor.rowcount
+                cursor.execute("""
+                    INSERT INTO LatestGoldPrices
+                        (gold_type_id, gold_price_id, buy_price, sell_price, unit, date_recorded, source_update_time)
+                    SELECT DISTINCT ON (gold_type_id)
+                        gold_type_id, id, buy_price, sell_price, unit, date_recorded, source_update_time
+                    FROM GoldPrices
+                    ORDER BY gold_type_id, COALESCE(source_update_time, date_recorded) DESC, id DESC
+                    ON CONFLICT (gold_type_id) DO UPDATE SET
+                        gold_price_id = EXCLUDED.gold_price_id,
+                        buy_price = EXCLUDED.buy_price,
+                        sell_price = EXCLUDED.sell_price,
+                        unit = EXCLUDED.unit,
+                        date_recorded = EXCLUDED.date_recorded,
+                        source_update_time = EXCLUDED.source_update_time
+                """)
+                gold_count = cursor.rowcount
+        logger.info(f"Đã dựng lại bảng mới nhất: {rates_count} ngoại tệ, {gold_count} loại vàng.")
     except psycopg2.Error as e:
-        print(f"Lỗi khi lấy giá vàng mới nhất từ PostgreSQL: {e}")
-        print(f"SQL Query đã chạy (hoặc cố gắng chạy): \n{sql_query}") # In ra câu query để debug
-    except ConnectionError as e_conn:
-        print(e_conn)
+        logger.error(f"Lỗi khi dựng lại bảng tỷ giá/giá vàng mới nhất: {e}")
+
+
+# --- Nến OHLC (rollup tăng dần) ---
+# Bảng lịch sử -> (bảng nến, cột định danh instrument, cột giá dùng để dựng nến)
+_CANDLE_SOURCES = {
+    'ExchangeRates': ('ExchangeRateCandles', 'currency_id', 'sell'),
+    'GoldPrices': ('GoldPriceCandles', 'gold_type_id', 'sell_price'),
+}
+
+# Gộp các tick có id trong (from_id, to_id] thành nến cho mọi khung thời gian, rồi trộn vào nến đã có:
+# high/low lấy max/min, open/close lấy theo tick sớm/muộn nhất, tick_count cộng dồn.
+# Thời điểm của tick là thời gian cập nhật của nguồn (hoặc thời điểm ghi nếu không có).
+_CANDLE_ROLLUP_SQL = """
+WITH ticks AS (
+    SELECT {instrument} AS instrument_id, {price} AS price,
+           COALESCE(source_update_time, date_recorded) AS tick_time, id
+    FROM {history}
+    WHERE id > %(from_id)s AND id <= %(to_id)s AND {price} IS NOT NULL
+),
+bucketed AS (
+    SELECT t.instrument_id, r.resolution, t.price, t.tick_time, t.id,
+           date_trunc(r.unit, t.tick_time AT TIME ZONE %(tz)s) AT TIME ZONE %(tz)s AS bucket_start
+    FROM ticks t
+    CROSS JOIN (VALUES {resolutions}) AS r(resolution, unit)
+)
+INSERT INTO {candles} AS c
+    ({instrument}, resolution, bucket_start, open, high, low, close, tick_count, open_time, close_time)
+SELECT instrument_id, resolution, bucket_start,
+       (array_agg(price ORDER BY tick_time, id))[1],
+       MAX(price),
+       MIN(price),
+       (array_agg(price ORDER BY tick_time DESC, id DESC))[1],
+       COUNT(*),
+       MIN(tick_time),
+       MAX(tick_time)
+FROM bucketed
+GROUP BY instrument_id, resolution, bucket_start
+ON CONFLICT ({instrument}, resolution, bucket_start) DO UPDATE SET
+    open = CASE WHEN EXCLUDED.open_time < c.open_time THEN EXCLUDED.open ELSE c.open END,
+    open_time = LEAST(c.open_time, EXCLUDED.open_time),
+    high = GREATEST(c.high, EXCLUDED.high),
+    low = LEAST(c.low, EXCLUDED.low),
+    close = CASE WHEN EXCLUDED.close_time >= c.close_time THEN EXCLUDED.close ELSE c.close END,
+    close_time = GREATEST(c.close_time, EXCLUDED.close_time),
+    tick_count = c.tick_count + EXCLUDED.tick_count
+"""
+
+
+def _rollup_upper_bound(cursor, history_table):
+    """
+    Id lớn nhất có thể rollup an toàn: lấy khóa advisory exclusive trong chốc lát để chờ các
+    transaction ghi đang dở commit xong, nhờ vậy không dòng nào có id nhỏ hơn mốc này xuất hiện sau đó.
+    """
+    cursor.execute("SELECT pg_advisory_lock(%s)", (INGEST_ADVISORY_LOCK,))
+    try:
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {history_table}")
+        return cursor.fetchone()[0]
     finally:
-        if conn:
-            conn.close()
-    return prices
\ No newline at end of file
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (INGEST_ADVISORY_LOCK,))
+
+
+@metrics.timed_db
+def update_candles(batch_size=None):
+    """
+    Cập nhật tăng dần các bảng nến OHLC (1m/1h/1d) từ các tick mới kể từ watermark.
+    Chỉ những nến có tick mới mới bị ghi; mỗi lô tối đa `batch_size` id được xử lý và
+    dời watermark trong cùng một transaction. Trả về số tick đã xử lý.
+    """
+    batch_size = ROLLUP_BATCH_SIZE if batch_size is None else batch_size
+    resolutions = ", ".join(f"('{name}', '{unit}')" for name, unit in CANDLE_RESOLUTIONS.items())
+    processed = 0
+    try:
+        for history_table, (candles_table, instrument, price) in _CANDLE_SOURCES.items():
+            rollup_sql = _CANDLE_ROLLUP_SQL.format(
+                history=history_table, candles=candles_table, instrument=instrument,
+                price=price, resolutions=resolutions
+            )
+            with db_connection() as conn:
+                with conn.cursor() as cursor:
+                    upper_bound = _rollup_upper_bound(cursor, history_table)
+            while True:
+                with db_connection() as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute("""
+                            INSERT INTO RollupWatermarks (name, last_id) VALUES (%s, 0)
+                            ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
+                            RETURNING last_id
+                        """, (candles_table,))
+                        from_id = cursor.fetchone()[0] # Khóa dòng watermark đến hết transaction
+                        if from_id >= upper_bound:
+                            break
+                        to_id = min(upper_bound, from_id + batch_size)
+                        cursor.execute(rollup_sql, {'from_id': from_id, 'to_id': to_id, 'tz': ROLLUP_TIMEZONE})
+                        cursor.execute(
+                            "UPDATE RollupWatermarks SET last_id = %s, updated_at = CURRENT_TIMESTAMP WHERE name = %s",
+                            (to_id, candles_table)
+                        )
+                        processed += to_id - from_id
+    except psycopg2.Error as e:
+        logger.error(f"Lỗi khi cập nhật bảng nến OHLC: {e}")
+    return processed
+
+
+def _get_candles(query, params):
+    candles = []
+    try:
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.execute(query, params)
+                candles = cursor.fetchall()
+    except psycopg2.Error as e:
+        logger.error(f"Lỗi khi đọc nến OHLC từ PostgreSQL: {e}")
+    return candles
+
+
+@metrics.timed_db
+def get_exchange_rate_candles(code, resolution='1h', start=None, end=None):
+    """
+    Lấy nến OHLC của tỷ giá bán một ngoại tệ theo khung `resolution` ('1m', '1h', '1d'),
+    với bucket_start trong [start, end) (bỏ trống để không giới hạn), sắp xếp theo thời gian.
+    """
+    if resolution not in CANDLE_RESOLUTIONS:
+        raise ValueError(f"Khung thời gian không hợp lệ: '{resolution}' (chỉ nhận {', '.join(CANDLE_RESOLUTIONS)}).")
+    return _get_candles("""
+        SELECT c.code AS currency_code, k.resolution, k.bucket_start,
+               k.open, k.high, k.low, k.close, k.tick_count
+        FROM ExchangeRateCandles k
+        JOIN Currencies c ON c.id = k.currency_id
+        WHERE c.code = %(code)s AND k.resolution = %(resolution)s
+          AND (%(start)s::timestamptz IS NULL OR k.bucket_start >= %(start)s)
+          AND (%(end)s::timestamptz IS NULL OR k.bucket_start < %(end)s)
+        ORDER BY k.bucket_start
+    """, {'code': code, 'resolution': resolution, 'start': start, 'end': end})
+
+
+@metrics.timed_db
+def get_gold_price_candles(gold_type_name, resolution='1h', start=None, end=None, provider='SJC'):
+    """Lấy nến OHLC của giá bán một loại vàng (xem get_exchange_rate_candles)."""
+    if resolution not in CANDLE_RESOLUTIONS:
+        raise ValueError(f"Khung thời gian không hợp lệ: '{resolution}' (chỉ nhận {', '.join(CANDLE_RESOLUTIONS)}).")
+    return _get_candles("""
+        SELECT gt.name AS gold_type_name, gt.provider, k.resolution, k.bucket_start,
+               k.open, k.high, k.low, k.close, k.tick_count
+        FROM GoldPriceCandles k
+        JOIN GoldTypes gt ON gt.id = k.gold_type_id
+        WHERE gt.name = %(name)s AND gt.provider = %(provider)s AND k.resolution = %(resolution)s
+          AND (%(start)s::timestamptz IS NULL OR k.bucket_start >= %(start)s)
+          AND (%(end)s::timestamptz IS NULL OR k.bucket_start < %(end)s)
+        ORDER BY k.bucket_start
+    """, {'name': gold_type_name, 'provider': provider, 'resolution': resolution, 'start': start, 'end': end})
+
+
+# Truy vấn xuất lịch sử (kèm thông tin bảng chiều) theo khoảng id, dùng cho dataset.export_history().
+# export_date là ngày theo giờ Việt Nam của date_recorded, dùng để chia thư mục.
+_EXPORT_QUERIES = {
+    'ExchangeRates': """
+        SELECT er.id, c.code AS currency_code, c.name AS currency_name,
+               er.buy_cash::float8, er.buy_transfer::float8, er.sell::float8,
+               er.date_recorded, er.source_update_time,
+               (er.date_recorded AT TIME ZONE %(tz)s)::date AS export_date
+        FROM ExchangeRates er
+        JOIN Currencies c ON c.id = er.currency_id
+        WHERE er.id > %(from_id)s AND er.id <= %(to_id)s
+        ORDER BY er.id
+    """,
+    'GoldPrices': """
+        SELECT gp.id, gt.name AS gold_type_name, gt.original_type_name, gt.city_name, gt.provider,
+               gp.buy_price::float8, gp.sell_price::float8, gp.unit,
+               gp.date_recorded, gp.source_update_time,
+               (gp.date_recorded AT TIME ZONE %(tz)s)::date AS export_date
+        FROM GoldPrices gp
+        JOIN GoldTypes gt ON gt.id = gp.gold_type_id
+        WHERE gp.id > %(from_id)s AND gp.id <= %(to_id)s
+        ORDER BY gp.id
+    """,
+}
+
+
+@metrics.timed_db
+def get_history_upper_bound(history_table):
+    """Id lớn nhất của bảng lịch sử mà không còn dòng nào nhỏ hơn nó có thể được commit sau này."""
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            return _rollup_upper_bound(cursor, history_table)
+
+
+_stream_cursor_ids = itertools.count(1)
+
+
+def _stream_query(query, params, chunk_size):
+    """
+    Chạy `query` qua một named (server-side) cursor và trả về từng lô tối đa `chunk_size` dòng
+    dưới dạng (tên cột, list tuple). Chỉ một lô nằm trong bộ nhớ tại một thời điểm.
+    Kết nối được giữ (mượn từ pool) cho đến khi đọc hết hoặc generator bị đóng.
+    Lỗi CSDL được ném ra cho người gọi, vì một luồng bị cắt ngang trông giống hệt một luồng đã đọc xong.
+    """
+    with db_connection() as conn:
+        with conn.cursor(name=f"stream_{next(_stream_cursor_ids)}") as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(query, params)
+            columns = None
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                if columns is None:
+                    columns = [column.name for column in cursor.description]
+                yield columns, rows
+
+
+def _as_chunks(stream, as_columns):
+    for columns, rows in stream:
+        if as_columns:
+            yield {name: list(values) for name, values in zip(columns, zip(*rows))}
+        else:
+            yield rows
+
+
+EXCHANGE_RATE_HISTORY_COLUMNS = (
+    'currency_code', 'buy_cash', 'buy_transfer', 'sell', 'date_recorded', 'source_update_time'
+)
+GOLD_PRICE_HISTORY_COLUMNS = (
+    'gold_type_name', 'provider', 'buy_price', 'sell_price', 'unit', 'date_recorded', 'source_update_time'
+)
+
+
+def iter_exchange_rate_history(codes=None, start=None, end=None, chunk_size=None, as_columns=False):
+    """
+    Đọc lịch sử tỷ giá dạng luồng, sắp theo date_recorded: mỗi phần tử là một list tối đa `chunk_size`
+    tuple theo thứ tự EXCHANGE_RATE_HISTORY_COLUMNS, hoặc (as_columns=True) một dict tên cột -> list giá trị.
+    Lọc theo danh sách mã ngoại tệ `codes` và date_recorded trong [start, end) (None = không lọc).
+    Bộ nhớ dùng không phụ thuộc số dòng được quét:
+
+        for chunk in database.iter_exchange_rate_history(['USD', 'EUR'], start=...):
+            ...
+    """
+    query = """
+        SELECT c.code AS currency_code, er.buy_cash, er.buy_transfer, er.sell,
+               er.date_recorded, er.source_update_time
+        FROM ExchangeRates er
+        JOIN Currencies c ON c.id = er.currency_id
+        WHERE (%(codes)s::varchar[] IS NULL OR c.code = ANY(%(codes)s::varchar[]))
+          AND (%(start)s::timestamptz IS NULL OR er.date_recorded >= %(start)s)
+          AND (%(end)s::timestamptz IS NULL OR er.date_recorded < %(end)s)
+        ORDER BY er.date_recorded, er.id
+    """
+    params = {'codes': [code.upper() for code in codes] if codes else None, 'start': start, 'end': end}
+    return _as_chunks(_stream_query(query, params, chunk_size or HISTORY_CHUNK_SIZE), as_columns)
+
+
+def iter_gold_price_history(gold_type_names=None, start=None, end=None, provider=None, chunk_size=None, as_columns=False):
+    """
+    Đọc lịch sử giá vàng dạng luồng (xem iter_exchange_rate_history); cột theo GOLD_PRICE_HISTORY_COLUMNS.
+    Lọc theo danh sách tên loại vàng, nhà cung cấp và khoảng date_recorded.
+    """
+    query = """
+        SELECT gt.name AS gold_type_name, gt.provider, gp.buy_price, gp.sell_price, gp.unit,
+               gp.date_recorded, gp.source_update_time
+        FROM GoldPrices gp
+        JOIN GoldTypes gt ON gt.id = gp.gold_type_id
+        WHERE (%(names)s::varchar[] IS NULL OR gt.name = ANY(%(names)s::varchar[]))
+          AND (%(provider)s::varchar IS NULL OR gt.provider = %(provider)s)
+          AND (%(start)s::timestamptz IS NULL OR gp.date_recorded >= %(start)s)
+          AND (%(end)s::timestamptz IS NULL OR gp.date_recorded < %(end)s)
+        ORDER BY gp.date_recorded, gp.id
+    """
+    params = {'names': list(gold_type_names) if gold_type_names else None, 'provider': provider, 'start': start, 'end': end}
+    return _as_chunks(_stream_query(query, params, chunk_size or HISTORY_CHUNK_SIZE), as_columns)
+
+
+def iter_history_export(history_table, from_id, to_id, batch_size=10000):
+    """
+    Đọc các dòng lịch sử có id trong (from_id, to_id] theo thứ tự id, từng lô `batch_size` dòng,
+    dạng (tên cột, list tuple); dùng cho dataset.export_history().
+    """
+    return _stream_query(_EXPORT_QUERIES[history_table],
+                         {'from_id': from_id, 'to_id': to_id, 'tz': ROLLUP_TIMEZONE}, batch_size)
@@ -0,0 +1,178 @@
+# src/dataset.py
+import json
+import logging
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+_TIMESTAMP = pa.timestamp('us', tz='UTC')
+
+# Bộ dữ liệu xuất ra data/processed/<tên>/date=YYYY-MM-DD/part-<id đầu tiên>.<đuôi>
+# (kiểu phân vùng "hive", đọc được trực tiếp bằng pyarrow.dataset / pandas / duckdb)
+EXPORT_DATASETS = {
+    'exchange_rates': ('ExchangeRates', pa.schema([
+        ('id', pa.int64()),
+        ('currency_code', pa.string()),
+        ('currency_name', pa.string()),
+        ('buy_cash', pa.float64()),
+        ('buy_transfer', pa.float64()),
+        ('sell', pa.float64()),
+        ('date_recorded', _TIMESTAMP),
+        ('source_update_time', _TIMESTAMP),
+    ])),
+    'gold_prices': ('GoldPrices', pa.schema([
+        ('id', pa.int64()),
+        ('gold_type_name', pa.string()),
+        ('original_type_name', pa.string()),
+        ('city_name', pa.string()),
+        ('provider', pa.string()),
+        ('buy_price', pa.float64()),
+        ('sell_price', pa.float64()),
+        ('unit', pa.string()),
+        ('date_recorded', _TIMESTAMP),
+        ('source_update_time', _TIMESTAMP),
+    ])),
+}
+
+EXPORT_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'} # arrow = Arrow IPC (file), memory-map được
+WATERMARK_FILE = '_watermark.json'
+
+
+def _read_watermark(dataset_dir):
+    try:
+        with open(os.path.join(dataset_dir, WATERMARK_FILE), encoding='utf-8') as f:
+            return int(json.load(f)['last_id'])
+    except FileNotFoundError:
+        return 0
+
+
+def _write_watermark(dataset_dir, last_id):
+    path = os.path.join(dataset_dir, WATERMARK_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'last_id': last_id}, f)
+    os.replace(tmp_path, path)
+
+
+def _part_first_id(filename):
+    """Id đầu tiên ghi trong tên file 'part-<id>.<đuôi>', hoặc None nếu không phải file dữ liệu."""
+    stem, ext = os.path.splitext(filename)
+    if ext not in EXPORT_FORMATS.values() or not stem.startswith('part-'):
+        return None
+    return int(stem[len('part-'):]) if stem[len('part-'):].isdigit() else None
+
+
+def _remove_uncommitted_parts(dataset_dir, last_id):
+    """
+    Xóa file của một lần xuất bị ngắt giữa chừng (id đầu tiên lớn hơn watermark, hoặc file tạm),
+    vì các dòng đó sẽ được xuất lại; nhờ vậy mỗi dòng có mặt đúng một lần.
+    """
+    for root, _, files in os.walk(dataset_dir):
+        for filename in files:
+            first_id = _part_first_id(filename)
+            is_partial = filename.startswith('part-') and filename.endswith('.tmp')
+            if is_partial or (first_id is not None and first_id > last_id):
+                os.remove(os.path.join(root, filename))
+
+
+class _PartWriter:
+    """Ghi một file part (Parquet hoặc Arrow IPC) vào tên tạm, đổi sang tên thật khi đóng."""
+
+    def __init__(self, path, schema, fmt):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if fmt == 'parquet':
+            self._writer = pq.ParquetWriter(self.tmp_path, schema, compression='zstd')
+            self._sink = None
+        else:
+            self._sink = pa.OSFile(self.tmp_path, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, schema)
+
+    def write(self, batch):
+        if isinstance(self._writer, pq.ParquetWriter):
+            self._writer.write_batch(batch)
+        else:
+            self._writer.write(batch)
+
+    def _close_file(self):
+        self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+
+    def close(self):
+        self._close_file()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self._close_file()
+        os.remove(self.tmp_path)
+
+
+def _export_dataset(name, history_table, schema, output_dir, fmt, batch_size):
+    dataset_dir = os.path.join(output_dir, name)
+    os.makedirs(dataset_dir, exist_ok=True)
+    last_id = _read_watermark(dataset_dir)
+    _remove_uncommitted_parts(dataset_dir, last_id)
+    upper_bound = database.get_history_upper_bound(history_table)
+    if upper_bound <= last_id:
+        logger.info(f"{name}: không có dòng mới kể từ id {last_id}.")
+        return 0
+
+    extension = EXPORT_FORMATS[fmt]
+    writers = {} # ngày -> _PartWriter đang mở
+    exported = 0
+    try:
+        for columns, rows in database.iter_history_export(history_table, last_id, upper_bound, batch_size):
+            date_index = columns.index('export_date')
+            rows_by_date = {}
+            for row in rows:
+                rows_by_date.setdefault(row[date_index], []).append(row)
+            # Dữ liệu đến theo thứ tự id nên thường theo thứ tự thời gian: đóng file của các ngày đã qua
+            for export_date in [d for d in writers if d not in rows_by_date]:
+                writers.pop(export_date).close()
+            for export_date, date_rows in rows_by_date.items():
+                values = list(zip(*date_rows))
+                batch = pa.RecordBatch.from_arrays(
+                    [pa.array(values[columns.index(field.name)], type=field.type) for field in schema],
+                    schema=schema
+                )
+                if export_date not in writers:
+                    path = os.path.join(dataset_dir, f"date={export_date.isoformat()}", f"part-{date_rows[0][0]}{extension}")
+                    writers[export_date] = _PartWriter(path, schema, fmt)
+                writers[export_date].write(batch)
+            exported += len(rows)
+        while writers:
+            writers.popitem()[1].close()
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+    # Chỉ dời watermark khi mọi file của lần xuất này đã hoàn chỉnh
+    _write_watermark(dataset_dir, upper_bound)
+    logger.info(f"{name}: đã xuất {exported} dòng (id {last_id + 1} -> {upper_bound}).",
+                extra={'dataset': name, 'rows': exported, 'last_id': upper_bound})
+    return exported
+
+
+def export_history(output_dir=None, fmt=None, batch_size=None):
+    """
+    Xuất tăng dần ExchangeRates và GoldPrices (kèm tên ngoại tệ / loại vàng) ra file dạng cột,
+    chia thư mục theo ngày (giờ Việt Nam). Mỗi lần chạy chỉ xuất các dòng có id lớn hơn watermark
+    của lần trước (lưu trong <thư mục bộ dữ liệu>/_watermark.json). Trả về tổng số dòng đã xuất.
+    """
+    output_dir = str(output_dir or config.PROCESSED_DATA_DIR)
+    fmt = fmt or config.EXPORT_FORMAT
+    batch_size = batch_size or config.EXPORT_BATCH_SIZE
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Định dạng xuất không hợp lệ: '{fmt}' (chỉ nhận {', '.join(EXPORT_FORMATS)}).")
+    total = 0
+    for name, (history_table, schema) in EXPORT_DATASETS.items():
+        total += _export_dataset(name, history_table, schema, output_dir, fmt, batch_size)
+    return total
@@ -0,0 +1,324 @@
+# src/features.py
+"""
+Tính đặc trưng (feature) cho tỷ giá và giá vàng bằng NumPy, theo lô, không lặp từng dòng.
+
+Dữ liệu của nhiều công cụ (ngoại tệ / loại vàng) được xếp liền nhau trong một SeriesSet:
+mỗi công cụ là một đoạn liên tiếp, sắp theo thời gian, ranh giới đoạn nằm trong `offsets`
+(giống cách lưu ma trận CSR). Mọi phép tính cửa sổ trượt đều dừng ở ranh giới đoạn,
+nên một lần gọi xử lý toàn bộ lịch sử của mọi công cụ.
+Cửa sổ trượt tính theo số tick (số lần ghi nhận), không theo thời gian.
+"""
+import os
+
+import numpy as np
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+import config
+
+USD_CODE = 'USD'
+DEFAULT_WINDOW = 20
+
+
+class SeriesSet:
+    """
+    Nhiều chuỗi thời gian xếp liền nhau: đoạn thứ k (công cụ keys[k]) là các dòng
+    offsets[k]:offsets[k+1] của `times` và của từng mảng trong `columns`.
+    """
+
+    def __init__(self, keys, offsets, times, columns):
+        self.keys = np.asarray(keys, dtype=object)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.times = np.asarray(times)
+        self.columns = {name: np.asarray(values, dtype=np.float64) for name, values in columns.items()}
+
+    @classmethod
+    def from_rows(cls, row_keys, times, columns):
+        """Dựng từ các mảng theo dòng chưa sắp xếp: gom theo công cụ, trong mỗi công cụ sắp theo thời gian."""
+        row_keys = np.asarray(row_keys).astype(str) # np.unique trên chuỗi cố định nhanh hơn nhiều so với object
+        keys, key_codes = np.unique(row_keys, return_inverse=True)
+        return cls.from_codes(keys.astype(object), key_codes, times, columns)
+
+    @classmethod
+    def from_codes(cls, keys, key_codes, times, columns):
+        """Như from_rows, nhưng công cụ của mỗi dòng đã được mã hóa thành chỉ số trong `keys`."""
+        key_codes = np.asarray(key_codes, dtype=np.int64)
+        times = np.asarray(times)
+        order = np.lexsort((times, key_codes)) # Sắp ổn định theo (công cụ, thời gian)
+        counts = np.bincount(key_codes, minlength=len(keys))
+        present = counts > 0 # Bỏ các khóa không có dòng nào
+        offsets = np.concatenate(([0], np.cumsum(counts[present])))
+        return cls(
+            np.asarray(keys, dtype=object)[present], offsets, times[order],
+            {name: np.asarray(values, dtype=np.float64)[order] for name, values in columns.items()}
+        )
+
+    def __len__(self):
+        return len(self.times)
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def segment_starts(self):
+        """Với mỗi dòng: chỉ số dòng đầu tiên của đoạn chứa nó."""
+        return np.repeat(self.offsets[:-1], self.lengths())
+
+    def segment(self, key):
+        """(times, {cột: mảng}) của một công cụ, dạng view không sao chép; None nếu không có."""
+        matches = np.flatnonzero(self.keys == key)
+        if len(matches) == 0:
+            return None
+        start, end = self.offsets[matches[0]], self.offsets[matches[0] + 1]
+        return self.times[start:end], {name: values[start:end] for name, values in self.columns.items()}
+
+
+# --- Các phép tính cơ bản trên mảng đã chia đoạn ---
+
+def spread(bid, ask):
+    """Chênh lệch mua/bán tuyệt đối và tương đối (so với giá giữa)."""
+    absolute = ask - bid
+    with np.errstate(invalid='ignore', divide='ignore'):
+        relative = absolute / ((ask + bid) / 2)
+    return absolute, relative
+
+
+def log_returns(values, segment_starts):
+    """log(p[i] / p[i-1]) trong cùng một đoạn; dòng đầu mỗi đoạn là NaN."""
+    returns = np.full(len(values), np.nan)
+    if len(values) > 1:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            returns[1:] = np.diff(np.log(values))
+    returns[np.arange(len(values)) == segment_starts] = np.nan
+    return returns
+
+
+def rolling_mean_std(values, segment_starts, window, min_periods=None):
+    """
+    Trung bình và độ lệch chuẩn (mẫu, ddof=1) trượt trên `window` giá trị gần nhất trong cùng đoạn,
+    bỏ qua NaN; NaN khi cửa sổ có ít hơn `min_periods` giá trị (mặc định bằng `window`).
+    Dùng tổng tích lũy nên chi phí O(n) bất kể độ dài cửa sổ; giá trị được trừ đi giá trị
+    đầu đoạn trước khi cộng dồn để tránh mất chính xác khi giá lớn (ví dụ giá vàng hàng trăm triệu).
+    """
+    min_periods = window if min_periods is None else min_periods
+    n = len(values)
+    if n == 0:
+        return np.empty(0), np.empty(0)
+    valid = ~np.isnan(values)
+    # Giá trị hợp lệ đầu tiên của mỗi đoạn làm mốc (không quan trọng chính xác, chỉ để giảm độ lớn)
+    baseline = np.where(valid, values, 0.0)[segment_starts]
+    centered = np.where(valid, values - baseline, 0.0)
+
+    def _cumsum(x):
+        return np.concatenate(([0.0], np.cumsum(x)))
+
+    cum_count = _cumsum(valid.astype(np.float64))
+    cum_sum = _cumsum(centered)
+    cum_sq = _cumsum(centered * centered)
+
+    idx = np.arange(n)
+    window_start = np.maximum(idx - window + 1, segment_starts)
+    count = cum_count[idx + 1] - cum_count[window_start]
+    total = cum_sum[idx + 1] - cum_sum[window_start]
+    total_sq = cum_sq[idx + 1] - cum_sq[window_start]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        variance = (total_sq - total * mean) / (count - 1)
+    std = np.sqrt(np.maximum(variance, 0.0))
+    enough = count >= max(min_periods, 1)
+    mean = np.where(enough, mean + baseline, np.nan)
+    std = np.where(enough & (count >= 2), std, np.nan)
+    return mean, std
+
+
+def asof(target_times, ref_times, ref_values):
+    """Với mỗi thời điểm trong target_times: giá trị ref gần nhất có thời gian <= nó (NaN nếu chưa có)."""
+    positions = np.searchsorted(ref_times, target_times, side='right') - 1
+    result = np.full(len(target_times), np.nan)
+    found = positions >= 0
+    result[found] = np.asarray(ref_values, dtype=np.float64)[positions[found]]
+    return result
+
+
+# --- Đặc trưng cho từng loại dữ liệu ---
+
+def exchange_rate_features(rates, window=DEFAULT_WINDOW):
+    """
+    Đặc trưng cho SeriesSet tỷ giá (cột buy_cash, buy_transfer, sell):
+    spread / spread_pct (bán - mua chuyển khoản), cash_transfer_spread (mua CK - mua TM),
+    log_return của giá bán, rolling_mean của giá bán và rolling_volatility của log_return.
+    """
+    starts = rates.segment_starts()
+    sell = rates.columns['sell']
+    buy_transfer = rates.columns['buy_transfer']
+    features = {}
+    features['spread'], features['spread_pct'] = spread(buy_transfer, sell)
+    features['cash_transfer_spread'] = buy_transfer - rates.columns['buy_cash']
+    features['log_return'] = log_returns(sell, starts)
+    features['rolling_mean'], _ = rolling_mean_std(sell, starts, window)
+    _, features['rolling_volatility'] = rolling_mean_std(features['log_return'], starts, window)
+    return features
+
+
+def gold_price_features(gold, rates=None, window=DEFAULT_WINDOW):
+    """
+    Đặc trưng cho SeriesSet giá vàng (cột buy_price, sell_price): spread / spread_pct, log_return,
+    rolling_mean, rolling_volatility và gold_usd_ratio = giá bán vàng / tỷ giá bán USD tại cùng thời điểm
+    (tức giá vàng quy ra USD; NaN nếu không có `rates` hoặc chưa có tỷ giá USD trước thời điểm đó).
+    """
+    starts = gold.segment_starts()
+    sell = gold.columns['sell_price']
+    features = {}
+    features['spread'], features['spread_pct'] = spread(gold.columns['buy_price'], sell)
+    features['log_return'] = log_returns(sell, starts)
+    features['rolling_mean'], _ = rolling_mean_std(sell, starts, window)
+    _, features['rolling_volatility'] = rolling_mean_std(features['log_return'], starts, window)
+    usd = rates.segment(USD_CODE) if rates is not None else None
+    if usd is None:
+        features['gold_usd_ratio'] = np.full(len(gold), np.nan)
+    else:
+        usd_times, usd_columns = usd
+        with np.errstate(invalid='ignore', divide='ignore'):
+            features['gold_usd_ratio'] = sell / asof(gold.times, usd_times, usd_columns['sell'])
+    return features
+
+
+# --- Nạp dữ liệu từ các file dạng cột do dataset.export_history() tạo ra ---
+
+def _load_series(dataset_dir, key_column, value_columns, start=None, end=None):
+    """
+    Đọc các cột cần thiết từ thư mục xuất, lọc date_recorded trong [start, end)
+    (datetime có múi giờ; bỏ trống để không giới hạn).
+    """
+    files = [os.path.join(root, name) for root, _, names in os.walk(dataset_dir)
+             for name in names if name.endswith(('.parquet', '.arrow'))]
+    if not files:
+        return SeriesSet.from_rows([], np.empty(0, dtype='datetime64[us]'), {name: [] for name in value_columns})
+    fmt = 'ipc' if files[0].endswith('.arrow') else 'parquet'
+    dataset = ds.dataset(files, format=fmt, partitioning='hive', partition_base_dir=str(dataset_dir))
+    filter_expression = None
+    if start is not None:
+        filter_expression = ds.field('date_recorded') >= start
+    if end is not None:
+        end_filter = ds.field('date_recorded') < end
+        filter_expression = end_filter if filter_expression is None else filter_expression & end_filter
+    table = dataset.to_table(columns=[key_column, 'date_recorded', *value_columns], filter=filter_expression)
+    # Mã hóa từ điển: gom nhóm theo chỉ số nguyên thay vì so sánh chuỗi từng dòng
+    encoded = pc.dictionary_encode(table[key_column].combine_chunks())
+    times = table['date_recorded'].combine_chunks().to_numpy(zero_copy_only=False).astype('datetime64[us]')
+    columns = {
+        name: table[name].combine_chunks().to_numpy(zero_copy_only=False).astype(np.float64)
+        for name in value_columns
+    }
+    return SeriesSet.from_codes(encoded.dictionary.to_numpy(zero_copy_only=False),
+                                encoded.indices.to_numpy(), times, columns)
+
+
+def load_exchange_rate_series(processed_dir=None, start=None, end=None):
+    """Nạp lịch sử tỷ giá của mọi ngoại tệ (xem `python main.py export`)."""
+    processed_dir = processed_dir or config.PROCESSED_DATA_DIR
+    return _load_series(os.path.join(processed_dir, 'exchange_rates'), 'currency_code',
+                        ['buy_cash', 'buy_transfer', 'sell'], start, end)
+
+
+def load_gold_price_series(processed_dir=None, start=None, end=None):
+    """Nạp lịch sử giá vàng của mọi loại vàng (khóa là tên loại vàng)."""
+    processed_dir = processed_dir or config.PROCESSED_DATA_DIR
+    return _load_series(os.path.join(processed_dir, 'gold_prices'), 'gold_type_name',
+                        ['buy_price', 'sell_price'], start, end)
+
+
+# --- Chế độ tăng dần ---
+
+class IncrementalFeatures:
+    """
+    Cập nhật đặc trưng từ các tick mới mà không tính lại toàn bộ lịch sử.
+    Với mỗi công cụ chỉ giữ `window + 1` giá gần nhất; mỗi lần cập nhật, phần đuôi này được ghép với
+    các tick mới, sắp lại theo thời gian như SeriesSet.from_codes (tick đến muộn được xếp vào đúng chỗ
+    trong phần đuôi), rồi tính bằng đúng các hàm theo lô ở trên, nên kết quả trùng với tính toàn bộ.
+    Tick cũ hơn cả phần đuôi đã giữ chỉ được tính với các giá còn giữ.
+
+    Cho gold_usd_ratio, chuỗi tỷ giá bán USD được giữ từ tick USD cuối cùng trước tick vàng cũ nhất
+    còn trong các phần đuôi giá vàng; tick vàng mới được tra as-of trên chuỗi này như gold_price_features.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self._tails = {'rates': {}, 'gold': {}} # loại -> {khóa: (times, {cột: mảng})}
+        self._usd = None # (times, sell) các tick USD đã thấy còn cần cho as-of, sắp theo thời gian
+
+    def _extend_with_tails(self, kind, new):
+        """Ghép phần đuôi đã lưu với các tick mới; trả về SeriesSet ghép và chỉ số các dòng mới trong đó."""
+        tails = self._tails[kind]
+        times, columns, key_codes, new_mask = [], {name: [] for name in new.columns}, [], []
+        for position, key in enumerate(new.keys):
+            start, end = new.offsets[position], new.offsets[position + 1]
+            tail_times, tail_columns = tails.get(key, (new.times[:0], {name: values[:0] for name, values in new.columns.items()}))
+            times += [tail_times, new.times[start:end]]
+            for name, values in new.columns.items():
+                columns[name] += [tail_columns[name], values[start:end]]
+            key_codes.append(np.full(len(tail_times) + end - start, position, dtype=np.int64))
+            new_mask += [np.zeros(len(tail_times), dtype=bool), np.ones(end - start, dtype=bool)]
+        if not times:
+            return new, np.arange(0)
+        times, key_codes, new_mask = np.concatenate(times), np.concatenate(key_codes), np.concatenate(new_mask)
+        # Sắp ổn định theo (công cụ, thời gian) như from_codes: tick đến muộn về đúng vị trí, phần đuôi
+        # đứng trước tick mới cùng thời điểm; các dòng mới giữ nguyên thứ tự tương đối của `new`
+        order = np.lexsort((times, key_codes))
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(key_codes, minlength=len(new.keys)))))
+        combined = SeriesSet(new.keys, offsets, times[order],
+                             {name: np.concatenate(parts)[order] for name, parts in columns.items()})
+        # Lưu lại phần đuôi mới cho lần sau
+        keep = self.window + 1
+        for position, key in enumerate(combined.keys):
+            start, end = combined.offsets[position], combined.offsets[position + 1]
+            start = max(start, end - keep)
+            tails[key] = (combined.times[start:end].copy(),
+                          {name: values[start:end].copy() for name, values in combined.columns.items()})
+        return combined, np.flatnonzero(new_mask[order])
+
+    def _merge_usd(self, rates):
+        """Trộn các tick USD của SeriesSet `rates` vào chuỗi USD đang giữ (tick trùng thời điểm: giữ tick đến sau)."""
+        segment = rates.segment(USD_CODE) if rates is not None else None
+        if segment is None or not len(segment[0]):
+            return
+        times, sell = segment[0], segment[1]['sell']
+        if self._usd is not None:
+            times, sell = np.concatenate((self._usd[0], times)), np.concatenate((self._usd[1], sell))
+        order = np.argsort(times, kind='stable')
+        times, sell = times[order], sell[order]
+        last_of_time = np.append(times[1:] != times[:-1], True)
+        self._usd = (times[last_of_time], sell[last_of_time])
+
+    def _prune_usd(self):
+        """Bỏ các tick USD không còn cần: as-of của mọi tick vàng từ tick cũ nhất trong các phần đuôi trở đi."""
+        gold_tails = self._tails['gold']
+        if self._usd is None or not gold_tails:
+            return
+        oldest = min(tail_times[0] for tail_times, _ in gold_tails.values() if len(tail_times))
+        first = max(np.searchsorted(self._usd[0], oldest, side='right') - 1, 0)
+        if first:
+            self._usd = (self._usd[0][first:].copy(), self._usd[1][first:].copy())
+
+    def update_rates(self, new_rates):
+        """Đặc trưng (như exchange_rate_features) cho các dòng của SeriesSet tỷ giá mới, theo thứ tự của new_rates."""
+        combined, new_rows = self._extend_with_tails('rates', new_rates)
+        self._merge_usd(new_rates)
+        features = exchange_rate_features(combined, self.window)
+        return {name: values[new_rows] for name, values in features.items()}
+
+    def update_gold(self, new_gold, new_rates=None):
+        """
+        Đặc trưng (như gold_price_features) cho các dòng của SeriesSet giá vàng mới, theo thứ tự của new_gold.
+        Tỷ giá USD cho gold_usd_ratio gồm các tick đã đưa vào update_rates() và các tick USD của
+        `new_rates` (nếu có; đưa cùng một đợt vào cả hai chỗ không làm trùng tick).
+        """
+        combined, new_rows = self._extend_with_tails('gold', new_gold)
+        self._merge_usd(new_rates)
+        rates = None
+        if self._usd is not None:
+            usd_times, usd_sell = self._usd
+            rates = SeriesSet([USD_CODE], [0, len(usd_times)], usd_times, {'sell': usd_sell})
+        features = gold_price_features(combined, rates, self.window)
+        self._prune_usd()
+        return {name: values[new_rows] for name, values in features.items()}
@@ -0,0 +1,127 @@
+# src/leader.py
+"""
+Phân công nguồn/job giữa nhiều node thu thập chạy cùng lúc (COLLECTOR_COORDINATION=advisory).
+
+Mỗi nguồn (và mỗi job nền như rollup nến) ứng với một khóa advisory mức session của PostgreSQL.
+Trước mỗi lần poll, node gọi is_leader(name): node đang giữ khóa thì poll, các node khác bỏ qua.
+Khóa được giữ trên một kết nối riêng của node (không qua pool), nên:
+  - chỉ một node đang sống chạy mỗi nguồn, không ghi trùng và không tăng tải lên nguồn;
+  - node dừng/chết thì kết nối đóng, khóa được nhả ngay (treo máy/mất mạng: sau thời gian TCP
+    keepalive, xem COLLECTOR_KEEPALIVE) và node khác giành được khóa ở lần poll kế tiếp.
+Node đang giữ khóa nào có thể xem trong pg_stat_activity (application_name = 'collector:<node id>').
+"""
+import logging
+import threading
+
+import psycopg2
+
+import config
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+COORDINATION_MODES = ('none', 'advisory')
+LEADER_LOCK_CLASS = 0x4C454144 # Khóa advisory dạng (class, hashtext(tên nguồn/job))
+
+
+class LeaderElection:
+    """Bầu node chạy cho từng nguồn/job bằng pg_try_advisory_lock; an toàn khi gọi từ nhiều thread."""
+
+    def __init__(self, node_id=None, fail_open=None):
+        self.node_id = node_id or config.COLLECTOR_NODE_ID
+        self.fail_open = config.COLLECTOR_FAIL_OPEN if fail_open is None else fail_open
+        self._conn = None
+        self._held = set()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            keepalive = max(1, config.COLLECTOR_KEEPALIVE)
+            self._conn = database.get_db_connection(
+                application_name=f"collector:{self.node_id}"[:63],
+                keepalives=1,
+                keepalives_idle=keepalive,
+                keepalives_interval=max(1, keepalive // 2),
+                keepalives_count=3
+            )
+            self._conn.autocommit = True
+            self._held.clear()
+        return self._conn
+
+    def _drop_connection(self):
+        """Kết nối giữ khóa bị hỏng: server đã (hoặc sẽ) nhả mọi khóa của session đó."""
+        if self._held:
+            logger.warning(f"Mất kết nối giữ khóa, node {self.node_id} không còn chạy: {', '.join(sorted(self._held))}",
+                           extra={'node': self.node_id})
+        for name in self._held:
+            metrics.LEADER.labels(name).set(0)
+        self._held.clear()
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+        self._conn = None
+
+    def _try_acquire(self, name):
+        with self._connection().cursor() as cursor:
+            if name in self._held:
+                # Khóa mức session chỉ mất khi session mất: kết nối còn sống nghĩa là vẫn giữ khóa
+                cursor.execute("SELECT 1")
+                return True
+            cursor.execute("SELECT pg_try_advisory_lock(%s, hashtext(%s))", (LEADER_LOCK_CLASS, name))
+            return cursor.fetchone()[0]
+
+    def is_leader(self, name):
+        """
+        True nếu node này được chạy `name` ở lần này (giành khóa nếu chưa ai giữ).
+        Không kết nối được CSDL: trả về fail_open (mặc định True: vẫn poll, dữ liệu được giữ trong spool).
+        """
+        with self._lock:
+            error = None
+            # Lần thử thứ hai dùng kết nối mới, phòng khi kết nối cũ đã bị server đóng (CSDL khởi động lại)
+            for _ in range(2):
+                try:
+                    acquired = self._try_acquire(name)
+                    break
+                except psycopg2.Error as e:
+                    error = e
+                    self._drop_connection()
+            else:
+                logger.warning(f"Không kiểm tra được quyền chạy {name} ({error}); "
+                               f"{'vẫn chạy' if self.fail_open else 'bỏ qua'} lần này.", extra={'job': name})
+                return self.fail_open
+            if acquired and name not in self._held:
+                self._held.add(name)
+                logger.info(f"Node {self.node_id} nhận chạy {name}", extra={'job': name, 'node': self.node_id})
+            metrics.LEADER.labels(name).set(1 if acquired else 0)
+            return acquired
+
+    def held(self):
+        with self._lock:
+            return sorted(self._held)
+
+    def release_all(self):
+        """Nhả mọi khóa (gọi khi dừng) để node khác tiếp quản ngay, không phải chờ kết nối bị phát hiện là chết."""
+        with self._lock:
+            if self._conn is not None and not self._conn.closed:
+                try:
+                    with self._conn.cursor() as cursor:
+                        cursor.execute("SELECT pg_advisory_unlock_all()")
+                except psycopg2.Error:
+                    pass
+            if self._held:
+                logger.info(f"Node {self.node_id} nhả quyền chạy: {', '.join(sorted(self._held))}", extra={'node': self.node_id})
+            for name in self._held:
+                metrics.LEADER.labels(name).set(0)
+            self._held.clear()
+            self._drop_connection()
+
+
+def from_config():
+    """LeaderElection theo COLLECTOR_COORDINATION, hoặc None khi chạy một node (mode 'none')."""
+    mode = config.COLLECTOR_COORDINATION
+    if mode not in COORDINATION_MODES:
+        raise ValueError(f"COLLECTOR_COORDINATION='{mode}' không hợp lệ (cho phép: {', '.join(COORDINATION_MODES)}).")
+    return LeaderElection() if mode == 'advisory' else None
@@ -0,0 +1,67 @@
+# src/log_config.py
+"""
+Cấu hình logging cho cả ứng dụng. Mỗi module dùng logger = logging.getLogger(__name__)
+và truyền thêm dữ liệu có cấu trúc qua `extra`, ví dụ:
+
+    logger.info("Đã ghi snapshot", extra={'source': 'VCB', 'rows': 20})
+
+LOG_FORMAT=text: dòng dễ đọc, các trường extra nối thêm dạng key=value.
+LOG_FORMAT=json: mỗi dòng một object JSON, để đưa vào hệ thống gom log.
+"""
+import json
+import logging
+import sys
+from datetime import datetime
+
+import config
+import metrics
+
+# Thuộc tính có sẵn của LogRecord; mọi thuộc tính khác là trường `extra` do người gọi truyền vào
+_RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+def _extra_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RESERVED_ATTRS}
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)-7s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        entry.update(_extra_fields(record))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level=None, fmt=None):
+    """Gắn handler ra stderr (và handler đếm lỗi cho metric) vào root logger. Gọi một lần khi khởi động."""
+    level = (level or config.LOG_LEVEL).upper()
+    fmt = (fmt or config.LOG_FORMAT).lower()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.addHandler(metrics.ErrorCountingHandler())
+    root.setLevel(level)
+    # Log của thư viện HTTP quá chi tiết ở mức DEBUG
+    logging.getLogger('urllib3').setLevel(max(logging.getLevelName(level), logging.INFO))
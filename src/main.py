@@ -1,68 +1,142 @@
-from datetime import datetime
-import services.scraper_vcb as scraper # Đã cập nhật cho PostgreSQL
-import services.sjc_gold_scraper as scraper_sjc # Đã cập nhật cho PostgreSQL
+from datetime import date
+import argparse
+import functools
+import logging
+import threading
+import psycopg2
+import config
+import log_config
+import metrics
+from scheduler import PollingScheduler
+from services import http_session
+from services import sources
+import anomaly
+import api
+import backfill
+import dataset
+import leader
+import spool
 import database # database.py đã được cập nhật cho PostgreSQL
 import sys # Để thoát nếu kết nối DB thất bại
 
-def run_update_exchange_rates():
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] --- Bắt đầu quá trình cập nhật tỷ giá Vietcombank (PostgreSQL) ---")
-
-
-    # 1. Lấy dữ liệu tỷ giá mới nhất từ Vietcombank API
-    print("\nĐang lấy dữ liệu tỷ giá từ Vietcombank...")
-    fetched_rates, source_update_time_str = scraper.fetch_exchange_rates_from_api()
-
-    if fetched_rates:
-        print(f"Lấy dữ liệu thành công. Thời gian cập nhật từ Vietcombank (chuỗi gốc): {source_update_time_str}.")
-        print(f"Số lượng ngoại tệ thu được: {len(fetched_rates)}")
-        
-        # 2. Lưu dữ liệu vào cơ sở dữ liệu PostgreSQL
-        print("\nĐang lưu dữ liệu vào cơ sở dữ liệu PostgreSQL...")
-        successful_inserts = 0
-        for rate_data in fetched_rates:
-            currency_id = database.get_or_create_currency(rate_data['code'], rate_data['name'])
-            if currency_id:
-                database.insert_exchange_rate(
-                    currency_id=currency_id,
-                    buy_cash=rate_data['buy_cash'],
-                    buy_transfer=rate_data['buy_transfer'],
-                    sell=rate_data['sell'],
-                    source_update_time_str=source_update_time_str # Truyền chuỗi, database.py sẽ parse
-                )
-                successful_inserts += 1
-            else:
-                print(f"Không thể lấy hoặc tạo currency_id cho {rate_data['code']} trong PostgreSQL.")
-        print(f"Đã thực hiện ghi {successful_inserts} bản ghi tỷ giá vào PostgreSQL.")
-    else:
-        print("Không lấy được dữ liệu tỷ giá từ Vietcombank. Bỏ qua việc lưu vào CSDL.")
-
-    # --- Lấy và lưu giá vàng SJC ---
-    print("\n--- Cập nhật Giá vàng SJC ---")
-    sjc_gold_data, sjc_source_time = scraper_sjc.get_sjc_gold_data()
-
-    if sjc_gold_data:
-        print(f"Lấy giá vàng SJC thành công. Thời gian SJC cập nhật: {sjc_source_time}.")
-        print(f"Số loại giá vàng SJC: {len(sjc_gold_data)}")
-        for gold_item in sjc_gold_data:
-            gold_type_id = database.get_or_create_gold_type(
-                full_name=gold_item['type_name'],
-                original_type_name=gold_item['original_type'],
-                city_name=gold_item['city'],
-                provider='SJC'
-            )
-            if gold_type_id:
-                database.insert_gold_price(
-                    gold_type_id=gold_type_id,
-                    buy_price=gold_item['buy'],
-                    sell_price=gold_item['sell'],
-                    unit=gold_item['unit'],
-                    source_update_time_str=sjc_source_time
-                )
-        print(f"Đã lưu {len(sjc_gold_data)} bản ghi giá vàng SJC.")
+logger = logging.getLogger(__name__)
+
+_replayer = None # spool.SpoolReplayer của tiến trình (None nếu spool tắt hoặc không mở được)
+_replayer_lock = threading.Lock()
+_replayer_opened = False
+_validator = None # anomaly.QuoteValidator (None nếu ANOMALY_MODE=off), tạo và khởi tạo từ lịch sử lúc khởi động
+_validator_lock = threading.Lock()
+_validator_created = False
+_coordinator = None # leader.LeaderElection khi chạy nhiều node (COLLECTOR_COORDINATION=advisory)
+
+def get_replayer():
+    """Mở spool cục bộ (một lần cho mỗi tiến trình) nếu SPOOL_ENABLED; None nếu không dùng được spool."""
+    global _replayer, _replayer_opened
+    with _replayer_lock:
+        if not _replayer_opened:
+            _replayer_opened = True
+            if config.SPOOL_ENABLED:
+                try:
+                    _replayer = spool.SpoolReplayer(spool.Spool())
+                except (spool.SpoolLockedError, OSError) as e:
+                    logger.warning(f"Không dùng được spool cục bộ ({e}), snapshot sẽ được ghi thẳng vào CSDL.")
+        return _replayer
+
+def close_replayer():
+    """Dừng thread ghi bù (nếu có), thử ghi nốt phần còn lại rồi đóng spool."""
+    global _replayer, _replayer_opened
+    with _replayer_lock:
+        replayer, _replayer, _replayer_opened = _replayer, None, False
+    if replayer is not None:
+        replayer.stop()
+        replayer.spool.close()
+
+def _write_snapshot(snapshot):
+    rows = snapshot.rows()
+    # Ghi cả snapshot trong một transaction: hoặc đủ cả, hoặc không có dòng nào
+    if snapshot.kind == sources.KIND_EXCHANGE_RATES:
+        written = database.insert_exchange_rates_batch(rows, snapshot.source_update_time, source=snapshot.source)
     else:
-        print("Không lấy được dữ liệu giá vàng từ SJC.")
+        written = database.insert_gold_prices_batch(rows, snapshot.source_update_time, provider=snapshot.source)
+    logger.info(f"Đã ghi {written}/{len(rows)} bản ghi của {snapshot.source} vào PostgreSQL.",
+                extra={'source': snapshot.source, 'source_update_time': snapshot.source_update_time,
+                       'rows': len(rows), 'written': written})
+    return written
+
+def get_validator():
+    """Bộ kiểm tra giá bất thường của tiến trình (tạo một lần); None nếu ANOMALY_MODE=off."""
+    global _validator, _validator_created
+    with _validator_lock:
+        if not _validator_created:
+            _validator_created = True
+            _validator = anomaly.from_config()
+        return _validator
 
-    # 3. Hiển thị tỷ giá mới nhất vừa được lưu (hoặc đã có) trong CSDL PostgreSQL
+def _check_quotes(snapshot):
+    """Bước kiểm tra giá bất thường giữa scraper và việc ghi; trả về snapshot cần ghi (None nếu không còn dòng nào)."""
+    validator = get_validator()
+    if validator is None:
+        return snapshot
+    checked, anomalies = validator.validate(snapshot)
+    if anomalies:
+        for record in anomalies:
+            metrics.QUOTE_ANOMALIES.labels(snapshot.source, record['action']).inc()
+        try:
+            database.insert_quarantined_quotes(anomalies)
+        except psycopg2.Error as e:
+            logger.error(f"Không ghi được {len(anomalies)} dòng giá bất thường vào QuarantinedQuotes: {e}")
+    return checked
+
+def store_snapshot(source, snapshot):
+    """
+    Lưu snapshot của một nguồn (services.sources.Snapshot): ghi nối vào spool cục bộ rồi báo cho
+    thread ghi bù, nên không chờ CSDL. Khi không có spool, ghi thẳng vào CSDL trong một transaction.
+    """
+    if snapshot is None:
+        metrics.SNAPSHOTS.labels(source.name, 'empty').inc()
+        logger.warning(f"Không lấy được dữ liệu từ {source.name}. Bỏ qua việc lưu vào CSDL.", extra={'source': source.name})
+        return
+    snapshot = _check_quotes(snapshot)
+    if snapshot is None:
+        metrics.SNAPSHOTS.labels(source.name, 'quarantined').inc()
+        return
+    replayer = get_replayer()
+    if replayer is not None:
+        try:
+            seq = replayer.spool.append(spool.snapshot_record(snapshot))
+        except OSError as e:
+            logger.error(f"Không ghi được snapshot {snapshot.source} vào spool ({e}), ghi thẳng vào CSDL.")
+        else:
+            logger.debug(f"Đã ghi snapshot {snapshot.source} vào spool (seq {seq}).",
+                         extra={'source': snapshot.source, 'seq': seq, 'rows': len(snapshot.quotes)})
+            replayer.wake()
+            return
+    _write_snapshot(snapshot)
+
+def drain_spool():
+    """Ghi đồng bộ phần spool chưa ghi (khi không có thread ghi bù chạy nền). Trả về số dòng đã ghi."""
+    replayer = get_replayer()
+    if replayer is None or replayer.running:
+        return 0
+    try:
+        return replayer.replay_pending()
+    except psycopg2.Error as e:
+        logger.warning(f"Chưa ghi được spool vào CSDL ({e}); {replayer.pending()} snapshot được giữ lại cho lần chạy sau.")
+        return 0
+
+def fetch_and_store_all_sources(source_list=None):
+    """
+    Lấy dữ liệu từ tất cả các nguồn đã đăng ký (services.sources) song song, mỗi nguồn một thread
+    với deadline riêng. Nguồn nào trả về trước được lưu ngay (vào spool), nên tổng thời gian xấp xỉ
+    thời gian của nguồn chậm nhất. Nguồn vượt deadline bị bỏ qua trong lần cập nhật này.
+    Khi không có thread ghi bù chạy nền, spool được ghi vào CSDL ngay sau khi lấy xong.
+    """
+    succeeded = sources.run_sources(store_snapshot, source_list)
+    drain_spool()
+    return succeeded
+
+def display_latest_quotes():
+    """In bảng tỷ giá và giá vàng mới nhất trong CSDL ra stdout cho người đọc (lệnh "run --show")."""
     print("\n--- Tỷ giá mới nhất hiện có trong Cơ sở dữ liệu PostgreSQL ---")
     latest_rates_from_db = database.get_latest_rates()
     if latest_rates_from_db:
@@ -95,8 +169,133 @@ def run_update_exchange_rates():
             print(f"- {gold['gold_type_name']} (Provider: {gold['provider']}): Mua: {buy_price_display}, Bán: {sell_price_display} ({gold['unit']}). (SJC: {source_update_display}, App: {date_recorded_display})")
     else:
         print("Không có dữ liệu giá vàng SJC trong CSDL.")
-    
-    print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] --- Hoàn tất quá trình cập nhật (PostgreSQL) ---")
+
+def run_update_exchange_rates(show=False):
+    """Một lần cập nhật (lệnh "run"): lấy và lưu mọi nguồn, cập nhật nến; show=True in thêm bảng giá mới nhất."""
+    logger.info("Bắt đầu cập nhật dữ liệu từ các nguồn (song song)")
+
+    # 1. Lấy dữ liệu từ mọi nguồn đã đăng ký song song, lưu ngay khi từng nguồn trả về
+    #    (chạy nhiều node: chỉ các nguồn node này giành được khóa, giữ đến khi tiến trình kết thúc)
+    source_list = None
+    if _coordinator is not None:
+        source_list = [s for s in sources.registered_sources() if _coordinator.is_leader(f"source:{s.name}")]
+    fetch_and_store_all_sources(source_list)
+
+    # Cập nhật các nến OHLC chịu ảnh hưởng bởi tick mới
+    if _coordinator is None or _coordinator.is_leader('job:candles'):
+        database.update_candles()
+
+    logger.info("Hoàn tất quá trình cập nhật")
+
+    # 3. Hiển thị tỷ giá mới nhất vừa được lưu (hoặc đã có) trong CSDL PostgreSQL (chỉ khi được yêu cầu)
+    if show:
+        display_latest_quotes()
+
+def _leader_only(name, func):
+    """Job của daemon chỉ chạy func() khi node này được bầu chạy `name` (luôn chạy nếu không bật coordination)."""
+    if _coordinator is None:
+        return func
+
+    @functools.wraps(func)
+    def job():
+        if _coordinator.is_leader(name):
+            return func()
+        logger.debug(f"{name} đang do node khác chạy, bỏ qua", extra={'job': name})
+    return job
+
+def _poll_source(source, after_store=None):
+    """Một lần poll của chế độ daemon: lấy dữ liệu một nguồn (có deadline, rate limit) rồi lưu ngay."""
+    logger.debug(f"Poll {source.name}", extra={'source': source.name})
+    sources.run_sources(store_snapshot, [source])
+    if after_store is not None:
+        after_store()
+
+def run_daemon(with_api=False):
+    """
+    Chạy thường trú: mỗi nguồn được poll theo chu kỳ riêng (có jitter) trong thread riêng,
+    không bao giờ có hai lần poll cùng một nguồn chạy đồng thời. Pool kết nối CSDL, HTTP session
+    và cache bảng chiều được giữ mở giữa các lần poll. Dừng êm khi nhận SIGTERM/SIGINT.
+    with_api=True: chạy kèm API đọc tỷ giá, cache của API được làm mới ngay sau mỗi lần ghi.
+    """
+    logger.info("Khởi động chế độ daemon")
+    scheduler = PollingScheduler()
+    quote_cache = server = None
+    if with_api:
+        quote_cache = api.QuoteCache()
+        server = api.make_server(quote_cache)
+        api.start_in_background(server)
+    elif config.METRICS_PORT > 0:
+        # Không có API thì /metrics được phục vụ bởi server riêng
+        metrics.start_metrics_server(config.METRICS_PORT)
+        logger.info(f"Metric Prometheus tại http://0.0.0.0:{config.METRICS_PORT}/metrics")
+    after_store = quote_cache.refresh if quote_cache else None
+    replayer = get_replayer()
+    if replayer is not None:
+        # Dữ liệu vào CSDL qua thread ghi bù của spool: làm mới cache API sau khi ghi, không phải sau khi poll
+        replayer.on_replayed, after_store = after_store, None
+        replayer.start()
+    if _coordinator is not None:
+        logger.info(f"Chạy nhiều node: node {_coordinator.node_id} chỉ poll các nguồn/job nó giữ khóa")
+    for source in sources.registered_sources():
+        poll = functools.partial(_poll_source, source, after_store)
+        scheduler.add_job(source.name, _leader_only(f"source:{source.name}", poll), source.poll_interval, config.POLL_JITTER)
+        logger.info(f"{source.name}: poll mỗi {source.poll_interval:.0f}s (±{config.POLL_JITTER:.0f}s)")
+    scheduler.add_job('candles', _leader_only('job:candles', database.update_candles), config.ROLLUP_INTERVAL, config.POLL_JITTER)
+    # Bảo trì partition (tạo partition tháng tới, áp dụng lưu giữ) mỗi ngày một lần
+    scheduler.add_job('partition-maintenance', _leader_only('job:partition-maintenance', database.run_partition_maintenance), 24 * 3600, 60)
+    scheduler.install_signal_handlers()
+    try:
+        scheduler.run_forever()
+    finally:
+        if _coordinator is not None:
+            _coordinator.release_all() # Node khác tiếp quản ngay, trong lúc node này ghi nốt spool
+        close_replayer()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    logger.info("Daemon đã dừng")
+
+def run_api_server():
+    """
+    Chỉ chạy API đọc tỷ giá (dữ liệu do một tiến trình khác ghi vào CSDL):
+    cache được làm mới mỗi API_REFRESH_INTERVAL giây, không phụ thuộc số client.
+    """
+    quote_cache = api.QuoteCache()
+    quote_cache.refresh()
+    server = api.make_server(quote_cache)
+    api.start_in_background(server)
+    scheduler = PollingScheduler()
+    scheduler.add_job('quote-cache', quote_cache.refresh, config.API_REFRESH_INTERVAL)
+    scheduler.install_signal_handlers()
+    try:
+        scheduler.run_forever()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Thu thập tỷ giá Vietcombank và giá vàng SJC vào PostgreSQL.")
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help="Cập nhật một lần rồi thoát (mặc định)")
+    run_parser.add_argument('--show', action='store_true', help="In bảng tỷ giá và giá vàng mới nhất sau khi cập nhật")
+    daemon_parser = subparsers.add_parser('daemon', help="Chạy thường trú, poll từng nguồn theo chu kỳ cấu hình")
+    daemon_parser.add_argument('--api', action='store_true', help="Chạy kèm API đọc tỷ giá (API_HOST:API_PORT)")
+    subparsers.add_parser('serve', help="Chỉ chạy API đọc tỷ giá/giá vàng (API_HOST:API_PORT)")
+    migrate_parser = subparsers.add_parser('migrate', help="Áp dụng các migration schema CSDL còn thiếu")
+    migrate_parser.add_argument('--check', action='store_true', help="Chỉ in phiên bản schema hiện tại và phiên bản cần, không thay đổi CSDL")
+    subparsers.add_parser('maintenance', help="Tạo partition cho các tháng tới và áp dụng chính sách lưu giữ")
+    subparsers.add_parser('rebuild-latest', help="Dựng lại bảng tỷ giá/giá vàng mới nhất từ lịch sử")
+    subparsers.add_parser('rollup', help="Cập nhật các bảng nến OHLC từ tick mới kể từ watermark")
+    export_parser = subparsers.add_parser('export', help="Xuất tăng dần lịch sử ra data/processed (Parquet/Arrow IPC, chia theo ngày)")
+    export_parser.add_argument('--format', choices=sorted(dataset.EXPORT_FORMATS), default=config.EXPORT_FORMAT, help="Định dạng file xuất")
+    export_parser.add_argument('--output-dir', default=str(config.PROCESSED_DATA_DIR), help="Thư mục gốc của các bộ dữ liệu xuất ra")
+    backfill_parser = subparsers.add_parser('backfill', help="Nạp bù tỷ giá Vietcombank cho một khoảng ngày (tiếp tục được sau khi bị ngắt)")
+    backfill_parser.add_argument('--start', required=True, type=date.fromisoformat, help="Ngày bắt đầu (YYYY-MM-DD)")
+    backfill_parser.add_argument('--end', type=date.fromisoformat, default=date.today(), help="Ngày kết thúc (YYYY-MM-DD), mặc định hôm nay")
+    backfill_parser.add_argument('--workers', type=int, default=config.BACKFILL_WORKERS, help="Số ngày được lấy song song")
+    backfill_parser.add_argument('--rate', type=float, default=config.BACKFILL_RATE_LIMIT, help="Số request tối đa mỗi giây")
+    backfill_parser.add_argument('--checkpoint', default=str(config.BACKFILL_CHECKPOINT_PATH), help="File checkpoint các ngày đã nạp xong")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
     # Rất quan trọng: Đảm bảo bạn đã cấu hình đúng các biến môi trường
@@ -107,4 +306,51 @@ if __name__ == "__main__":
     # os.environ["PG_PASSWORD"] = "your_secret_password"
     # os.environ["PG_DATABASE"] = "vcb_rates_db"
     
-    run_update_exchange_rates()
\ No newline at end of file
+    args = parse_args()
+    log_config.setup_logging()
+    try:
+        if args.command == 'migrate':
+            if args.check:
+                print(f"Phiên bản schema: {database.get_schema_version()} (mã nguồn cần: {database.SCHEMA_VERSION})")
+                sys.exit(0)
+            # Mã thoát khác 0 khi migration lỗi, để script triển khai không chạy tiếp run/daemon
+            sys.exit(0 if database.create_tables_postgres() else 1)
+        # Chỉ so phiên bản schema (một truy vấn); DDL chỉ chạy khi gọi "migrate"
+        try:
+            schema_ok = database.verify_schema()
+        except psycopg2.OperationalError:
+            # CSDL chưa truy cập được: việc thu thập vẫn chạy, dữ liệu được giữ trong spool
+            if args.command not in (None, 'run', 'daemon') or not config.SPOOL_ENABLED:
+                sys.exit(1)
+            schema_ok = True
+        if not schema_ok:
+            sys.exit(1)
+        database.preload_dimension_cache() # Một truy vấn lúc khởi động, sau đó ID lấy từ bộ nhớ
+        if args.command in (None, 'run', 'daemon'):
+            _coordinator = leader.from_config()
+            validator = get_validator()
+            if validator is not None:
+                validator.ensure_seeded() # Truy vấn lịch sử ở đây, không trong thread lấy dữ liệu của nguồn đầu tiên
+        if args.command == 'daemon':
+            run_daemon(with_api=args.api)
+        elif args.command == 'serve':
+            run_api_server()
+        elif args.command == 'maintenance':
+            database.run_partition_maintenance()
+        elif args.command == 'rebuild-latest':
+            database.rebuild_latest_tables()
+        elif args.command == 'rollup':
+            logger.info(f"Đã rollup {database.update_candles()} tick vào bảng nến OHLC.")
+        elif args.command == 'export':
+            logger.info(f"Đã xuất tổng cộng {dataset.export_history(args.output_dir, args.format)} dòng.")
+        elif args.command == 'backfill':
+            backfill.run_backfill(args.start, args.end, args.workers, args.rate, args.checkpoint)
+            logger.info(f"Đã rollup {database.update_candles()} tick vào bảng nến OHLC.")
+        else:
+            run_update_exchange_rates(show=getattr(args, 'show', False)) # Không có lệnh con: không có --show
+    finally:
+        if _coordinator is not None:
+            _coordinator.release_all()
+        close_replayer()
+        database.close_pool() # Đóng các kết nối trong pool trước khi thoát
+        http_session.close_session()
\ No newline at end of file
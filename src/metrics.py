@@ -0,0 +1,109 @@
+# src/metrics.py
+"""
+Metric của ứng dụng theo định dạng Prometheus (dùng prometheus_client).
+Xem qua endpoint /metrics của API (main.py serve / daemon --api),
+hoặc server metrics riêng khi chạy daemon với METRICS_PORT > 0.
+"""
+import functools
+import logging
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest, start_http_server
+
+# Bucket (giây) cho các thao tác từ vài ms (truy vấn CSDL) đến vài chục giây (HTTP có retry)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'exchange_http_request_duration_seconds',
+    "Thời gian một lần gửi HTTP tới nguồn dữ liệu (mỗi lần thử lại tính riêng)",
+    ['source', 'method', 'status'], buckets=LATENCY_BUCKETS
+)
+PARSE_SECONDS = Histogram(
+    'exchange_parse_duration_seconds', "Thời gian phân tích response của nguồn",
+    ['source'], buckets=LATENCY_BUCKETS
+)
+SNAPSHOT_ROWS = Gauge('exchange_snapshot_rows', "Số dòng trong snapshot gần nhất của nguồn", ['source'])
+ROWS_WRITTEN = Counter('exchange_rows_written_total', "Số dòng lịch sử đã ghi vào CSDL", ['source'])
+SNAPSHOTS = Counter(
+    'exchange_snapshots_total', "Số snapshot đã xử lý theo kết quả (written/unchanged/failed/empty/timeout/skipped/quarantined)", ['source', 'result']
+)
+LAST_SUCCESS = Gauge(
+    'exchange_last_success_timestamp_seconds', "Thời điểm (Unix) ghi thành công snapshot gần nhất", ['source']
+)
+DB_QUERY_SECONDS = Histogram(
+    'exchange_db_query_duration_seconds', "Thời gian thực thi các hàm CSDL",
+    ['function'], buckets=LATENCY_BUCKETS
+)
+DB_QUERY_ERRORS = Counter(
+    'exchange_db_query_errors_total', "Số lần hàm CSDL kết thúc bằng exception (người gọi có thể đã xử lý hoặc thử lại)",
+    ['function']
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    'exchange_db_pool_wait_seconds', "Thời gian chờ mượn kết nối từ pool", buckets=LATENCY_BUCKETS
+)
+JOB_SECONDS = Histogram(
+    'exchange_job_duration_seconds', "Thời gian một lần chạy job của daemon", ['job'], buckets=LATENCY_BUCKETS
+)
+QUOTE_ANOMALIES = Counter(
+    'exchange_quote_anomalies_total', "Số dòng giá bị phát hiện bất thường theo cách xử lý (quarantined/flagged)", ['source', 'action']
+)
+LEADER = Gauge('exchange_collector_leader', "1 nếu node này đang giữ quyền chạy nguồn/job (chế độ nhiều node)", ['job'])
+SPOOL_DEAD_LETTERS = Counter(
+    'exchange_spool_dead_letters_total', "Số snapshot trong spool không ghi được vì lỗi dữ liệu, đã chuyển sang file dead-letter"
+)
+SPOOL_PENDING = Gauge('exchange_spool_pending_snapshots', "Số snapshot trong spool cục bộ chưa được ghi vào CSDL")
+# Chỉ được đếm bởi ErrorCountingHandler (mỗi bản ghi log mức ERROR một lần), nên tổng theo mọi nhãn có nghĩa
+ERRORS = Counter('exchange_errors_total', "Số bản ghi log mức ERROR trở lên theo thành phần (tên logger)", ['component'])
+
+
+def observe_http(source, method, status, seconds):
+    HTTP_REQUEST_SECONDS.labels(source, method, str(status)).observe(seconds)
+
+
+def record_snapshot(source, rows, written):
+    """Ghi nhận kết quả ghi một snapshot: rows = số dòng của snapshot, written = số dòng đã ghi (0 nếu không đổi, None nếu lỗi)."""
+    SNAPSHOT_ROWS.labels(source).set(rows)
+    if written is None:
+        SNAPSHOTS.labels(source, 'failed').inc()
+        return
+    SNAPSHOTS.labels(source, 'written' if written else 'unchanged').inc()
+    ROWS_WRITTEN.labels(source).inc(written)
+    LAST_SUCCESS.labels(source).set_to_current_time()
+
+
+def timed_db(func):
+    """Decorator: đo thời gian hàm CSDL theo tên hàm; lỗi thoát ra khỏi hàm được đếm vào exchange_db_query_errors_total."""
+    histogram = DB_QUERY_SECONDS.labels(func.__name__)
+    errors = DB_QUERY_ERRORS.labels(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started)
+    return wrapper
+
+
+class ErrorCountingHandler(logging.Handler):
+    """Handler logging đếm mọi bản ghi mức ERROR trở lên vào exchange_errors_total theo tên logger."""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record):
+        ERRORS.labels(record.name).inc()
+
+
+def render():
+    """(body, content type) của toàn bộ metric theo định dạng text của Prometheus."""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    """Mở endpoint /metrics riêng (thread nền) khi không chạy kèm API."""
+    start_http_server(port, addr=host)
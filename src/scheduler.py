@@ -0,0 +1,80 @@
+# src/scheduler.py
+import logging
+import random
+import signal
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PollingScheduler:
+    """
+    Bộ lập lịch cho chế độ thường trú (daemon).
+    Mỗi job chạy trong một thread riêng theo chu kỳ của nó (cộng thêm jitter ngẫu nhiên),
+    nên một job không bao giờ chạy chồng lên chính nó; nếu một lần chạy kéo dài quá chu kỳ,
+    lần kế tiếp bắt đầu ngay sau khi lần đó kết thúc.
+    """
+
+    def __init__(self):
+        self.stop_event = threading.Event()
+        self._jobs = []
+        self._threads = []
+
+    def add_job(self, name, func, interval, jitter=0.0):
+        """Đăng ký job `func` chạy mỗi `interval` giây, lệch ngẫu nhiên trong khoảng ±`jitter` giây."""
+        self._jobs.append((name, func, float(interval), float(jitter)))
+
+    def _run_job(self, name, func, interval, jitter):
+        # Rải thời điểm chạy lần đầu để các job không cùng bắn một lúc
+        if self.stop_event.wait(random.uniform(0, jitter)):
+            return
+        next_run = time.monotonic()
+        duration = metrics.JOB_SECONDS.labels(name)
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            try:
+                func()
+            except Exception as e: # Một lần poll lỗi không được làm dừng cả daemon
+                logger.exception(f"Lỗi khi chạy job {name}: {e}", extra={'job': name})
+            elapsed = time.monotonic() - started
+            duration.observe(elapsed)
+            if elapsed > interval:
+                logger.warning(f"Job {name} chạy mất {elapsed:.1f}s, lâu hơn chu kỳ {interval:.1f}s.",
+                               extra={'job': name, 'elapsed': round(elapsed, 3)})
+
+            next_run = max(next_run + interval, time.monotonic())
+            delay = max(0.0, next_run - time.monotonic() + random.uniform(-jitter, jitter))
+            self.stop_event.wait(delay)
+
+    def start(self):
+        for name, func, interval, jitter in self._jobs:
+            thread = threading.Thread(
+                target=self._run_job,
+                args=(name, func, interval, jitter),
+                name=f"poll-{name}",
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, *_):
+        """Yêu cầu dừng; các job đang chạy được phép chạy xong lần hiện tại."""
+        if not self.stop_event.is_set():
+            logger.info("Nhận tín hiệu dừng, đang chờ các job đang chạy kết thúc...")
+        self.stop_event.set()
+
+    def install_signal_handlers(self):
+        """Dừng êm khi nhận SIGTERM (systemd, docker stop) hoặc SIGINT (Ctrl+C). Phải gọi từ main thread."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def run_forever(self, join_timeout=60):
+        """Khởi động các job và chặn cho đến khi có yêu cầu dừng."""
+        self.start()
+        while not self.stop_event.wait(1):
+            pass
+        for thread in self._threads:
+            thread.join(timeout=join_timeout)
@@ -0,0 +1,169 @@
+# src/services/http_session.py
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Cấu hình HTTP dùng chung cho các scraper ---
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))          # Số lần thử lại tối đa sau lần gửi đầu tiên
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))    # Giây chờ cơ sở cho exponential backoff
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "8"))        # Trần thời gian chờ giữa hai lần thử
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "10"))       # Số kết nối keep-alive giữ lại cho mỗi host
+HTTP_MAX_PER_HOST = int(os.getenv("HTTP_MAX_PER_HOST", "4"))        # Số request tối đa gửi đồng thời tới cùng một host
+HTTP_VALIDATOR_CACHE_SIZE = 64 # Số URL được nhớ ETag/Last-Modified cho conditional GET
+
+# Lỗi tạm thời đáng để thử lại
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+_validators = OrderedDict() # url -> (etag, last_modified, response gần nhất có status 200)
+_validators_lock = threading.Lock()
+_host_slots = {} # host -> BoundedSemaphore giới hạn số request đồng thời
+_host_slots_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Trả về requests.Session dùng chung cho cả tiến trình.
+    Session giữ kết nối keep-alive theo host, nên các lần poll liên tiếp không phải
+    tra DNS, mở TCP và bắt tay TLS lại từ đầu.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            # Việc thử lại do request() đảm nhận (có jitter), adapter không tự thử lại
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def close_session():
+    """Đóng session dùng chung và các kết nối keep-alive của nó."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+    with _validators_lock:
+        _validators.clear()
+
+
+def _host_slot(url):
+    """Semaphore của host trong url: các thread gửi tới cùng host không vượt quá HTTP_MAX_PER_HOST request cùng lúc."""
+    host = urlparse(url).netloc
+    with _host_slots_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = threading.BoundedSemaphore(max(1, HTTP_MAX_PER_HOST))
+        return slot
+
+
+def _backoff_delay(attempt, response=None):
+    """
+    Thời gian chờ trước lần thử thứ attempt+1: exponential backoff có trần với "full jitter"
+    (ngẫu nhiên trong [0, min(trần, cơ sở * 2^attempt)]) để các tiến trình không thử lại cùng lúc.
+    Tôn trọng header Retry-After (dạng số giây) nếu server gửi, nhưng không vượt trần.
+    """
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), HTTP_BACKOFF_MAX)
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _conditional_headers(url):
+    with _validators_lock:
+        cached = _validators.get(url)
+        if cached is None:
+            return {}, None
+        _validators.move_to_end(url)
+    etag, last_modified, cached_response = cached
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers, cached_response
+
+
+def _remember_validators(url, response):
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if not etag and not last_modified:
+        return # Nguồn không hỗ trợ conditional GET
+    with _validators_lock:
+        _validators[url] = (etag, last_modified, response)
+        _validators.move_to_end(url)
+        while len(_validators) > HTTP_VALIDATOR_CACHE_SIZE:
+            _validators.popitem(last=False)
+
+
+def request(method, url, conditional=False, max_retries=None, source=None, **kwargs):
+    """
+    Gửi HTTP request qua session dùng chung, thử lại khi gặp lỗi tạm thời
+    (timeout, lỗi kết nối, HTTP 429/5xx) với exponential backoff có trần và jitter.
+
+    conditional=True (chỉ nên dùng cho GET): gửi If-None-Match / If-Modified-Since theo
+    ETag / Last-Modified của lần trước. Nếu server trả 304, hàm trả về response đã lưu
+    của lần trước, nên người gọi xử lý như một response 200 bình thường.
+
+    Khi hết số lần thử, ném lại requests.exceptions.RequestException của lần cuối
+    (giống requests.get/requests.post), hoặc trả về response lỗi cuối cùng để người gọi raise_for_status().
+
+    source: nhãn nguồn cho metric thời gian/status HTTP (mặc định là host của URL).
+    Mỗi lần gửi chiếm một chỗ trong giới hạn HTTP_MAX_PER_HOST của host (không giữ chỗ khi chờ backoff).
+    """
+    max_retries = HTTP_MAX_RETRIES if max_retries is None else max_retries
+    source = source or urlparse(url).hostname
+    headers = dict(kwargs.pop('headers', None) or {})
+    cached_response = None
+    if conditional:
+        conditional_headers, cached_response = _conditional_headers(url)
+        headers.update(conditional_headers)
+
+    session = get_session()
+    host_slot = _host_slot(url)
+    for attempt in range(max_retries + 1):
+        started = time.perf_counter()
+        try:
+            with host_slot:
+                response = session.request(method, url, headers=headers, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            metrics.observe_http(source, method, type(e).__name__, time.perf_counter() - started)
+            if attempt >= max_retries:
+                raise
+            delay = _backoff_delay(attempt)
+            logger.warning(f"Lỗi tạm thời khi gọi {url} ({type(e).__name__}), thử lại sau {delay:.2f}s ({attempt + 1}/{max_retries}).",
+                           extra={'source': source, 'attempt': attempt + 1})
+            time.sleep(delay)
+            continue
+
+        metrics.observe_http(source, method, response.status_code, time.perf_counter() - started)
+        if response.status_code == 304 and cached_response is not None:
+            logger.debug(f"Nguồn {url} báo chưa thay đổi (304), dùng lại dữ liệu lần trước.")
+            return cached_response
+        if response.status_code in RETRY_STATUS_CODES and attempt < max_retries:
+            delay = _backoff_delay(attempt, response)
+            logger.warning(f"{url} trả về HTTP {response.status_code}, thử lại sau {delay:.2f}s ({attempt + 1}/{max_retries}).",
+                           extra={'source': source, 'status': response.status_code, 'attempt': attempt + 1})
+            response.close()
+            time.sleep(delay)
+            continue
+
+        if conditional and response.status_code == 200:
+            _remember_validators(url, response)
+        return response
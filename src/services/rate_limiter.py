@@ -0,0 +1,32 @@
+# src/services/rate_limiter.py
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Giới hạn tốc độ kiểu token bucket, dùng chung được giữa nhiều thread:
+    trung bình tối đa `rate` lần mỗi giây, cho phép dồn tối đa `burst` lần liền nhau.
+    """
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError("rate phải lớn hơn 0.")
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Chặn cho đến khi được phép gửi thêm một request."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
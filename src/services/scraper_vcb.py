@@ -2,13 +2,21 @@
 import requests
 from datetime import datetime
 import json
+import logging
+import time
+import metrics
+from services import http_session # Session dùng chung: keep-alive, conditional GET, retry/backoff
+
+logger = logging.getLogger(__name__)
 
 # URL API tỷ giá của Vietcombank
 VCB_EXCHANGE_RATE_API_URL = "https://www.vietcombank.com.vn/api/exchangerates"
 
-def fetch_exchange_rates_from_api():
+def fetch_exchange_rates_from_api(date=None, conditional=True):
     """
     Lấy dữ liệu tỷ giá từ API của Vietcombank.
+    date (datetime.date hoặc datetime): ngày cần lấy tỷ giá, mặc định là hôm nay.
+    conditional: gửi ETag/If-Modified-Since của lần trước (nên tắt khi nạp bù nhiều ngày lịch sử).
     Trả về một danh sách các dictionaries chứa tỷ giá và thời gian cập nhật từ nguồn.
     """
     headers = {
@@ -17,28 +25,29 @@ def fetch_exchange_rates_from_api():
         'Accept-Language': 'vi-VN,vi;q=0.9,en-US;q=0.8,en;q=0.7'
     }
     
-    # Lấy ngày hiện tại để gửi request
-    current_date = datetime.now().strftime('%Y-%m-%d')
-    api_url = f"{VCB_EXCHANGE_RATE_API_URL}?date={current_date}"
+    # Mặc định lấy ngày hiện tại để gửi request
+    request_date = (date or datetime.now()).strftime('%Y-%m-%d')
+    api_url = f"{VCB_EXCHANGE_RATE_API_URL}?date={request_date}"
     
-    print(f"Đang gửi yêu cầu tới API Vietcombank: {api_url}")
+    logger.debug(f"Đang gửi yêu cầu tới API Vietcombank: {api_url}")
     try:
-        response = requests.get(api_url, headers=headers, timeout=25)
+        response = http_session.request('GET', api_url, conditional=conditional, source='VCB', headers=headers, timeout=25)
         response.raise_for_status()
+        parse_started = time.perf_counter()
         data = response.json()
     except requests.exceptions.Timeout:
-        print("Lỗi: Yêu cầu tới API Vietcombank bị timeout.")
+        logger.error("Lỗi: Yêu cầu tới API Vietcombank bị timeout.")
         return None, None
     except requests.exceptions.RequestException as e:
-        print(f"Lỗi khi truy cập API Vietcombank: {e}")
+        logger.error(f"Lỗi khi truy cập API Vietcombank: {e}")
         return None, None
     except json.JSONDecodeError as e:
-        print(f"Lỗi khi phân tích JSON từ API: {e}")
+        logger.error(f"Lỗi khi phân tích JSON từ API: {e}")
         return None, None
 
     # Kiểm tra cấu trúc dữ liệu
     if not isinstance(data, dict) or 'Data' not in data:
-        print("Dữ liệu API không đúng định dạng mong đợi.")
+        logger.warning("Dữ liệu API không đúng định dạng mong đợi.")
         return None, None
 
     # Lấy thời gian cập nhật từ API
@@ -49,7 +58,7 @@ def fetch_exchange_rates_from_api():
             dt = datetime.fromisoformat(data['UpdatedDate'].replace('Z', '+00:00'))
             source_update_time_str = dt.strftime('%Y-%m-%d %H:%M:%S')
         except (ValueError, AttributeError) as e:
-            print(f"Lỗi khi xử lý thời gian cập nhật: {e}")
+            logger.error(f"Lỗi khi xử lý thời gian cập nhật: {e}")
             source_update_time_str = "Không xác định"
 
     extracted_rates = []
@@ -69,11 +78,12 @@ def fetch_exchange_rates_from_api():
                     'sell': sell
                 })
         except (ValueError, KeyError) as e:
-            print(f"Lỗi khi xử lý dữ liệu cho {item.get('currencyCode', 'Unknown')}: {e}")
+            logger.warning(f"Lỗi khi xử lý dữ liệu cho {item.get('currencyCode', 'Unknown')}: {e}")
             continue
 
+    metrics.PARSE_SECONDS.labels('VCB').observe(time.perf_counter() - parse_started)
     if not extracted_rates:
-        print("Không trích xuất được bản ghi tỷ giá nào từ API.")
+        logger.warning("Không trích xuất được bản ghi tỷ giá nào từ API.")
         return None, source_update_time_str
 
     return extracted_rates, source_update_time_str
@@ -82,7 +92,7 @@ def fetch_exchange_rates():
     """
     Hàm chính để lấy dữ liệu tỷ giá.
     """
-    print("Sử dụng API Vietcombank để lấy tỷ giá.")
+    logger.debug("Sử dụng API Vietcombank để lấy tỷ giá.")
     return fetch_exchange_rates_from_api()
 
 if __name__ == '__main__':
@@ -1,10 +1,25 @@
 # src/services/sjc_gold_scraper.py
 import requests
 import json # Để xử lý JSON response
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import config
+import metrics
+from services import http_session # Session dùng chung: keep-alive, retry/backoff
 from datetime import datetime
+
+logger = logging.getLogger(__name__)
 # import re # Không cần re nữa nếu có key thời gian rõ ràng
 
 SJC_PRICE_SERVICE_URL = "https://sjc.com.vn/GoldPrice/Services/PriceService.ashx"
+SJC_BRANCHES = config.SJC_BRANCHES # "1,2,..." hoặc "all"
+
+# Các BranchId có dữ liệu tìm được ở lần dò gần nhất (khi SJC_BRANCHES="all")
+_discovered_branches = None
+_discovered_at = 0.0
+_discovery_lock = threading.Lock()
 
 def _convert_sjc_numeric_value(value):
     """Chuyển đổi giá trị số từ SJC (thường là float với .0000) sang integer."""
@@ -23,7 +38,7 @@ def _parse_sjc_service_update_time(response_dict):
     response_dict là Python dictionary đã được parse từ JSON.
     """
     if not isinstance(response_dict, dict):
-        print("Lỗi: Dữ liệu phản hồi để parse thời gian không phải là dictionary.")
+        logger.error("Lỗi: Dữ liệu phản hồi để parse thời gian không phải là dictionary.")
         return datetime.now().strftime('%Y-%m-%d %H:%M:%S') # Fallback
 
     raw_time_str = response_dict.get("latestDate") # Ví dụ: "13:48 08/05/2025"
@@ -34,11 +49,11 @@ def _parse_sjc_service_update_time(response_dict):
             dt_obj_naive = datetime.strptime(raw_time_str, '%H:%M %d/%m/%Y')
             return dt_obj_naive.strftime('%Y-%m-%d %H:%M:%S')
         except ValueError as e:
-            print(f"Không parse được thời gian SJC từ service: '{raw_time_str}'. Lỗi: {e}")
+            logger.error(f"Không parse được thời gian SJC từ service: '{raw_time_str}'. Lỗi: {e}")
             # Nếu lỗi, thử trả về chuỗi gốc hoặc một giá trị mặc định có ý nghĩa hơn
             return raw_time_str # Trả về chuỗi gốc để có thể debug
     else:
-        print("Không tìm thấy key 'latestDate' hoặc giá trị không hợp lệ trong phản hồi từ service SJC.")
+        logger.warning("Không tìm thấy key 'latestDate' hoặc giá trị không hợp lệ trong phản hồi từ service SJC.")
         return datetime.now().strftime('%Y-%m-%d %H:%M:%S') # Fallback
 
 
@@ -50,7 +65,7 @@ def _parse_sjc_service_gold_items(response_dict):
     gold_prices_list = []
     
     if not isinstance(response_dict, dict):
-        print("Lỗi: Dữ liệu phản hồi để parse giá vàng không phải là dictionary.")
+        logger.error("Lỗi: Dữ liệu phản hồi để parse giá vàng không phải là dictionary.")
         return gold_prices_list
 
     gold_items_list = response_dict.get("data") # Key "data" chứa list các loại vàng
@@ -84,18 +99,21 @@ def _parse_sjc_service_gold_items(response_dict):
             # else:
                 # print(f"Warning: Bỏ qua mục vàng thiếu thông tin: Type={type_name_original}, BuyV={item.get('BuyValue')}, SellV={item.get('SellValue')}")
     else:
-        print("Không tìm thấy key 'data' hoặc giá trị không phải list trong phản hồi JSON từ service SJC.")
+        logger.warning("Không tìm thấy key 'data' hoặc giá trị không phải list trong phản hồi JSON từ service SJC.")
         
     return gold_prices_list
 
 
-def fetch_sjc_gold_from_service():
+def fetch_sjc_gold_from_service(branch_id='1', discovering=False):
     """
-    Lấy giá vàng SJC từ PriceService.ashx bằng POST request.
+    Lấy giá vàng SJC của một chi nhánh từ PriceService.ashx bằng POST request.
+    branch_id: BranchId của SJC (1 thường là TP.HCM hoặc chi nhánh trung tâm).
+    discovering: đang dò chi nhánh (SJC_BRANCHES="all"); BranchId không tồn tại trả về success=false
+    là chuyện bình thường nên chỉ ghi log DEBUG.
     """
     payload = {
         'method': 'GetCurrentGoldPricesByBranch',
-        'BranchId': '1' # BranchId=1 thường là TP.HCM hoặc chi nhánh trung tâm
+        'BranchId': str(branch_id)
     }
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
@@ -104,66 +122,161 @@ def fetch_sjc_gold_from_service():
         'Referer': 'https://sjc.com.vn/gia-vang-online' # Trang web gốc của request
     }
 
-    print(f"Đang gửi POST request tới SJC Price Service: {SJC_PRICE_SERVICE_URL}")
-    print(f"Payload: {payload}")
+    logger.debug(f"Đang gửi POST request tới SJC Price Service: {SJC_PRICE_SERVICE_URL}")
+    logger.debug(f"Payload: {payload}")
     
     source_update_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S') # Fallback
     gold_data_list = []
 
     try:
-        response = requests.post(SJC_PRICE_SERVICE_URL, headers=headers, data=payload, timeout=20)
+        # POST không dùng conditional request; chỉ hưởng keep-alive và retry
+        response = http_session.request('POST', SJC_PRICE_SERVICE_URL, source='SJC', headers=headers, data=payload, timeout=20)
         response.raise_for_status()
         
+        parse_started = time.perf_counter()
         raw_response_text = response.text # Lấy text để debug nếu JSON lỗi
         response_json = response.json() # Parse JSON
 
-        print("Phản hồi từ SJC Price Service là JSON.")
+        logger.debug("Phản hồi từ SJC Price Service là JSON.")
         # print(f"Dữ liệu JSON thô: {json.dumps(response_json, indent=2, ensure_ascii=False)}") # Debug: In ra JSON đẹp
 
         if response_json.get("success") is True:
             source_update_time = _parse_sjc_service_update_time(response_json)
             gold_data_list = _parse_sjc_service_gold_items(response_json)
+            metrics.PARSE_SECONDS.labels('SJC').observe(time.perf_counter() - parse_started)
             if not gold_data_list:
-                 print("Lấy dữ liệu thành công nhưng không phân tích được mục giá vàng nào.")
+                 logger.debug(f"BranchId={branch_id}: lấy dữ liệu thành công nhưng không có mục giá vàng nào.")
         else:
             error_message = response_json.get("message", "Lỗi không xác định từ SJC service (success=false).")
-            print(f"SJC Service báo lỗi: {error_message}")
+            logger.log(logging.DEBUG if discovering else logging.ERROR,
+                       f"SJC Service báo lỗi (BranchId={branch_id}): {error_message}")
             # source_update_time vẫn có thể có trong 'latestDate' ngay cả khi success=false
             source_update_time = _parse_sjc_service_update_time(response_json) # Thử parse thời gian
             return None, source_update_time # Trả về None cho data, nhưng có thể có thời gian
 
     except requests.exceptions.Timeout:
-        print(f"Lỗi: Yêu cầu tới SJC Price Service ({SJC_PRICE_SERVICE_URL}) bị timeout.")
+        logger.error(f"Lỗi: Yêu cầu tới SJC Price Service ({SJC_PRICE_SERVICE_URL}, BranchId={branch_id}) bị timeout.")
         return None, source_update_time
     except requests.exceptions.RequestException as e:
-        print(f"Lỗi khi POST request tới SJC Price Service: {e}")
+        logger.error(f"Lỗi khi POST request tới SJC Price Service (BranchId={branch_id}): {e}")
         return None, source_update_time
     except json.JSONDecodeError as e:
-        print(f"Lỗi giải mã JSON từ SJC Price Service: {e}.")
-        print(f"Phản hồi thô nhận được (đầu): {raw_response_text[:500] if raw_response_text else 'Không có'}")
+        logger.error(f"Lỗi giải mã JSON từ SJC Price Service: {e}.")
+        logger.debug(f"Phản hồi thô nhận được (đầu): {raw_response_text[:500] if raw_response_text else 'Không có'}")
         return None, source_update_time
     except Exception as e_general: # Bắt các lỗi không lường trước khác
-        print(f"Lỗi không xác định khi xử lý phản hồi từ SJC Price Service: {e_general}")
+        logger.error(f"Lỗi không xác định khi xử lý phản hồi từ SJC Price Service: {e_general}")
         return None, source_update_time
         
     return gold_data_list, source_update_time
 
 
+def _parse_branch_ids(spec):
+    """'1, 2,5' -> ['1', '2', '5']; 'all' -> None (dò mọi chi nhánh)."""
+    spec = (spec or '').strip()
+    if spec.lower() == 'all':
+        return None
+    branch_ids = [part.strip() for part in spec.split(',') if part.strip()]
+    return list(dict.fromkeys(branch_ids)) or ['1']
+
+
+def _latest_update_time(update_times):
+    """Thời gian cập nhật mới nhất trong các chuỗi '%Y-%m-%d %H:%M:%S' (bỏ qua chuỗi không parse được)."""
+    parsed = []
+    for value in update_times:
+        try:
+            parsed.append((datetime.strptime(value, '%Y-%m-%d %H:%M:%S'), value))
+        except (TypeError, ValueError):
+            continue
+    if parsed:
+        return max(parsed)[1]
+    return next((value for value in update_times if value), None)
+
+
+def _fetch_branches(branch_ids, discovering=False):
+    """Lấy song song các chi nhánh; số request đồng thời tới SJC do giới hạn theo host của http_session quyết định."""
+    with ThreadPoolExecutor(max_workers=len(branch_ids), thread_name_prefix='sjc-branch') as executor:
+        results = executor.map(lambda branch_id: fetch_sjc_gold_from_service(branch_id, discovering=discovering),
+                               branch_ids)
+        return dict(zip(branch_ids, results))
+
+
+def _branches_to_fetch():
+    """
+    Danh sách BranchId cần lấy trong lần này và cờ cho biết đây có phải lần dò chi nhánh không.
+    Với SJC_BRANCHES="all", lần đầu (và sau mỗi SJC_BRANCH_REFRESH_INTERVAL giây) dò 1..SJC_MAX_BRANCH_ID;
+    các lần khác chỉ lấy những chi nhánh đã dò thấy có dữ liệu.
+    """
+    branch_ids = _parse_branch_ids(SJC_BRANCHES)
+    if branch_ids is not None:
+        return branch_ids, False
+    with _discovery_lock:
+        if _discovered_branches and time.monotonic() - _discovered_at < config.SJC_BRANCH_REFRESH_INTERVAL:
+            return list(_discovered_branches), False
+    return [str(i) for i in range(1, config.SJC_MAX_BRANCH_ID + 1)], True
+
+
+def _remember_discovered_branches(results):
+    global _discovered_branches, _discovered_at
+    found = [branch_id for branch_id, (gold_data, _) in results.items() if gold_data]
+    if not found:
+        return # Lần dò thất bại (mạng, SJC lỗi): lần sau dò lại
+    with _discovery_lock:
+        _discovered_branches = found
+        _discovered_at = time.monotonic()
+    logger.info(f"Tìm thấy {len(found)} chi nhánh SJC có dữ liệu: BranchId {', '.join(found)}",
+                extra={'source': 'SJC', 'branches': len(found)})
+
+
+def fetch_sjc_gold_all_branches():
+    """
+    Lấy giá vàng của mọi chi nhánh cấu hình trong SJC_BRANCHES (song song) và gộp thành một snapshot.
+    Mỗi mục đã mang tên thành phố ('city', và hậu tố trong 'type_name'), nên các chi nhánh không đè nhau.
+    Thời gian cập nhật của snapshot là thời gian mới nhất trong các chi nhánh.
+    Chi nhánh lỗi bị bỏ qua; trả về (None, thời gian) nếu không chi nhánh nào có dữ liệu.
+    """
+    branch_ids, discovering = _branches_to_fetch()
+    results = _fetch_branches(branch_ids, discovering=discovering)
+    if discovering:
+        _remember_discovered_branches(results)
+
+    merged = {}
+    update_times = []
+    failed = []
+    for branch_id in branch_ids:
+        gold_data, update_time = results[branch_id]
+        if gold_data is None:
+            failed.append(branch_id)
+            continue
+        if gold_data:
+            update_times.append(update_time)
+        for item in gold_data:
+            merged[item['type_name']] = item
+    if failed and not discovering:
+        logger.warning(f"Không lấy được giá vàng của chi nhánh SJC: BranchId {', '.join(failed)}",
+                       extra={'source': 'SJC', 'failed_branches': len(failed)})
+
+    update_time = _latest_update_time(update_times) or _latest_update_time([t for _, t in results.values()])
+    if not merged:
+        return None, update_time
+    return list(merged.values()), update_time
+
+
 # Hàm chính để lấy dữ liệu giá vàng SJC
 def get_sjc_gold_data():
     """
     Hàm chính để lấy dữ liệu giá vàng SJC.
-    Hiện tại sử dụng POST request đến PriceService.ashx.
+    Hiện tại sử dụng POST request đến PriceService.ashx, một request cho mỗi chi nhánh trong SJC_BRANCHES.
     """
-    print("Đang lấy giá vàng SJC từ PriceService (POST)...")
-    gold_data, update_time = fetch_sjc_gold_from_service()
+    logger.debug("Đang lấy giá vàng SJC từ PriceService (POST)...")
+    gold_data, update_time = fetch_sjc_gold_all_branches()
     
     if gold_data:
-        print(f"Lấy giá vàng SJC từ PriceService thành công. Thời gian SJC cập nhật: {update_time}")
+        logger.info(f"Lấy giá vàng SJC từ PriceService thành công. Thời gian SJC cập nhật: {update_time}")
     elif update_time: # Có thể có update_time ngay cả khi gold_data là None (ví dụ service báo lỗi)
-        print(f"Không lấy được danh sách giá vàng chi tiết từ PriceService. Thời gian SJC (nếu có): {update_time}")
+        logger.warning(f"Không lấy được danh sách giá vàng chi tiết từ PriceService. Thời gian SJC (nếu có): {update_time}")
     else:
-        print("Hoàn toàn không lấy được dữ liệu/thời gian từ PriceService SJC.")
+        logger.warning("Hoàn toàn không lấy được dữ liệu/thời gian từ PriceService SJC.")
         
     return gold_data, update_time
 
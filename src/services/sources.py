@@ -0,0 +1,256 @@
+# src/services/sources.py
+"""
+Giao diện chung cho các nguồn giá (ngân hàng, doanh nghiệp vàng), registry các nguồn đã đăng ký
+và bộ chạy song song các nguồn.
+
+Thêm một nguồn mới:
+
+    class ABCBankSource(PriceSource):
+        name = 'ABC'                 # nhãn nguồn trong CSDL và metric
+        kind = KIND_EXCHANGE_RATES
+        timeout = 20                 # deadline của một lần lấy dữ liệu (giây)
+
+        def fetch(self):
+            ...
+            return Snapshot(self.name, self.kind, '2025-05-08 13:48:00', quotes)
+
+    register(ABCBankSource())
+
+Mỗi nguồn được lấy trong thread riêng, nên thời gian một vòng cập nhật xấp xỉ thời gian
+của nguồn chậm nhất (bị chặn bởi timeout của nó), không tăng theo số nguồn.
+"""
+import concurrent.futures
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import config
+import metrics
+from services import scraper_vcb
+from services import sjc_gold_scraper
+from services.rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+KIND_EXCHANGE_RATES = 'exchange_rates'
+KIND_GOLD_PRICES = 'gold_prices'
+
+
+@dataclass(frozen=True)
+class ExchangeRateQuote:
+    code: str
+    name: str
+    buy_cash: float = None
+    buy_transfer: float = None
+    sell: float = None
+
+    def as_row(self):
+        """Dict theo dạng database.insert_exchange_rates_batch nhận."""
+        return {'code': self.code, 'name': self.name, 'buy_cash': self.buy_cash,
+                'buy_transfer': self.buy_transfer, 'sell': self.sell}
+
+
+@dataclass(frozen=True)
+class GoldQuote:
+    type_name: str       # Tên đầy đủ, duy nhất trong một nhà cung cấp (vd "Vàng SJC 1L - Hà Nội")
+    original_type: str   # Tên loại vàng gốc của nguồn
+    city: str
+    buy: int = None
+    sell: int = None
+    unit: str = 'đồng/lượng'
+
+    def as_row(self):
+        """Dict theo dạng database.insert_gold_prices_batch nhận."""
+        return {'type_name': self.type_name, 'original_type': self.original_type, 'city': self.city,
+                'buy': self.buy, 'sell': self.sell, 'unit': self.unit}
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """
+    Toàn bộ giá một nguồn công bố tại một thời điểm.
+    source_update_time: thời gian cập nhật do nguồn công bố, dạng 'YYYY-MM-DD HH:MM:SS' giờ Việt Nam
+    (None nếu nguồn không cho biết).
+    """
+    source: str
+    kind: str
+    source_update_time: str
+    quotes: tuple
+    fetched_at: datetime = field(default_factory=lambda: datetime.now().astimezone())
+
+    def rows(self):
+        return [quote.as_row() for quote in self.quotes]
+
+
+class PriceSource:
+    """
+    Lớp cơ sở của một nguồn giá. Lớp con đặt các thuộc tính bên dưới và cài đặt fetch()
+    (nếu định nghĩa __init__ riêng thì phải gọi super().__init__()).
+      timeout:         deadline (giây) của một lần fetch trong run_sources()
+      poll_interval:   chu kỳ poll (giây) ở chế độ daemon
+      rate_limit:      số lần fetch tối đa mỗi giây (0 = không giới hạn)
+      max_concurrency: số lần fetch của nguồn được chạy đồng thời; lần fetch bị bỏ dở vì quá
+                       timeout vẫn chiếm chỗ đến khi thật sự kết thúc, nên một nguồn bị treo
+                       không làm dồn thêm thread ở các vòng sau.
+    """
+    name = None
+    kind = None
+    timeout = 30.0
+    poll_interval = 60.0
+    rate_limit = 0.0
+    max_concurrency = 1
+
+    def __init__(self):
+        self._slots = threading.BoundedSemaphore(max(1, self.max_concurrency))
+        self._limiter = RateLimiter(self.rate_limit, burst=self.max_concurrency) if self.rate_limit > 0 else None
+
+    def fetch(self):
+        """Lấy dữ liệu từ nguồn; trả về Snapshot, hoặc None nếu không lấy được."""
+        raise NotImplementedError
+
+    def try_acquire(self):
+        """Giữ một chỗ chạy của nguồn nếu còn; False nếu đã đủ max_concurrency lần fetch đang chạy."""
+        return self._slots.acquire(blocking=False)
+
+    def release(self):
+        self._slots.release()
+
+    def fetch_limited(self):
+        """fetch() sau khi chờ rate limit; nhả chỗ chạy đã giữ bằng try_acquire() khi xong."""
+        try:
+            if self._limiter is not None:
+                self._limiter.acquire()
+            return self.fetch()
+        finally:
+            self.release()
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.name}>"
+
+
+class VietcombankSource(PriceSource):
+    name = 'VCB'
+    kind = KIND_EXCHANGE_RATES
+    timeout = config.VCB_FETCH_DEADLINE
+    poll_interval = config.VCB_POLL_INTERVAL
+    rate_limit = config.VCB_RATE_LIMIT
+
+    def fetch(self):
+        rates, update_time = scraper_vcb.fetch_exchange_rates_from_api()
+        if not rates:
+            return None
+        return Snapshot(self.name, self.kind, update_time, tuple(ExchangeRateQuote(**rate) for rate in rates))
+
+
+class SJCSource(PriceSource):
+    name = 'SJC'
+    kind = KIND_GOLD_PRICES
+    timeout = config.SJC_FETCH_DEADLINE
+    poll_interval = config.SJC_POLL_INTERVAL
+    rate_limit = config.SJC_RATE_LIMIT
+
+    def fetch(self):
+        gold_items, update_time = sjc_gold_scraper.get_sjc_gold_data()
+        if not gold_items:
+            return None
+        return Snapshot(self.name, self.kind, update_time, tuple(GoldQuote(**item) for item in gold_items))
+
+
+# --- Registry ---
+_registry = {} # name -> PriceSource, theo thứ tự đăng ký
+_registry_lock = threading.Lock()
+
+
+def register(source):
+    """Đăng ký (hoặc thay thế, nếu trùng tên) một nguồn giá."""
+    if not source.name or source.kind not in (KIND_EXCHANGE_RATES, KIND_GOLD_PRICES):
+        raise ValueError(f"Nguồn {source!r} thiếu name hoặc kind không hợp lệ.")
+    with _registry_lock:
+        _registry[source.name] = source
+    return source
+
+
+def unregister(name):
+    with _registry_lock:
+        return _registry.pop(name, None)
+
+
+def get_source(name):
+    with _registry_lock:
+        return _registry.get(name)
+
+
+def registered_sources():
+    with _registry_lock:
+        return list(_registry.values())
+
+
+# --- Chạy song song ---
+def _start(executor, source):
+    if not source.try_acquire():
+        logger.warning(f"Nguồn {source.name} vẫn còn {source.max_concurrency} lần lấy dữ liệu chưa xong, bỏ qua lần này.",
+                       extra={'source': source.name})
+        metrics.SNAPSHOTS.labels(source.name, 'skipped').inc()
+        return None
+    try:
+        return executor.submit(source.fetch_limited)
+    except BaseException:
+        source.release()
+        raise
+
+
+def run_sources(on_snapshot, sources=None):
+    """
+    Lấy dữ liệu từ các nguồn (mặc định: mọi nguồn đã đăng ký) song song, mỗi nguồn một thread
+    với deadline `timeout` riêng. on_snapshot(source, snapshot) được gọi ngay trong thread của
+    người gọi khi từng nguồn trả về (snapshot là None nếu nguồn không lấy được dữ liệu);
+    nguồn vượt deadline bị bỏ qua trong lần này. Trả về số nguồn đã trả về Snapshot.
+    """
+    sources = registered_sources() if sources is None else list(sources)
+    if not sources:
+        return 0
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix='fetch')
+    started = time.monotonic()
+    pending = {}
+    for source in sources:
+        future = _start(executor, source)
+        if future is not None:
+            pending[future] = (source, started + source.timeout)
+    succeeded = 0
+    try:
+        while pending:
+            next_deadline = min(expires_at for _, expires_at in pending.values())
+            done, _ = concurrent.futures.wait(
+                pending,
+                timeout=max(0, next_deadline - time.monotonic()),
+                return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                source, _ = pending.pop(future)
+                try:
+                    snapshot = future.result()
+                except Exception as e:
+                    logger.error(f"Lỗi không xác định khi lấy dữ liệu từ {source.name}: {e}", extra={'source': source.name})
+                    continue
+                logger.debug(f"Nguồn {source.name} trả về sau {time.monotonic() - started:.2f}s", extra={'source': source.name})
+                if snapshot is not None:
+                    succeeded += 1
+                on_snapshot(source, snapshot)
+
+            now = time.monotonic()
+            for future, (source, expires_at) in list(pending.items()):
+                if expires_at <= now and not future.done():
+                    logger.warning(f"Nguồn {source.name} vượt quá deadline {source.timeout:g} giây, bỏ qua trong lần cập nhật này.",
+                                   extra={'source': source.name})
+                    metrics.SNAPSHOTS.labels(source.name, 'timeout').inc()
+                    del pending[future]
+    finally:
+        # Không chờ các thread đã quá hạn; chúng tự kết thúc theo timeout HTTP của scraper
+        executor.shutdown(wait=False)
+    return succeeded
+
+
+register(VietcombankSource())
+register(SJCSource())
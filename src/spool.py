@@ -0,0 +1,370 @@
+# src/spool.py
+"""
+Spool ghi trước (write-ahead) cục bộ cho các snapshot đã lấy được từ nguồn.
+
+Snapshot được ghi nối (append-only) thành một dòng JSON vào file trong config.SPOOL_DIR, mỗi dòng
+mang một số thứ tự `seq` tăng dần. SpoolReplayer đọc các dòng chưa ghi theo đúng thứ tự và ghi vào
+PostgreSQL theo lô lớn (database.insert_snapshots_bulk); mốc seq đã ghi được lưu trong bảng
+SpoolCheckpoints cùng transaction với dữ liệu, nên ghi lại một lô đã commit là không thể.
+Việc lấy dữ liệu chỉ chờ ghi file cục bộ, không chờ CSDL; khi CSDL không truy cập được, dữ liệu
+nằm lại trong spool và được ghi bù khi CSDL hoạt động lại.
+
+File spool (segment) được đặt tên theo seq đầu tiên nó chứa (000000000042.jsonl); segment đã được
+ghi hết vào CSDL bị xóa. Bản ghi không bao giờ ghi được vì lỗi dữ liệu (DataError, IntegrityError,
+bản ghi hỏng) được chuyển sang dead_letter.jsonl cùng thư mục để xem lại, và không chặn các bản ghi sau nó.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import psycopg2
+import psycopg2.pool
+
+import config
+import database
+import metrics
+
+try:
+    import fcntl
+except ImportError: # Windows: không khóa thư mục spool giữa các tiến trình
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.jsonl'
+DEAD_LETTER_FILE = 'dead_letter.jsonl'
+# Lỗi tạm thời (mất kết nối, hết kết nối trong pool, timeout, deadlock): thử lại cả lô với backoff
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.pool.PoolError, OSError)
+# Lỗi do chính nội dung bản ghi: thử lại không bao giờ thành công
+RECORD_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError, KeyError, TypeError, ValueError)
+
+
+class SpoolLockedError(RuntimeError):
+    """Thư mục spool đang được một tiến trình khác sử dụng."""
+
+
+def snapshot_record(snapshot):
+    """Dict ghi vào spool cho một services.sources.Snapshot."""
+    return {
+        'source': snapshot.source,
+        'kind': snapshot.kind,
+        'source_update_time': snapshot.source_update_time,
+        'fetched_at': snapshot.fetched_at.isoformat(),
+        'rows': snapshot.rows(),
+    }
+
+
+class Spool:
+    """
+    Log append-only các snapshot trên đĩa. Chỉ một tiến trình được mở một thư mục spool
+    (khóa bằng flock); trong tiến trình, append() an toàn khi gọi từ nhiều thread.
+    """
+
+    def __init__(self, directory=None, segment_bytes=None, fsync=None):
+        self.directory = Path(directory or config.SPOOL_DIR)
+        self.segment_bytes = segment_bytes or config.SPOOL_SEGMENT_BYTES
+        self.fsync = config.SPOOL_FSYNC if fsync is None else fsync
+        self._lock = threading.Lock()
+        self._active = None # File segment đang ghi (mở dạng append)
+        self._read_cursor = None # (path, offset, seq cuối đã đọc): đọc tiếp không phải parse lại từ đầu file
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = self._lock_directory()
+        self.spool_id = self._load_spool_id()
+        self._next_seq = self._recover()
+
+    def _lock_directory(self):
+        lock_file = open(self.directory / 'spool.lock', 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                raise SpoolLockedError(f"Thư mục spool '{self.directory}' đang được tiến trình khác sử dụng.")
+        return lock_file
+
+    def _load_spool_id(self):
+        # ID cố định của spool này, dùng làm khóa trong SpoolCheckpoints
+        path = self.directory / 'spool_id'
+        try:
+            return path.read_text(encoding='utf-8').strip()
+        except FileNotFoundError:
+            spool_id = uuid.uuid4().hex
+            path.write_text(spool_id, encoding='utf-8')
+            return spool_id
+
+    def _segments(self):
+        """[(seq đầu tiên, path)] của các segment, theo thứ tự."""
+        segments = []
+        for path in self.directory.glob(f"*{SEGMENT_SUFFIX}"):
+            if path.stem.isdigit():
+                segments.append((int(path.stem), path))
+        return sorted(segments)
+
+    def _recover(self):
+        """seq kế tiếp; cắt bỏ dòng ghi dở (tiến trình bị ngắt giữa chừng) ở cuối segment cuối."""
+        segments = self._segments()
+        if not segments:
+            return 1
+        first_seq, path = segments[-1]
+        with open(path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                logger.warning(f"Bỏ {len(data) - end} byte ghi dở ở cuối '{path.name}'.")
+                f.truncate(end)
+        last_seq = None
+        for line in data[:end].splitlines():
+            try:
+                last_seq = json.loads(line)['seq']
+            except (ValueError, KeyError):
+                continue
+        return first_seq if last_seq is None else last_seq + 1
+
+    def _segment_path(self, first_seq):
+        return self.directory / f"{first_seq:012d}{SEGMENT_SUFFIX}"
+
+    def _active_file(self):
+        if self._active is None:
+            segments = self._segments()
+            path = segments[-1][1] if segments else self._segment_path(self._next_seq)
+            self._active = open(path, 'ab')
+        return self._active
+
+    def _rotate(self):
+        """Đóng segment đang ghi; lần append sau bắt đầu segment mới (tạo sẵn, tên theo seq kế tiếp)."""
+        if self._active is not None:
+            self._active.close()
+            self._active = None
+        self._segment_path(self._next_seq).touch()
+
+    def append(self, record):
+        """Ghi nối một snapshot (dict, xem snapshot_record) và trả về seq của nó. Lỗi ghi đĩa ném OSError."""
+        with self._lock:
+            seq = self._next_seq
+            line = json.dumps({'seq': seq, **record}, ensure_ascii=False, default=str) + '\n'
+            f = self._active_file()
+            f.write(line.encode('utf-8'))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+            self._next_seq = seq + 1
+            if f.tell() >= self.segment_bytes:
+                self._rotate()
+        return seq
+
+    @property
+    def last_seq(self):
+        return self._next_seq - 1
+
+    def read(self, after_seq, max_rows):
+        """
+        Các bản ghi có seq > after_seq theo thứ tự, dừng khi tổng số dòng dữ liệu đạt max_rows
+        (luôn trả về ít nhất một bản ghi nếu còn). Dòng chưa ghi xong (không có '\\n') chưa được đọc.
+        """
+        with self._lock:
+            segments = self._segments()
+        cursor = self._read_cursor
+        records, rows = [], 0
+        for index, (first_seq, path) in enumerate(segments):
+            next_first = segments[index + 1][0] if index + 1 < len(segments) else None
+            if next_first is not None and next_first <= after_seq + 1:
+                continue # Cả segment đã được ghi
+            offset = cursor[1] if cursor and cursor[0] == path and cursor[2] <= after_seq else 0
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            with f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    try:
+                        record = json.loads(line)
+                    except ValueError as e:
+                        logger.error(f"Bỏ qua dòng hỏng trong '{path.name}': {e}")
+                        continue
+                    if record['seq'] <= after_seq:
+                        continue
+                    records.append(record)
+                    rows += len(record.get('rows') or ()) # Bản ghi thiếu 'rows' được dead-letter khi phát lại
+                    self._read_cursor = (path, offset, record['seq'])
+                    if rows >= max_rows:
+                        return records
+        return records
+
+    def truncate(self, upto_seq):
+        """Xóa các segment mà mọi bản ghi đều có seq <= upto_seq (đã được ghi vào CSDL)."""
+        with self._lock:
+            segments = self._segments()
+            for index, (first_seq, path) in enumerate(segments):
+                if index + 1 < len(segments):
+                    if segments[index + 1][0] > upto_seq + 1:
+                        break
+                elif upto_seq < self._next_seq - 1 or path.stat().st_size == 0:
+                    break
+                else:
+                    # Segment đang ghi đã được ghi hết: bắt đầu segment mới rồi xóa segment này
+                    self._rotate()
+                path.unlink(missing_ok=True)
+
+    def dead_letter(self, record, error):
+        """Ghi nối bản ghi không ghi được vào CSDL (kèm lỗi) vào file dead-letter của spool."""
+        entry = {'dead_lettered_at': datetime.now().astimezone().isoformat(), 'error': f"{type(error).__name__}: {error}",
+                 'record': record}
+        line = json.dumps(entry, ensure_ascii=False, default=str) + '\n'
+        with self._lock:
+            with open(self.directory / DEAD_LETTER_FILE, 'ab') as f:
+                f.write(line.encode('utf-8'))
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._active is not None:
+                self._active.close()
+                self._active = None
+        self._lock_file.close()
+
+
+class SpoolReplayer:
+    """
+    Ghi phần chưa ghi của spool vào CSDL theo lô (tối đa SPOOL_REPLAY_BATCH_ROWS dòng mỗi transaction).
+    Chạy đồng bộ bằng replay_pending(), hoặc trong thread nền bằng start(): thread được đánh thức
+    bởi wake() sau mỗi lần append, và khi CSDL lỗi thì thử lại với backoff có trần SPOOL_RETRY_MAX giây.
+    on_replayed(): gọi sau mỗi lần ghi được dữ liệu (vd làm mới cache của API).
+    """
+
+    def __init__(self, spool, batch_rows=None, on_replayed=None):
+        self.spool = spool
+        self.batch_rows = batch_rows or config.SPOOL_REPLAY_BATCH_ROWS
+        self.on_replayed = on_replayed
+        self._committed_seq = None # seq cuối đã ghi vào CSDL (đọc từ SpoolCheckpoints lần đầu)
+        self._replay_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def pending(self):
+        committed = self._committed_seq or 0
+        return max(0, self.spool.last_seq - committed)
+
+    def replay_pending(self):
+        """
+        Ghi toàn bộ phần spool chưa ghi, theo thứ tự. Trả về số dòng đã ghi; lỗi CSDL tạm thời được ném ra.
+        Lô gặp lỗi dữ liệu được ghi lại từng snapshot một: snapshot vẫn lỗi bị chuyển sang dead-letter
+        và mốc checkpoint vượt qua nó, các snapshot còn lại vẫn được ghi.
+        """
+        with self._replay_lock:
+            if self._committed_seq is None:
+                self._committed_seq = database.get_spool_checkpoint(self.spool.spool_id)
+                self.spool.truncate(self._committed_seq)
+            total = 0
+            while True:
+                records = self.spool.read(self._committed_seq, self.batch_rows)
+                if not records:
+                    break
+                try:
+                    total += self._replay_batch(records)
+                except RECORD_ERRORS as e:
+                    logger.warning(f"Lô {len(records)} snapshot từ spool gặp lỗi dữ liệu ({e}); ghi lại từng snapshot để tách bản ghi lỗi.")
+                    for record in records:
+                        try:
+                            total += self._replay_batch([record])
+                        except RECORD_ERRORS as record_error:
+                            self._dead_letter(record, record_error)
+            metrics.SPOOL_PENDING.set(self.pending())
+        if total and self.on_replayed is not None:
+            self.on_replayed()
+        return total
+
+    def _replay_batch(self, records):
+        """Ghi các bản ghi liên tiếp trong một transaction và dời checkpoint tới bản ghi cuối; trả về số dòng đã ghi."""
+        last_seq = records[-1]['seq']
+        started = time.perf_counter()
+        snapshots = [
+            dict(record, fetched_at=datetime.fromisoformat(record['fetched_at'])) for record in records
+        ]
+        written = database.insert_snapshots_bulk(snapshots, self.spool.spool_id, last_seq)
+        self._committed_seq = last_seq
+        self.spool.truncate(last_seq)
+        for source, count in written.items():
+            last_rows = next(len(s['rows']) for s in reversed(snapshots) if s['source'] == source)
+            metrics.record_snapshot(source, last_rows, count)
+        batch_rows = sum(written.values())
+        logger.log(
+            logging.INFO if len(records) > 1 else logging.DEBUG,
+            f"Đã ghi {len(records)} snapshot từ spool ({batch_rows} dòng) trong {time.perf_counter() - started:.2f}s",
+            extra={'snapshots': len(records), 'rows': batch_rows, 'last_seq': last_seq}
+        )
+        return batch_rows
+
+    def _dead_letter(self, record, error):
+        """Chuyển bản ghi hỏng sang dead-letter rồi dời checkpoint qua nó (ghi file trước: không mất bản ghi)."""
+        seq = record['seq']
+        self.spool.dead_letter(record, error)
+        database.advance_spool_checkpoint(self.spool.spool_id, seq)
+        self._committed_seq = seq
+        self.spool.truncate(seq)
+        metrics.SPOOL_DEAD_LETTERS.inc()
+        logger.error(f"Snapshot seq {seq} của {record.get('source')} không ghi được vào CSDL ({type(error).__name__}: {error}); "
+                     f"đã chuyển sang {self.spool.directory / DEAD_LETTER_FILE}.",
+                     extra={'seq': seq, 'source': record.get('source')})
+
+    def wake(self):
+        metrics.SPOOL_PENDING.set(self.pending())
+        self._wake.set()
+
+    def _run(self):
+        failures = 0
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                self.replay_pending()
+                failures = 0
+            except TRANSIENT_ERRORS as e:
+                failures += 1
+                delay = random.uniform(0.5, 1.0) * min(config.SPOOL_RETRY_MAX, 0.5 * (2 ** failures))
+                logger.warning(f"Chưa ghi được spool vào CSDL ({e}); còn {self.pending()} snapshot chờ, thử lại sau {delay:.1f}s.",
+                               extra={'pending': self.pending(), 'attempt': failures})
+                self._stop.wait(delay)
+                continue
+            except psycopg2.Error as e:
+                # Lỗi không do bản ghi nào (vd schema chưa migrate): không chuyển dữ liệu sang dead-letter,
+                # chờ lâu nhất rồi thử lại để người vận hành kịp xử lý
+                failures += 1
+                logger.error(f"Lỗi CSDL khi ghi spool ({type(e).__name__}: {e}); còn {self.pending()} snapshot chờ, "
+                             f"thử lại sau {config.SPOOL_RETRY_MAX:.0f}s.", extra={'pending': self.pending(), 'attempt': failures})
+                self._stop.wait(config.SPOOL_RETRY_MAX)
+                continue
+            self._wake.wait()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='spool-replay', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=30):
+        """Dừng thread nền rồi thử ghi nốt phần còn lại một lần; phần chưa ghi được vẫn nằm trong spool."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self.spool.last_seq == (self._committed_seq or 0):
+            return
+        try:
+            self.replay_pending()
+        except (psycopg2.Error, OSError) as e:
+            logger.warning(f"Còn {self.pending()} snapshot trong spool chưa ghi được vào CSDL: {e}")
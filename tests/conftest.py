@@ -0,0 +1,6 @@
+# tests/conftest.py
+import os
+import sys
+
+# Mã nguồn dùng import phẳng (import config, import database) như khi chạy python src/main.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
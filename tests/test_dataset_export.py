@@ -0,0 +1,51 @@
+# tests/test_dataset_export.py
+"""
+Xuất GoldPrices ra file dạng cột giữ nguyên phần thập phân của giá (NUMERIC(18, 4) -> float64).
+Cần một CSDL PostgreSQL dùng riêng cho test: PG_TEST_DATABASE=<tên> (và PG_HOST/PG_USER/PG_PASSWORD nếu cần);
+bỏ qua nếu không đặt biến này.
+"""
+import os
+import uuid
+
+import pytest
+
+TEST_DATABASE = os.getenv("PG_TEST_DATABASE")
+if not TEST_DATABASE:
+    pytest.skip("Chưa đặt PG_TEST_DATABASE", allow_module_level=True)
+os.environ["PG_DATABASE"] = TEST_DATABASE # Trước khi import config/database
+
+import pyarrow.compute as pc # noqa: E402
+import pyarrow.dataset as ds # noqa: E402
+
+import database # noqa: E402
+import dataset # noqa: E402
+
+
+@pytest.fixture(scope='module', autouse=True)
+def schema():
+    database.apply_migrations()
+    yield
+    database.close_pool()
+
+
+@pytest.mark.parametrize('fmt', sorted(dataset.EXPORT_FORMATS))
+def test_gold_export_keeps_fractional_prices(tmp_path, fmt):
+    type_name = f"Vàng test {uuid.uuid4().hex[:8]}"
+    provider = 'TEST'
+    written = database.insert_gold_prices_batch(
+        [{'type_name': type_name, 'original_type': type_name, 'city': None,
+          'buy': '85000000.2500', 'sell': '85500000.5000', 'unit': 'đồng/lượng'}],
+        '2025-05-08 10:00:00', provider=provider, detect_changes=False
+    )
+    assert written == 1
+    try:
+        dataset.export_history(tmp_path, fmt)
+        table = ds.dataset(str(tmp_path / 'gold_prices'), format='ipc' if fmt == 'arrow' else 'parquet',
+                           partitioning='hive').to_table()
+        rows = table.filter(pc.equal(table['gold_type_name'], type_name)).to_pylist()
+        assert [(row['buy_price'], row['sell_price']) for row in rows] == [(85000000.25, 85500000.5)]
+    finally:
+        with database.db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM GoldTypes WHERE name = %s AND provider = %s", (type_name, provider))
+                cursor.execute("DELETE FROM SourceSnapshots WHERE source = %s", (provider,))